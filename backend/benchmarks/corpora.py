@@ -0,0 +1,138 @@
+"""Deterministic synthetic source corpora for the engine benchmarks.
+
+Every corpus is built from numbered units with no randomness, so the same
+(language, kind, size) always yields the same source.
+"""
+
+LANGUAGES = ('javascript', 'typescript', 'python')
+KINDS = ('many_small', 'huge_function', 'deep_nesting', 'long_strings')
+FILENAMES = {'javascript': 'bench.js', 'typescript': 'bench.ts', 'python': 'bench.py'}
+
+NESTING_DEPTH = 24
+STRING_WIDTH = 400
+
+def _js_small(i: int, typed: bool) -> str:
+    sig = f"(a: number, b: number, c: boolean): number" if typed else "(a, b, c)"
+    arrow = f"(x: number): number" if typed else "(x)"
+    return (
+        f"function fn_{i}{sig} {{\n"
+        f"  // helper {i}: compares 'a' and \"b\"\n"
+        f"  const label = \"item {i} // not a comment\";\n"
+        f"  if (a > b && c || label.length === {i % 13}) {{\n"
+        f"    return a + b * {i % 7};\n"
+        f"  }}\n"
+        f"  for (let k = 0; k < b; k++) {{ a += k % 3 === 0 ? k : -k; }}\n"
+        f"  return a;\n"
+        f"}}\n"
+        f"export const arrow_{i} = {arrow} => x * {i % 5 + 1};\n"
+    )
+
+def _py_small(i: int) -> str:
+    return (
+        f"def fn_{i}(a, b, c=None):\n"
+        f"    # helper {i}: compares 'a' and \"b\"\n"
+        f"    label = \"item {i} # not a comment\"\n"
+        f"    if a > b and c or len(label) == {i % 13}:\n"
+        f"        return a + b * {i % 7}\n"
+        f"    for k in range(b):\n"
+        f"        a += k if k % 3 == 0 else -k\n"
+        f"    return a\n"
+        f"\n"
+    )
+
+def _js_statement(i: int) -> str:
+    return [
+        f"  let v{i} = items[{i % 17}] * {i % 9} + offset;\n",
+        f"  if (v{i - 1} > {i % 23} && flags.enabled) {{ total += v{i - 1}; }}\n",
+        f"  total = total > {i} ? total - {i % 11} : total + 1;\n",
+        f"  while (total > {i * 3} || total < -{i}) {{ total = Math.floor(total / 2); }}\n",
+    ][i % 4]
+
+def _py_statement(i: int) -> str:
+    return [
+        f"    v{i} = items[{i % 17}] * {i % 9} + offset\n",
+        f"    if v{i - 1} > {i % 23} and flags.enabled:\n        total += v{i - 1}\n",
+        f"    total = total - {i % 11} if total > {i} else total + 1\n",
+        f"    while total > {i * 3} or total < -{i}:\n        total = total // 2\n",
+    ][i % 4]
+
+def _js_nested(i: int, typed: bool) -> str:
+    sig = "(input: any[]): number" if typed else "(input)"
+    lines = [f"function nested_{i}{sig} {{\n", "  let acc = 0;\n"]
+    for d in range(1, NESTING_DEPTH + 1):
+        pad = '  ' * d
+        if d % 3 == 0:
+            lines.append(f"{pad}const inner_{i}_{d} = (x) => {{\n")
+        elif d % 3 == 1:
+            lines.append(f"{pad}for (const v{d} of input) {{\n")
+        else:
+            lines.append(f"{pad}if (v{d - 1} > {d} || acc < {i}) {{\n")
+        lines.append(f"{pad}  acc += {d};\n")
+    for d in range(NESTING_DEPTH, 0, -1):
+        lines.append('  ' * d + ('};\n' if d % 3 == 0 else '}\n'))
+    lines.append("  return acc;\n}\n")
+    return ''.join(lines)
+
+def _py_nested(i: int) -> str:
+    lines = [f"def nested_{i}(input):\n", "    acc = 0\n"]
+    for d in range(1, NESTING_DEPTH + 1):
+        pad = '    ' * d
+        if d % 3 == 0:
+            lines.append(f"{pad}def inner_{i}_{d}(x):\n")
+        elif d % 3 == 1:
+            lines.append(f"{pad}for v{d} in input:\n")
+        else:
+            lines.append(f"{pad}if v{d - 1} > {d} or acc < {i}:\n")
+        lines.append(f"{pad}    acc = {d}\n")
+    lines.append("    return acc\n\n")
+    return ''.join(lines)
+
+def _filler(i: int, quote: str) -> str:
+    text = f"segment {i} with // slashes, /* stars */, # hashes and escaped \\{quote} quotes; "
+    return (text * (STRING_WIDTH // len(text) + 1))[:STRING_WIDTH].rstrip('\\')
+
+def _js_strings(i: int) -> str:
+    return (
+        f"const text_{i} = \"{_filler(i, chr(34))}\";\n"
+        f"const tpl_{i} = `line one ${{text_{i}.length}}\n  {_filler(i, '`')}\n  end`;\n"
+        f"function use_{i}() {{ return text_{i} + '{_filler(i, chr(39))}'; }}\n"
+    )
+
+def _py_strings(i: int) -> str:
+    return (
+        f"TEXT_{i} = \"{_filler(i, chr(34))}\"\n"
+        f"DOC_{i} = \"\"\"line one\n{_filler(i, chr(39))}\nend\"\"\"\n"
+        f"def use_{i}():\n    return TEXT_{i} + f\"{{DOC_{i}!r}} {i}\"\n\n"
+    )
+
+def _units(language: str, kind: str):
+    typed = language == 'typescript'
+    python = language == 'python'
+    i = 0
+    if kind == 'huge_function':
+        yield "def huge(items, offset, flags):\n    total = 0\n    v0 = 0\n" if python else \
+            "function huge(items, offset, flags) {\n  let total = 0;\n  let v0 = 0;\n"
+        while True:
+            i += 1
+            yield _py_statement(i) if python else _js_statement(i)
+    while True:
+        i += 1
+        if kind == 'many_small':
+            yield _py_small(i) if python else _js_small(i, typed)
+        elif kind == 'deep_nesting':
+            yield _py_nested(i) if python else _js_nested(i, typed)
+        else:
+            yield _py_strings(i) if python else _js_strings(i)
+
+def generate(language: str, kind: str, loc: int) -> str:
+    """Source of at least loc lines made of whole units of the given kind."""
+    parts = []
+    lines = 0
+    for unit in _units(language, kind):
+        parts.append(unit)
+        lines += unit.count('\n')
+        if lines >= loc:
+            break
+    if kind == 'huge_function':
+        parts.append("    return total\n" if language == 'python' else "  return total;\n}\n")
+    return ''.join(parts)
@@ -0,0 +1,142 @@
+"""Time each analyzer stage on synthetic corpora and gate regressions against a baseline.
+
+Usage: python backend/benchmarks/engine.py [--languages ...] [--kinds ...] [--sizes ...]
+                                           [--repeat N] [--save PATH]
+                                           [--compare PATH [--threshold F] [--min-seconds S]]
+
+Corpora come from corpora.py and are identical on every run. Each stage is
+timed on its own (best of --repeat, span memo cleared) so a regression points
+at the stage that caused it. --save writes a JSON baseline; --compare exits 1
+when any stage is slower than the baseline by more than --threshold.
+"""
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(BACKEND_DIR))
+# server.py connects lazily; these only need to be present
+os.environ.setdefault('MONGO_URL', 'mongodb://localhost:27017')
+os.environ.setdefault('DB_NAME', 'noseycoder_bench')
+
+import server  # noqa: E402
+from corpora import FILENAMES, KINDS, LANGUAGES, generate  # noqa: E402
+
+# 200000 LOC is supported but takes minutes per corpus, so it is opt-in via --sizes
+SIZES = (1000, 20000)
+STAGES = (
+    'remove_comments_and_strings', 'lex', 'extract', 'compute_halstead',
+    'compute_cyclomatic_complexity', 'span_facts', 'linter', 'analyze_code'
+)
+LABELS = dict(zip(STAGES, ('strip', 'lex', 'extract', 'halstead', 'cc', 'spans', 'linter', 'total')))
+
+def extract(code: str, language: str, offsets: list) -> tuple:
+    if language == 'python':
+        return server.python_engine(code, offsets)
+    return server.extract_js_functions(code, offsets), None
+
+def stage_calls(code: str, language: str) -> dict:
+    """Zero-argument callables per stage; inputs of later stages are prepared up front."""
+    filename = FILENAMES[language]
+    offsets = server.line_offsets(code)
+    functions, tokens = extract(code, language, offsets)
+    server._span_memo.clear()
+    _, fn_facts = server.collect_span_facts(code, language, functions, offsets, tokens)
+    _, fact_table = server.function_tables(functions, fn_facts)
+    return {
+        'remove_comments_and_strings': lambda: server.remove_comments_and_strings(code, language),
+        'lex': lambda: server.lex(code, language),
+        'extract': lambda: extract(code, language, server.line_offsets(code)),
+        'compute_halstead': lambda: server.compute_halstead(code, language),
+        'compute_cyclomatic_complexity': lambda: server.compute_cyclomatic_complexity(code, language),
+        'span_facts': lambda: server.collect_span_facts(code, language, functions, offsets, tokens),
+        'linter': lambda: server.apply_rules(fact_table, language),
+        'analyze_code': lambda: server.analyze_code(code, filename),
+    }
+
+def best_of(call, repeat: int) -> float:
+    best = float('inf')
+    for _ in range(repeat):
+        server._span_memo.clear()
+        started = time.perf_counter()
+        call()
+        best = min(best, time.perf_counter() - started)
+    return best
+
+def run(languages, kinds, sizes, repeat: int) -> dict:
+    results = {}
+    for language in languages:
+        for kind in kinds:
+            for size in sizes:
+                code = generate(language, kind, size)
+                loc = code.count('\n') + 1
+                calls = stage_calls(code, language)
+                row = []
+                for stage in STAGES:
+                    seconds = best_of(calls[stage], repeat)
+                    results[f"{language}/{kind}/{size}/{stage}"] = round(seconds, 6)
+                    row.append(f"{LABELS[stage]}={seconds * 1000:.1f}")
+                print(f"{language:<10} {kind:<13} {loc:>7} LOC  " + '  '.join(row) + '  (ms)', flush=True)
+    return results
+
+def compare(results: dict, baseline: dict, threshold: float, min_seconds: float) -> list:
+    """Return (key, baseline, current) for each stage slower by more than threshold and min_seconds."""
+    regressions = []
+    for key, current in results.items():
+        previous = baseline.get(key)
+        if previous is None:
+            continue
+        if current > previous * (1 + threshold) and current - previous > min_seconds:
+            regressions.append((key, previous, current))
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--languages', nargs='+', choices=LANGUAGES, default=list(LANGUAGES))
+    parser.add_argument('--kinds', nargs='+', choices=KINDS, default=list(KINDS))
+    parser.add_argument('--sizes', nargs='+', type=int, default=list(SIZES))
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--save', help='write results as a JSON baseline')
+    parser.add_argument('--compare', help='baseline JSON to compare against')
+    parser.add_argument('--threshold', type=float, default=0.25,
+                        help='allowed slowdown as a fraction of the baseline (default 0.25)')
+    parser.add_argument('--min-seconds', type=float, default=0.002,
+                        help='ignore slowdowns smaller than this many seconds (default 0.002)')
+    args = parser.parse_args()
+
+    baseline = None
+    if args.compare:
+        baseline = json.loads(Path(args.compare).read_text())
+
+    results = run(args.languages, args.kinds, args.sizes, args.repeat)
+
+    if args.save:
+        Path(args.save).write_text(json.dumps({
+            'meta': {
+                'analyzerVersion': server.ANALYZER_VERSION, 'pythonEngine': server.PYTHON_ENGINE,
+                'python': platform.python_version(), 'machine': platform.machine(),
+                'repeat': args.repeat, 'createdAt': datetime.now(timezone.utc).isoformat()
+            },
+            'results': results
+        }, indent=2, sort_keys=True) + '\n')
+        print(f"saved {len(results)} timings to {args.save}")
+
+    if baseline is not None:
+        missing = sorted(set(results) - set(baseline['results']))
+        if missing:
+            print(f"{len(missing)} timings have no baseline entry, e.g. {missing[0]}")
+        regressions = compare(results, baseline['results'], args.threshold, args.min_seconds)
+        for key, previous, current in regressions:
+            print(f"REGRESSION {key}: {previous * 1000:.2f} ms -> {current * 1000:.2f} ms "
+                  f"(+{(current / previous - 1) * 100:.0f}%)")
+        if regressions:
+            sys.exit(1)
+        print(f"no stage slower than {args.threshold:.0%} over {args.compare}")
+
+if __name__ == '__main__':
+    main()
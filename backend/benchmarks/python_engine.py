@@ -0,0 +1,62 @@
+"""Compare the ast/tokenize Python engine with the regex fallback on large modules.
+
+Usage: python backend/benchmarks/python_engine.py [--copies N] [--repeat N] [FILE ...]
+
+Each FILE (default: backend/server.py) is repeated --copies times to build a
+large module, then analyzed cold (span memo cleared) with each engine.
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+from pathlib import Path
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(BACKEND_DIR))
+# server.py connects lazily; these only need to be present
+os.environ.setdefault('MONGO_URL', 'mongodb://localhost:27017')
+os.environ.setdefault('DB_NAME', 'noseycoder_bench')
+
+import server  # noqa: E402
+
+ENGINES = ('ast', 'regex')
+
+def run(code: str, engine: str, repeat: int) -> tuple:
+    server.PYTHON_ENGINE = engine
+    times = []
+    result = None
+    for _ in range(repeat):
+        server._span_memo.clear()
+        started = time.perf_counter()
+        result = server.analyze_code(code, 'bench.py')
+        times.append(time.perf_counter() - started)
+    return statistics.median(times), result
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('files', nargs='*', default=[str(BACKEND_DIR / 'server.py')])
+    parser.add_argument('--copies', type=int, default=20)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    for path in args.files:
+        code = '\n'.join([Path(path).read_text()] * args.copies)
+        loc = code.count('\n') + 1
+        print(f"{path} x{args.copies}: {loc} LOC, {len(code) / 1e6:.2f} MB")
+        results = {}
+        for engine in ENGINES:
+            seconds, result = run(code, engine, args.repeat)
+            results[engine] = result
+            summary = result['summary']
+            print(f"  {engine:<6} {seconds * 1000:8.1f} ms  {loc / seconds:10.0f} LOC/s  "
+                  f"functions={summary['functionCount']} cc={summary['cyclomaticComplexity']} "
+                  f"volume={summary['halstead']['volume']}")
+        def key(fn):
+            return fn['name'], fn['startLine'], fn['endLine'], fn['loc'], fn['cyclomaticComplexity']
+
+        agree = sum(1 for a, b in zip(results['ast']['functions'], results['regex']['functions']) if key(a) == key(b))
+        print(f"  per-function agreement (name, start, end, loc, CC): {agree}/{len(results['ast']['functions'])}")
+
+if __name__ == '__main__':
+    main()
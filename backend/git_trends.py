@@ -0,0 +1,297 @@
+"""Replay a local git repository's history and store complexity trends next to analysis_history.
+
+Usage: python backend/git_trends.py REPO [--rev REV] [--since DATE] [--max-commits N] [--every N]
+                                         [--name NAME] [--jobs N] [--dry-run]
+
+Walks the first-parent history of REV, oldest first. Each selected commit is
+diffed against the previous one in parallel git processes, so only changed
+paths are looked at. Sources are read from the object store and analyzed in
+the server's worker pool (ANALYSIS_WORKERS) once per blob SHA and language:
+a blob already summarized in analysis_blob_summaries, by this run or an
+earlier one, is never analyzed again. The per-commit repository series goes
+to analysis_trend_commits and per-file change points to analysis_trend_files,
+both served by GET /api/trends/{name}. Only the git binary and the on-disk
+clone are needed; --dry-run prints the series without touching Mongo.
+"""
+import argparse
+import asyncio
+import os
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from pathlib import Path
+
+BACKEND_DIR = Path(__file__).resolve().parent
+sys.path.insert(0, str(BACKEND_DIR))
+
+import server  # noqa: E402
+from fastapi import HTTPException  # noqa: E402
+from pymongo import ReplaceOne  # noqa: E402
+
+# Regular files only: symlinks (120000) and submodules (160000) have no source to analyze
+SOURCE_MODES = ('100644', '100755')
+LOOKUP_BATCH = 1000
+WRITE_BATCH = 1000
+TOTALS = ('loc', 'sloc', 'functionCount', 'issueCount', 'cyclomaticComplexity', 'maintainabilityIndex')
+
+def git(repo: str, *args: str) -> bytes:
+    return subprocess.run(['git', '-C', repo, *args], check=True, capture_output=True).stdout
+
+def decode_path(raw: bytes) -> str:
+    return raw.decode('utf-8', 'surrogateescape')
+
+def list_commits(repo: str, rev: str, since: datetime = None, max_commits: int = 0, every: int = 1) -> list:
+    """(sha, commit time, first-parent depth) of the selected commits, oldest first.
+
+    --every keeps every Nth commit counted back from the newest, so REV itself is always included.
+    """
+    lines = git(repo, 'log', '--first-parent', '--format=%H %ct', rev).decode().split()
+    chain = [(lines[i], int(lines[i + 1])) for i in range(0, len(lines), 2)]
+    commits = [(sha, ct, len(chain) - i) for i, (sha, ct) in enumerate(chain)]
+    if since is not None:
+        commits = [c for c in commits if c[1] >= since.timestamp()]
+    if max_commits:
+        commits = commits[:max_commits]
+    return commits[::every][::-1]
+
+def tree_files(repo: str, commit: str) -> dict:
+    """{path: blob} for the supported source files in a commit."""
+    files = {}
+    for record in git(repo, 'ls-tree', '-r', '-z', commit).split(b'\0'):
+        if not record:
+            continue
+        meta, raw_path = record.split(b'\t', 1)
+        mode, kind, blob = meta.decode().split()
+        path = decode_path(raw_path)
+        if kind == 'blob' and mode in SOURCE_MODES and server.detect_language(path) != 'unknown':
+            files[path] = blob
+    return files
+
+def tree_changes(repo: str, old: str, new: str) -> dict:
+    """{path: blob, or None once it is gone} for supported source files that differ between two commits."""
+    fields = git(repo, 'diff-tree', '-r', '-z', '--no-renames', old, new).split(b'\0')
+    changes = {}
+    for meta, raw_path in zip(fields[0::2], fields[1::2]):
+        _, mode, _, blob, status = meta.decode().lstrip(':').split()
+        path = decode_path(raw_path)
+        if server.detect_language(path) == 'unknown':
+            continue
+        changes[path] = blob if status != 'D' and mode in SOURCE_MODES else None
+    return changes
+
+def walk(repo: str, commits: list, jobs: int) -> list:
+    """Changed source files per commit; the first commit's whole tree counts as changed."""
+    shas = [sha for sha, _, _ in commits]
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        first = pool.submit(tree_files, repo, shas[0])
+        rest = list(pool.map(lambda pair: tree_changes(repo, *pair), zip(shas, shas[1:])))
+        return [first.result(), *rest]
+
+def blob_sizes(repo: str, blobs: list) -> dict:
+    if not blobs:
+        return {}
+    out = subprocess.run(
+        ['git', '-C', repo, 'cat-file', '--batch-check'],
+        input=''.join(blob + '\n' for blob in blobs).encode(), check=True, capture_output=True
+    ).stdout
+    sizes = {}
+    for line in out.decode().splitlines():
+        blob, _, size = line.split()
+        sizes[blob] = int(size)
+    return sizes
+
+class BlobReader:
+    """Blob contents through one long-running git cat-file --batch process."""
+
+    def __init__(self, repo: str):
+        self.proc = subprocess.Popen(
+            ['git', '-C', repo, 'cat-file', '--batch'], stdin=subprocess.PIPE, stdout=subprocess.PIPE
+        )
+        self.lock = threading.Lock()
+
+    def read(self, blob: str) -> bytes:
+        with self.lock:
+            self.proc.stdin.write(blob.encode() + b'\n')
+            self.proc.stdin.flush()
+            header = self.proc.stdout.readline().split()
+            if len(header) != 3:
+                raise KeyError(blob)
+            data = self.proc.stdout.read(int(header[2]))
+            self.proc.stdout.read(1)  # the newline after the contents
+            return data
+
+    def close(self):
+        self.proc.stdin.close()
+        self.proc.wait()
+
+async def load_summaries(keys: list) -> dict:
+    summaries = {}
+    for i in range(0, len(keys), LOOKUP_BATCH):
+        async for doc in server.db.analysis_blob_summaries.find(
+            {'_id': {'$in': keys[i:i + LOOKUP_BATCH]}}, {'version': 0, 'createdAt': 0}
+        ):
+            summaries[doc.pop('_id')] = doc
+    return summaries
+
+async def analyze_blobs(repo: str, todo: dict) -> dict:
+    """{key: summary} for {key: (blob, path)}; blobs over ARCHIVE_MAX_FILE_BYTES are marked skipped."""
+    sizes = await asyncio.to_thread(blob_sizes, repo, sorted({blob for blob, _ in todo.values()}))
+    reader = BlobReader(repo)
+    # Enough in flight to keep every worker busy without filling the lane queues
+    in_flight = asyncio.Semaphore(max(1, server.analysis_pool.large.workers + server.analysis_pool.small.workers) * 2)
+    summaries = {}
+
+    async def analyze(key: str, blob: str, path: str):
+        if sizes.get(blob, 0) > server.ARCHIVE_MAX_FILE_BYTES:
+            summaries[key] = {'skipped': True}
+            return
+        async with in_flight:
+            code = (await asyncio.to_thread(reader.read, blob)).decode('utf-8', 'replace')
+            try:
+                try:
+                    result, _ = await server.analysis_pool.run(code, path)
+                except server.AnalysisBudgetExceeded:
+                    result, _ = await server.analysis_pool.run_degraded(code, path, 'worker_killed')
+            except (HTTPException, server.AnalysisBudgetExceeded) as e:
+                # Left out of the store, so the next run tries again
+                print(f"  {path} @ {blob[:12]}: {getattr(e, 'detail', 'analysis worker crashed')}", flush=True)
+                return
+            summaries[key] = server.blob_summary(result)
+            if len(summaries) % 500 == 0:
+                print(f"  analyzed {len(summaries)}/{len(todo)} blobs", flush=True)
+
+    try:
+        await asyncio.gather(*(analyze(key, blob, path) for key, (blob, path) in todo.items()))
+    finally:
+        reader.close()
+    return summaries
+
+def replay(name: str, commits: list, changes: list, summaries: dict) -> tuple:
+    """(commit points, file points), keeping repository totals current as each change lands."""
+    files = {}  # path -> summary at the current commit
+    failed = set()  # paths whose current blob has no summary
+    totals = dict.fromkeys(TOTALS, 0)
+    skipped = 0
+    commit_points, file_points = [], []
+    for (sha, ct, depth), changed in zip(commits, changes):
+        timestamp = datetime.fromtimestamp(ct, timezone.utc).isoformat(timespec='microseconds')
+        for path, blob in sorted(changed.items()):
+            old = files.pop(path, None)
+            failed.discard(path)
+            if old is not None and old.get('skipped'):
+                skipped -= 1
+            elif old is not None:
+                for field in TOTALS:
+                    totals[field] -= old[field]
+            point = {'repo': name, 'path': path, 'commit': sha, 'depth': depth, 'timestamp': timestamp}
+            if blob is None:
+                file_points.append({**point, 'deleted': True})
+                continue
+            summary = summaries.get(server.blob_summary_key(blob, server.detect_language(path)))
+            if summary is None:
+                failed.add(path)
+                continue
+            files[path] = summary
+            if summary.get('skipped'):
+                skipped += 1
+            else:
+                for field in TOTALS:
+                    totals[field] += summary[field]
+            file_points.append({**point, 'blob': blob, **summary})
+        analyzed = len(files) - skipped
+        commit_points.append({
+            'repo': name, 'commit': sha, 'depth': depth, 'timestamp': timestamp,
+            'files': analyzed, 'skipped': skipped, 'errors': len(failed), 'changedFiles': len(changed),
+            'loc': totals['loc'], 'sloc': totals['sloc'], 'functionCount': totals['functionCount'],
+            'issueCount': totals['issueCount'], 'cyclomaticComplexity': totals['cyclomaticComplexity'],
+            'meanCyclomaticComplexity': round(totals['cyclomaticComplexity'] / analyzed, 2) if analyzed else 0,
+            'maintainabilityIndex': round(totals['maintainabilityIndex'] / analyzed, 2) if analyzed else None,
+            'analyzerVersion': server.ANALYZER_VERSION
+        })
+    return commit_points, file_points
+
+async def write(collection, docs: list, key):
+    for i in range(0, len(docs), WRITE_BATCH):
+        await collection.bulk_write(
+            [ReplaceOne({'_id': key(doc)}, doc, upsert=True) for doc in docs[i:i + WRITE_BATCH]], ordered=False
+        )
+
+async def run(args) -> tuple:
+    repo = str(Path(args.repo).resolve())
+    name = args.name or Path(git(repo, 'rev-parse', '--show-toplevel').decode().strip()).name
+    since = datetime.fromisoformat(args.since) if args.since else None
+    if since is not None and since.tzinfo is None:
+        since = since.replace(tzinfo=timezone.utc)
+    started = time.perf_counter()
+    commits = list_commits(repo, args.rev, since, args.max_commits, args.every)
+    if not commits:
+        raise SystemExit(f"no commits of {args.rev} selected")
+    changes = await asyncio.to_thread(walk, repo, commits, args.jobs)
+    print(f"{name}: {len(commits)} commits, {sum(map(len, changes))} file changes "
+          f"({time.perf_counter() - started:.1f}s)", flush=True)
+
+    wanted = {}
+    for changed in changes:
+        for path, blob in changed.items():
+            if blob is not None:
+                wanted.setdefault(server.blob_summary_key(blob, server.detect_language(path)), (blob, path))
+    summaries = {}
+    if not args.dry_run:
+        await server.prepare_trend_collections()
+        summaries = await load_summaries(list(wanted))
+    todo = {key: source for key, source in wanted.items() if key not in summaries}
+    print(f"{len(wanted)} distinct blobs, {len(wanted) - len(todo)} already summarized", flush=True)
+
+    server.analysis_pool.start()
+    try:
+        fresh = await analyze_blobs(repo, todo)
+    finally:
+        server.analysis_pool.shutdown()
+    summaries.update(fresh)
+    commit_points, file_points = replay(name, commits, changes, summaries)
+
+    if args.dry_run:
+        for point in commit_points:
+            print(f"{point['commit'][:12]} {point['timestamp'][:10]} files={point['files']} loc={point['loc']} "
+                  f"cc={point['cyclomaticComplexity']} mi={point['maintainabilityIndex']} "
+                  f"issues={point['issueCount']}")
+    else:
+        now = datetime.now(timezone.utc)
+        await write(
+            server.db.analysis_blob_summaries,
+            [{'_id': key, **summary, 'version': server.ANALYZER_VERSION, 'createdAt': now} for key, summary in fresh.items()],
+            lambda doc: doc['_id']
+        )
+        await write(server.db.analysis_trend_commits, commit_points, lambda doc: f"{doc['repo']}:{doc['commit']}")
+        await write(server.db.analysis_trend_files, file_points,
+                    lambda doc: f"{doc['repo']}:{doc['commit']}:{doc['path']}")
+    print(f"analyzed {len(fresh)} blobs; {len(commit_points)} commit and {len(file_points)} file points "
+          f"in {time.perf_counter() - started:.1f}s", flush=True)
+    return commit_points, file_points
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('repo', help='path inside a local git clone')
+    parser.add_argument('--rev', default='HEAD', help='newest commit to replay (default HEAD)')
+    parser.add_argument('--since', help='skip commits older than this ISO date')
+    parser.add_argument('--max-commits', type=int, default=0, help='replay at most the newest N selected commits')
+    parser.add_argument('--every', type=int, default=1, help='keep every Nth first-parent commit (default 1)')
+    parser.add_argument('--name', help='repository name in the stored series (default: the clone directory name)')
+    parser.add_argument('--jobs', type=int, default=os.cpu_count() or 2,
+                        help='parallel git diff-tree processes for the commit walk')
+    parser.add_argument('--dry-run', action='store_true', help='print the series instead of storing it')
+    args = parser.parse_args()
+    if args.every < 1:
+        parser.error('--every must be at least 1')
+    try:
+        asyncio.run(run(args))
+    except subprocess.CalledProcessError as e:
+        sys.exit(f"git {' '.join(e.cmd[3:])} failed: {e.stderr.decode(errors='replace').strip()}")
+    finally:
+        server.client.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,53 @@
+"""Run jobs submitted to /api/jobs on this node, without serving the API.
+
+Usage: python backend/job_worker.py [--runners N]
+
+Each runner claims one job at a time from analysis_jobs and analyzes it in
+this node's worker pool (ANALYSIS_WORKERS). Start as many of these as needed,
+on any number of nodes sharing the Mongo database; set JOB_RUNNERS=0 on the
+API tier so it only accepts and serves jobs. SIGINT or SIGTERM hands running
+jobs back to the queue before exiting.
+"""
+import argparse
+import asyncio
+import os
+import signal
+import sys
+from pathlib import Path
+
+BACKEND_DIR = Path(__file__).resolve().parent
+sys.path.insert(0, str(BACKEND_DIR))
+# Only bulk work runs here, so no worker needs to be held back for interactive requests
+os.environ.setdefault('SCHED_INTERACTIVE_RESERVE', '0')
+
+import server  # noqa: E402
+
+async def serve(runners: int):
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    await server.prepare_job_collections()
+    server.analysis_pool.start()
+    server.history_writer.start()
+    server.job_runner.start(runners)
+    server.logger.info("Job worker %s running %d runners", server.job_runner.owner, runners)
+    try:
+        await stop.wait()
+    finally:
+        await server.job_runner.close()
+        await server.history_writer.close()
+        server.analysis_pool.shutdown()
+        server.client.close()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runners', type=int, default=max(1, server.JOB_RUNNERS),
+                        help='jobs run at once on this node (default JOB_RUNNERS, at least 1)')
+    args = parser.parse_args()
+    if args.runners < 1:
+        parser.error('--runners must be at least 1')
+    asyncio.run(serve(args.runners))
+
+if __name__ == '__main__':
+    main()
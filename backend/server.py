@@ -1,16 +1,69 @@
-from fastapi import FastAPI, APIRouter
+from fastapi import FastAPI, APIRouter, HTTPException, Query, Request, Response, WebSocket, WebSocketDisconnect
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.responses import StreamingResponse
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError
 import os
+import ast
 import logging
 import math
 import re
 from pathlib import Path
-from pydantic import BaseModel, Field, ConfigDict
-from typing import List, Optional
+from pydantic import BaseModel, Field, ConfigDict, field_validator
+from typing import Dict, Iterator, List, Literal, NamedTuple, Optional, Tuple
+from array import array
+from bisect import bisect_left, bisect_right
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
 import uuid
-from datetime import datetime, timezone
+import base64
+import codecs
+import gzip
+import json
+import asyncio
+import cProfile
+import hashlib
+import time
+import multiprocessing
+import random
+import signal
+import heapq
+import io
+import shutil
+import socket
+import tarfile
+import tempfile
+import threading
+import tokenize
+import zipfile
+import zlib
+from collections import Counter as TokenTally, OrderedDict, deque
+from contextvars import ContextVar
+from itertools import chain
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import shared_memory
+from datetime import datetime, timedelta, timezone
+
+try:
+    import resource
+except ImportError:  # Unix only; elsewhere analyses run without a CPU budget
+    resource = None
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import msgpack
+except ImportError:  # in requirements.txt; without it every response is JSON
+    msgpack = None
+try:
+    import brotli
+except ImportError:  # in requirements.txt; without it large responses fall back to gzip
+    brotli = None
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
@@ -19,14 +72,70 @@ mongo_url = os.environ['MONGO_URL']
 client = AsyncIOMotorClient(mongo_url)
 db = client[os.environ['DB_NAME']]
 
+# Bump whenever analyze_code output changes; cached results from other versions are ignored
+ANALYZER_RELEASE = '5'
+# The Python engines (see Python Engine below) can disagree on a source, so
+# each versions its results apart and nodes running either can share Mongo
+PYTHON_ENGINE = os.environ.get('PYTHON_ENGINE', 'regex')
+ANALYZER_VERSIONS = {'regex': ANALYZER_RELEASE, 'ast': ANALYZER_RELEASE + '-ast'}
+ANALYZER_VERSION = ANALYZER_VERSIONS.get(PYTHON_ENGINE, ANALYZER_RELEASE)
+
 app = FastAPI()
 api_router = APIRouter(prefix="/api")
 
 # ─── Models ───
-class AnalyzeRequest(BaseModel):
+class RuleConfig(BaseModel):
+    model_config = ConfigDict(extra="forbid")
+    enabled: bool = True
+    thresholds: Dict[str, float] = Field(default_factory=dict)
+
+class RuleOverrides(BaseModel):
+    rules: Optional[Dict[str, RuleConfig]] = None
+
+    @field_validator('rules')
+    @classmethod
+    def check_rules(cls, rules):
+        return validate_rule_config(rules)
+
+class AnalyzeRequest(RuleOverrides):
     code: str
     filename: str = "untitled.js"
 
+class ProbeRequest(RuleOverrides):
+    digest: str = Field(pattern=r'^[0-9a-f]{64}$')  # SHA-256 of the UTF-8 source
+    filename: str = "untitled.js"
+
+class BatchAnalyzeRequest(BaseModel):
+    items: List[AnalyzeRequest]
+
+class IncrementalAnalyzeRequest(RuleOverrides):
+    resultId: str
+    diff: str
+    filename: Optional[str] = None
+
+class LivePosition(BaseModel):
+    line: int = Field(ge=0)       # 0-based
+    character: int = Field(ge=0)  # 0-based code point column
+
+class LiveRange(BaseModel):
+    start: LivePosition
+    end: LivePosition
+
+class LiveChange(BaseModel):
+    range: Optional[LiveRange] = None  # None replaces the whole document
+    text: str
+
+class LiveOpenMessage(RuleOverrides):
+    type: Literal['open']
+    filename: str
+    text: str
+    version: int = 0
+
+class LiveEditMessage(BaseModel):
+    type: Literal['edit']
+    version: int
+    changes: List[LiveChange]
+
 class HalsteadResult(BaseModel):
     uniqueOperators: int = 0
     uniqueOperands: int = 0
@@ -45,7 +154,14 @@ class ComplexityLevel(BaseModel):
     color: str
     level: int
 
+class ExclusiveMetrics(BaseModel):
+    loc: int
+    cyclomaticComplexity: int
+    halstead: HalsteadResult
+
 class FunctionMetric(BaseModel):
+    id: int
+    parentId: Optional[int] = None
     name: str
     startLine: int
     endLine: int
@@ -58,6 +174,7 @@ class FunctionMetric(BaseModel):
     maintainabilityIndex: float
     maintainabilityLevel: ComplexityLevel
     maxNestingDepth: int
+    exclusive: ExclusiveMetrics
     heatIntensity: float
 
 class LinterIssue(BaseModel):
@@ -116,7 +233,7 @@ class AnalysisRecord(BaseModel):
     maintainability: float
     functionCount: int
     issueCount: int
-    timestamp: str = Field(default_factory=lambda: datetime.now(timezone.utc).isoformat())
+    timestamp: str = Field(default_factory=lambda: iso_timestamp(datetime.now(timezone.utc)))
 
 # ─── Analysis Engine (Python port of analyzer-core.js) ───
 
@@ -150,6 +267,401 @@ PY_OPERATORS = {
     'not', 'in', 'is', '&', '|', '^', '~', '<<', '>>', ':=', '->', ':'
 }
 
+JS_DECISIONS = {'if', 'for', 'while', 'case', 'catch', '?', '&&', '||', '??'}
+PY_DECISIONS = {'if', 'elif', 'for', 'while', 'except', 'and', 'or'}
+
+# ─── Lexer ───
+# One token stream per file; every metric below is computed from it, so the
+# source text is scanned exactly once per analysis.
+
+class Token(NamedTuple):
+    kind: str   # 'keyword' | 'name' | 'number' | 'string' | 'comment' | 'op' | 'punct'
+    text: str
+    start: int  # offset into the source
+    line: int   # 1-based
+    col: int    # 0-based, used for Python indentation
+
+def _operator_pattern(ops: set) -> str:
+    symbols = sorted((op for op in ops if not op.isalpha()), key=len, reverse=True)
+    return '|'.join(re.escape(op) for op in symbols)
+
+_NUMBER_PATTERN = r'0[xXoObB][0-9a-fA-F_]+n?|\d[\d_]*\.?\d*(?:[eE][+-]?\d+)?[njJ]?'
+
+_JS_TOKEN_RE = re.compile(
+    r'(?P<comment>//[^\n]*|/\*[\s\S]*?(?:\*/|\Z))'
+    r'|(?P<string>`(?:\\[\s\S]|[^\\`])*`?|\'(?:\\.|[^\\\'\n])*\'?|"(?:\\.|[^\\"\n])*"?)'
+    r'|(?P<name>[A-Za-z_$][\w$]*)'
+    rf'|(?P<number>{_NUMBER_PATTERN})'
+    rf'|(?P<op>{_operator_pattern(JS_OPERATORS)})'
+    r'|(?P<punct>[{}()\[\];,.@#])'
+)
+
+_PY_TOKEN_RE = re.compile(
+    r'(?P<comment>#[^\n]*)'
+    r'|(?P<string>[rRbBuUfF]{0,2}(?:\'\'\'(?:\\[\s\S]|[^\\])*?(?:\'\'\'|\Z)|"""(?:\\[\s\S]|[^\\])*?(?:"""|\Z)'
+    r'|\'(?:\\.|[^\\\'\n])*\'?|"(?:\\.|[^\\"\n])*"?))'
+    r'|(?P<name>[A-Za-z_]\w*)'
+    rf'|(?P<number>{_NUMBER_PATTERN})'
+    rf'|(?P<op>{_operator_pattern(PY_OPERATORS)})'
+    r'|(?P<punct>[{}()\[\];,.@])'
+)
+
+_JS_REGEX_LITERAL_RE = re.compile(r'/(?![*/])(?:\\.|\[(?:\\.|[^\]\\\n])*\]|[^/\\\n\[])+/[a-z]*')
+# A '/' after one of these (or at the start) begins a regex literal, not a division
+_JS_REGEX_PRECEDERS = {'op', 'keyword', None}
+_JS_REGEX_PUNCT = set('([{,;:!&|?}')
+
+# Skips NamedTuple's Python-level __new__; lex() builds tens of thousands of these
+_new_token = tuple.__new__
+
+def lex(code: str, language: str) -> List[Token]:
+    if language == 'python':
+        pattern, keywords = _PY_TOKEN_RE, PY_KEYWORDS
+    else:
+        pattern, keywords = _JS_TOKEN_RE, JS_KEYWORDS
+    python = language == 'python'
+    tokens = []
+    append = tokens.append
+    newlines = [m.start() for m in re.finditer('\n', code)]
+    newlines.append(len(code))
+    line, line_start, next_newline = 1, 0, newlines[0]
+    prev_kind, prev_text = None, ''
+    search = pattern.search
+    m = search(code)
+    while m:
+        start, end = m.span()
+        while next_newline < start:
+            line_start = next_newline + 1
+            next_newline = newlines[line]
+            line += 1
+        kind = m.lastgroup
+        if kind == 'name':
+            if m.group() in keywords:
+                kind = 'keyword'
+        elif (kind == 'op' and not python and code[start] == '/'
+                and (prev_kind in _JS_REGEX_PRECEDERS or (prev_kind == 'punct' and prev_text in _JS_REGEX_PUNCT))):
+            rm = _JS_REGEX_LITERAL_RE.match(code, start)
+            if rm:
+                kind, end = 'string', rm.end()
+        text = code[start:end]
+        append(_new_token(Token, (kind, text, start, line, start - line_start)))
+        if kind != 'comment':
+            prev_kind, prev_text = kind, text
+        m = search(code, end)
+    return tokens
+
+def scan_tokens(tokens: List[Token], language: str, lo: int = 0, hi: Optional[int] = None) -> dict:
+    """Single pass over tokens[lo:hi] collecting CC, Halstead counts, nesting and returns."""
+    decisions = PY_DECISIONS if language == 'python' else JS_DECISIONS
+    python = language == 'python'
+    cc = 1
+    operators = {}
+    operands = {}
+    returns = 0
+    depth = max_depth = 0
+    base_indent = -1
+    last_line = 0
+    for tok in tokens[lo:hi]:
+        kind, text = tok.kind, tok.text
+        if kind == 'comment':
+            continue
+        if kind == 'keyword' or kind == 'op':
+            operators[text] = operators.get(text, 0) + 1
+            if text in decisions:
+                cc += 1
+            elif text == 'return':
+                returns += 1
+        elif kind == 'name' or kind == 'number':
+            operands[text] = operands.get(text, 0) + 1
+        if python:
+            # Depth follows the indentation of each logical line
+            if tok.line != last_line and depth == 0:
+                if base_indent == -1:
+                    base_indent = tok.col
+                max_depth = max(max_depth, (tok.col - base_indent) // 4)
+            last_line = tok.line
+            if kind == 'punct':
+                if text in '([{': depth += 1
+                elif text in ')]}': depth = max(0, depth - 1)
+        elif kind == 'punct':
+            if text == '{':
+                depth += 1
+                if depth > max_depth: max_depth = depth
+            elif text == '}':
+                depth -= 1
+    return {
+        'cyclomaticComplexity': cc, 'operators': operators, 'operands': operands,
+        'maxNestingDepth': max_depth, 'returnCount': returns
+    }
+
+# ─── Span Memo ───
+# Source is split into top-level segments (a top-level function with everything
+# nested in it, or the code between functions). Each segment's facts, including
+# the facts of every function in its containment tree, are memoized per process
+# by a hash of the segment's text. Re-analyzing an edited file re-lexes only the
+# segments whose text changed; file-level metrics are rebuilt by merging them.
+
+SPAN_MEMO_SIZE = int(os.environ.get('SPAN_MEMO_SIZE', '20000'))
+_span_memo = OrderedDict()
+span_memo_stats = {'hits': 0, 'misses': 0}
+
+def _memo_get(key):
+    facts = _span_memo.get(key)
+    if facts is None:
+        span_memo_stats['misses'] += 1
+        return None
+    span_memo_stats['hits'] += 1
+    _span_memo.move_to_end(key)
+    return facts
+
+def _with_memo_counts(fn, *args):
+    """fn(*args) in a pool worker, with the span memo hits and misses it caused, for the API process to add up."""
+    hits, misses = span_memo_stats['hits'], span_memo_stats['misses']
+    value = fn(*args)
+    return value, span_memo_stats['hits'] - hits, span_memo_stats['misses'] - misses
+
+def span_memo_snapshot() -> dict:
+    hits, misses = span_memo_stats['hits'], span_memo_stats['misses']
+    lookups = hits + misses
+    return {'hits': hits, 'misses': misses, 'hitRate': round(hits / lookups, 4) if lookups else 0}
+
+def _memo_put(key, facts: dict):
+    _span_memo[key] = facts
+    if len(_span_memo) > SPAN_MEMO_SIZE:
+        _span_memo.popitem(last=False)
+
+def span_key(language: str, text: str) -> tuple:
+    return language, hashlib.blake2b(text.encode('utf-8', 'surrogatepass'), digest_size=16).digest()
+
+def line_offsets(code: str) -> List[int]:
+    """offsets[i] is where line i+1 starts; a final entry marks the end of the source."""
+    offsets = [0]
+    offsets.extend(m.end() for m in re.finditer('\n', code))
+    offsets.append(len(code))
+    return offsets
+
+def span_text(code: str, offsets: List[int], start_line: int, end_line: int) -> str:
+    return code[offsets[start_line - 1]:offsets[min(end_line, len(offsets) - 1)]]
+
+def top_level_segments(functions: list, loc: int) -> list:
+    """Cover lines 1..loc with [start, end, member function indexes] segments.
+
+    Each top-level function is its own segment (with its nested functions as
+    members); the lines between top-level functions form member-less segments.
+    """
+    order = sorted(range(len(functions)), key=lambda i: (functions[i].start_line, -functions[i].end_line))
+    segments = []
+    cursor = 1
+    for i in order:
+        start, end = functions[i].start_line, functions[i].end_line
+        if start < cursor:
+            # Nested in (or overlapping the end of) the previous function
+            last = segments[-1]
+            last[2].append(i)
+            if end > last[1]:
+                last[1] = end
+                cursor = end + 1
+            continue
+        if start > cursor:
+            segments.append([cursor, start - 1, []])
+        segments.append([start, end, [i]])
+        cursor = end + 1
+    if cursor <= loc:
+        segments.append([cursor, loc, []])
+    return segments
+
+def _facts_from_tokens(tokens: List[Token], language: str, lo: int = 0, hi: Optional[int] = None) -> dict:
+    facts = scan_tokens(tokens, language, lo, hi)
+    facts['halstead'] = halstead_from_counts(facts['operators'], facts['operands'])
+    return facts
+
+def _merge_counts(into: dict, counts: dict):
+    for key, n in counts.items():
+        into[key] = into.get(key, 0) + n
+
+def segment_tree_facts(tokens: List[Token], language: str, shape: tuple, origin: int = 0) -> Tuple[dict, list]:
+    """Facts for one segment and for each function in it, from a single pass over its tokens.
+
+    shape holds the (start, end) offsets of the segment's functions relative to
+    the segment, sorted by (start, -end); origin is the segment's offset in the
+    source the tokens' start offsets refer to. Every token is counted once, into the
+    innermost function containing it (or the segment itself); inclusive facts
+    are then built bottom-up by merging each function's counters into its parent.
+    """
+    decisions = PY_DECISIONS if language == 'python' else JS_DECISIONS
+    python = language == 'python'
+    n = len(shape)
+    # Index n collects the segment's code outside every function
+    decision_counts = [0] * (n + 1)
+    operators = [{} for _ in range(n + 1)]
+    operands = [{} for _ in range(n + 1)]
+    returns = [0] * (n + 1)
+    base = [0] * (n + 1)    # brace depth (JS) or indentation column (Python) where the function starts
+    peak = [0] * (n + 1)
+    parent = [None] * n
+    # Normalized token stream for clone fingerprints, and each function's [first, last) range in it
+    norm = array('Q')  # held for every missed segment until the fingerprint pass, so 8 bytes per token
+    norm_append = norm.append
+    kind_ids, token_ids = _CLONE_KIND_IDS, _clone_token_ids
+    first = [0] * n
+    last = [0] * n
+    stack = []
+    ends = [end for _, end in shape]
+    upcoming = 0
+    depth = 0
+    last_line = 0
+    for tok in tokens:
+        pos = tok.start - origin
+        while upcoming < n and shape[upcoming][0] <= pos:
+            while stack and ends[stack[-1]] <= shape[upcoming][0]:
+                last[stack.pop()] = len(norm)
+            parent[upcoming] = stack[-1] if stack else None
+            stack.append(upcoming)
+            first[upcoming] = len(norm)
+            base[upcoming] = peak[upcoming] = tok.col if python else depth
+            upcoming += 1
+        while stack and ends[stack[-1]] <= pos:
+            last[stack.pop()] = len(norm)
+        kind, text = tok.kind, tok.text
+        if kind == 'comment':
+            continue
+        norm_append(kind_ids.get(kind) or token_ids.get(text) or clone_token_id(text))
+        owner = stack[-1] if stack else n
+        if kind == 'keyword' or kind == 'op':
+            ops = operators[owner]
+            ops[text] = ops.get(text, 0) + 1
+            if text in decisions:
+                decision_counts[owner] += 1
+            elif text == 'return':
+                returns[owner] += 1
+        elif kind == 'name' or kind == 'number':
+            opnds = operands[owner]
+            opnds[text] = opnds.get(text, 0) + 1
+        if python:
+            # Depth follows the indentation of each logical line
+            if tok.line != last_line and depth == 0 and tok.col > peak[owner]:
+                peak[owner] = tok.col
+            last_line = tok.line
+            if kind == 'punct':
+                if text in '([{': depth += 1
+                elif text in ')]}': depth = max(0, depth - 1)
+        elif kind == 'punct':
+            if text == '{':
+                depth += 1
+                if depth > peak[owner]: peak[owner] = depth
+            elif text == '}':
+                depth -= 1
+    for k in stack:
+        last[k] = len(norm)
+    for k in range(upcoming, n):
+        first[k] = last[k] = len(norm)
+
+    exclusive = [
+        {'cyclomaticComplexity': 1 + decision_counts[k], 'halstead': halstead_from_counts(operators[k], operands[k])}
+        for k in range(n)
+    ]
+    node_facts = [None] * n
+    # Children sort after their parent, so walking backwards completes each subtree before its parent
+    for k in range(n - 1, -1, -1):
+        nesting = peak[k] - base[k]
+        node_facts[k] = {
+            'cyclomaticComplexity': 1 + decision_counts[k],
+            'halstead': halstead_from_counts(operators[k], operands[k]),
+            'maxNestingDepth': nesting // 4 if python else nesting,
+            'returnCount': returns[k], 'parent': parent[k], 'exclusive': exclusive[k],
+            'tokenSpan': (first[k], last[k])
+        }
+        into = n if parent[k] is None else parent[k]
+        decision_counts[into] += decision_counts[k]
+        returns[into] += returns[k]
+        _merge_counts(operators[into], operators[k])
+        _merge_counts(operands[into], operands[k])
+        if into < n and peak[k] > peak[into]:
+            peak[into] = peak[k]
+    segment_facts = {
+        'cyclomaticComplexity': 1 + decision_counts[n], 'operators': operators[n], 'operands': operands[n],
+        'norm': norm
+    }
+    return segment_facts, node_facts
+
+def collect_span_facts(code: str, language: str, functions: list, offsets: List[int],
+                       tokens: Optional[List[Token]] = None) -> Tuple[dict, list]:
+    """Return (file facts, per-function facts) built from memoized segment facts.
+
+    Per-function facts are inclusive of nested functions and also carry
+    'parent' (index into functions, or None) and 'exclusive' facts covering
+    only the function's own code: cyclomaticComplexity, halstead and loc.
+    tokens, when given, is the whole file's token stream (the Python engine's);
+    otherwise segments that miss the memo are lexed on their own.
+    """
+    loc = len(offsets) - 1
+    token_starts = None
+    file_operators = {}
+    file_operands = {}
+    file_cc = 1
+    fn_facts = [None] * len(functions)
+    segments = []  # (members, node facts) per top-level segment
+    missed = []    # (memo key, facts) of segments computed here; fingerprinted in one pass below
+    for seg_start, seg_end, members in top_level_segments(functions, loc):
+        seg_offset = offsets[seg_start - 1]
+        members.sort(key=lambda i: (functions[i].start, -functions[i].end))
+        shape = tuple((functions[i].start - seg_offset, functions[i].end - seg_offset) for i in members)
+        text = span_text(code, offsets, seg_start, seg_end)
+        key = span_key(language, text) + (shape, tokens is not None)
+        facts = _memo_get(key)
+        if facts is None:
+            if tokens is None:
+                facts = segment_tree_facts(lex(text, language), language, shape)
+            else:
+                if token_starts is None:
+                    token_starts = [t.start for t in tokens]
+                lo = bisect_left(token_starts, seg_offset)
+                hi = bisect_left(token_starts, seg_offset + len(text), lo)
+                facts = segment_tree_facts(tokens[lo:hi], language, shape, seg_offset)
+            missed.append((key, facts))
+        segment_facts, node_facts = facts
+        file_cc += segment_facts['cyclomaticComplexity'] - 1
+        _merge_counts(file_operators, segment_facts['operators'])
+        _merge_counts(file_operands, segment_facts['operands'])
+        segments.append((members, node_facts))
+
+    if missed:
+        batch = []
+        for _, (segment_facts, node_facts) in missed:
+            norm = segment_facts.pop('norm')
+            batch.append((norm if node_facts else [], [node.pop('tokenSpan') for node in node_facts]))
+        fingerprints = segment_fingerprints(batch)
+        for (key, facts), segment_fps in zip(missed, fingerprints):
+            for node, fps in zip(facts[1], segment_fps):
+                node['fingerprints'] = fps
+            _memo_put(key, facts)
+    for members, node_facts in segments:
+        for i, node in zip(members, node_facts):
+            parent = node['parent']
+            fn_facts[i] = {**node, 'parent': None if parent is None else members[parent]}
+
+    # Exclusive LOC: the lines of a function not inside any of its children
+    children = [[] for _ in functions]
+    for i, facts in enumerate(fn_facts):
+        if facts['parent'] is not None:
+            children[facts['parent']].append(i)
+    for i, facts in enumerate(fn_facts):
+        covered = 0
+        last = functions[i].start_line - 1
+        for c in sorted(children[i], key=lambda c: functions[c].start_line):
+            start, end = max(functions[c].start_line, last + 1), functions[c].end_line
+            if end >= start:
+                covered += end - start + 1
+                last = end
+        # In the order of FunctionMetric.exclusive, which uses this dict as is
+        facts['exclusive'] = {'loc': functions[i].loc - covered, **facts['exclusive']}
+
+    file_facts = {
+        'cyclomaticComplexity': file_cc, 'operators': file_operators, 'operands': file_operands,
+        'halstead': halstead_from_counts(file_operators, file_operands)
+    }
+    return file_facts, fn_facts
+
 def detect_language(filename: str) -> str:
     if not filename:
         return 'unknown'
@@ -182,35 +694,9 @@ def is_comment(line: str, language: str) -> bool:
     return trimmed.startswith('//') or trimmed.startswith('/*') or trimmed.startswith('*')
 
 def compute_cyclomatic_complexity(code: str, language: str) -> int:
-    complexity = 1
-    clean = remove_comments_and_strings(code, language)
-    if language in ('javascript', 'typescript'):
-        patterns = [
-            r'\bif\b', r'\belse\s+if\b', r'\bfor\b', r'\bwhile\b',
-            r'\bcase\b', r'\bcatch\b', r'\?\s*[^:]', r'&&', r'\|\|', r'\?\?'
-        ]
-    else:
-        patterns = [
-            r'\bif\b', r'\belif\b', r'\bfor\b', r'\bwhile\b',
-            r'\bexcept\b', r'\band\b', r'\bor\b'
-        ]
-    for p in patterns:
-        complexity += len(re.findall(p, clean))
-    return complexity
-
-def compute_halstead(code: str, language: str) -> dict:
-    clean = remove_comments_and_strings(code, language)
-    keywords = PY_KEYWORDS if language == 'python' else JS_KEYWORDS
-    ops = PY_OPERATORS if language == 'python' else JS_OPERATORS
-    operators = {}
-    operands = {}
-    for match in re.finditer(r'[a-zA-Z_$]\w*|[+\-*/%=!<>&|^~?:]+|\d+\.?\d*', clean):
-        token = match.group()
-        if token in ops or token in keywords:
-            operators[token] = operators.get(token, 0) + 1
-        elif re.match(r'^[a-zA-Z_$]', token) or re.match(r'^\d', token):
-            operands[token] = operands.get(token, 0) + 1
+    return scan_tokens(lex(code, language), language)['cyclomaticComplexity']
 
+def halstead_from_counts(operators: dict, operands: dict) -> dict:
     n1 = len(operators)
     n2 = len(operands)
     N1 = sum(operators.values())
@@ -232,6 +718,10 @@ def compute_halstead(code: str, language: str) -> dict:
         'bugs': round(bugs, 3)
     }
 
+def compute_halstead(code: str, language: str) -> dict:
+    facts = scan_tokens(lex(code, language), language)
+    return halstead_from_counts(facts['operators'], facts['operands'])
+
 def compute_maintainability_index(halstead_volume: float, cc: int, loc: int) -> float:
     if loc <= 0 or halstead_volume <= 0:
         return 100
@@ -239,280 +729,3810 @@ def compute_maintainability_index(halstead_volume: float, cc: int, loc: int) ->
     mi = max(0, min(100, mi * 100 / 171))
     return round(mi, 2)
 
-def compute_max_nesting(code: str, language: str) -> int:
-    lines = code.split('\n')
-    max_depth = 0
-    if language in ('javascript', 'typescript'):
-        depth = 0
-        for line in lines:
-            for ch in line:
-                if ch == '{': depth += 1
-                if ch == '}': depth -= 1
-                max_depth = max(max_depth, depth)
-    else:
-        base_indent = -1
-        for line in lines:
-            if not line.strip(): continue
-            indent = len(line) - len(line.lstrip())
-            if base_indent == -1: base_indent = indent
-            rel = (indent - base_indent) // 4
-            max_depth = max(max_depth, rel)
-    return max_depth
-
-def extract_js_functions(code: str, lines: list) -> list:
+# ─── Clone Detection ───
+# Duplicate logic is found by winnowing: each function's token stream is
+# normalized (every identifier, number and string becomes one placeholder, so
+# renamed copies still match), hashed as overlapping k-grams, and the minimum
+# hash of every window of w k-grams is kept as a fingerprint. Two functions that
+# share a run of at least k + w - 1 normalized tokens are guaranteed to share a
+# fingerprint, so candidates come from an inverted index (fingerprint ->
+# functions) instead of comparing every pair of functions.
+
+CLONE_K = int(os.environ.get('CLONE_K', '12'))
+CLONE_WINDOW = int(os.environ.get('CLONE_WINDOW', '8'))
+# Functions with fewer normalized tokens get no fingerprints: short helpers are alike by nature
+CLONE_MIN_TOKENS = int(os.environ.get('CLONE_MIN_TOKENS', '40'))
+# Functions kept per fingerprint; beyond this, later holders of a common fingerprint are only matched via others
+CLONE_MAX_POSTINGS = int(os.environ.get('CLONE_MAX_POSTINGS', '32'))
+# Best matches below this similarity are not recorded, whatever the duplicate-logic threshold
+CLONE_MIN_SIMILARITY = 0.5
+
+_CLONE_KIND_IDS = {'name': 1, 'number': 2, 'string': 3}
+_clone_token_ids = {}
+_CLONE_BASE = np.uint64(1099511628211)
+_CLONE_MIX = np.uint64(0xff51afd7ed558ccd)
+_CLONE_NONE = np.uint64(2 ** 64 - 1)
+
+def clone_token_id(text: str) -> int:
+    """Id of a keyword, operator or punctuation token; crc32 keeps ids, and stored fingerprints, stable across processes."""
+    tid = _clone_token_ids.get(text)
+    if tid is None:
+        tid = _clone_token_ids[text] = zlib.crc32(text.encode()) + len(_CLONE_KIND_IDS) + 1
+    return tid
+
+def segment_fingerprints(segments: list) -> list:
+    """Per segment, each function's sorted fingerprints, from [(normalized tokens, [(first, last) per function])].
+
+    All segments are hashed in one vectorized pass. w - 1 filler positions
+    around each segment keep every k-gram and every window that selects a
+    fingerprint inside one segment, so a segment's fingerprints do not depend
+    on the segments it is batched with (they are memoized with its facts).
+    """
+    k, w = CLONE_K, CLONE_WINDOW
+    pad = [0] * (w - 1)
+    flat = array('Q', pad)
+    labels, sizes, bases = [-1], [w - 1], []
+    for i, (norm, _) in enumerate(segments):
+        bases.append(len(flat))
+        flat.extend(norm)
+        flat.extend(pad)
+        labels += (i, -1)
+        sizes += (len(norm), w - 1)
+    n = len(flat) - k + 1
+    if n < w:
+        return [[[] for _ in spans] for _, spans in segments]
+
+    tokens = np.frombuffer(flat, dtype=np.uint64)
+    owner = np.repeat(np.array(labels), np.array(sizes))
+    # A k-gram is real when it starts and ends inside the same segment
+    valid = (owner[:n] >= 0) & (owner[:n] == owner[k - 1:k - 1 + n])
+    hashes = tokens[:n].copy()
+    for j in range(1, k):
+        hashes *= _CLONE_BASE
+        hashes += tokens[j:j + n]
+    hashes ^= hashes >> np.uint64(33)
+    hashes *= _CLONE_MIX
+    hashes ^= hashes >> np.uint64(33)
+    hashes[~valid] = _CLONE_NONE
+    # The rightmost minimum of each window, so a run of equal hashes yields one fingerprint
+    windows = sliding_window_view(hashes, w)
+    picked = np.arange(len(windows)) + (w - 1) - windows[:, ::-1].argmin(axis=1)
+    picked = np.unique(picked)
+    picked = picked[valid[picked]]
+    # 63 bits, so fingerprints are exact in Mongo's int64
+    values = (hashes[picked] >> np.uint64(1)).astype(np.int64).tolist()
+    picked = picked.tolist()
+
+    out = []
+    for base, (_, spans) in zip(bases, segments):
+        fps = []
+        for first, last in spans:
+            if last - first < CLONE_MIN_TOKENS:
+                fps.append([])
+                continue
+            lo = bisect_left(picked, base + first)
+            hi = bisect_right(picked, base + last - k, lo)
+            fps.append(sorted(set(values[lo:hi])))
+        out.append(fps)
+    return out
+
+def similarity(shared: int, a: int, b: int) -> float:
+    """Dice coefficient of two fingerprint sets of sizes a and b sharing shared fingerprints."""
+    return 2 * shared / (a + b) if a + b else 0.0
+
+class CloneIndex:
+    """Inverted index from fingerprint to the functions holding it; refs identify the functions to the caller."""
+
+    def __init__(self, max_fingerprints: Optional[int] = None):
+        self.postings = {}
+        self.refs = []
+        self.sizes = []
+        self.fingerprints = 0
+        self.max_fingerprints = max_fingerprints
+        self.truncated = False
+
+    def __len__(self) -> int:
+        return len(self.refs)
+
+    def add(self, fps: list, ref) -> bool:
+        """Index a function; False once the index holds max_fingerprints."""
+        if self.max_fingerprints is not None and self.fingerprints + len(fps) > self.max_fingerprints:
+            self.truncated = True
+            return False
+        key = len(self.refs)
+        self.refs.append(ref)
+        self.sizes.append(len(fps))
+        self.fingerprints += len(fps)
+        postings = self.postings
+        for fp in fps:
+            posting = postings.get(fp)
+            if posting is None:
+                postings[fp] = [key]
+            elif len(posting) < CLONE_MAX_POSTINGS:
+                posting.append(key)
+        return True
+
+    def _shared(self, fps: list) -> TokenTally:
+        postings = self.postings
+        return TokenTally(chain.from_iterable(postings.get(fp, ()) for fp in fps))
+
+    def matches(self, fps: list, min_similarity: float = CLONE_MIN_SIMILARITY) -> list:
+        """(similarity, ref) of indexed functions at least min_similarity alike, the most similar first."""
+        size, sizes = len(fps), self.sizes
+        found = []
+        for key, count in self._shared(fps).items():
+            score = similarity(count, size, sizes[key])
+            if score >= min_similarity:
+                found.append((score, key))
+        found.sort(key=lambda m: (-m[0], m[1]))
+        return [(round(score, 4), self.refs[key]) for score, key in found]
+
+    def best(self, fps: list, exclude=()) -> Optional[tuple]:
+        """(similarity, ref) of the most similar indexed function whose ref is not in exclude, or None.
+
+        Ties go to the function indexed first; below CLONE_MIN_SIMILARITY nothing matches.
+        """
+        size, sizes, refs = len(fps), self.sizes, self.refs
+        top, found = CLONE_MIN_SIMILARITY, None
+        for key, count in self._shared(fps).items():
+            score = 2 * count / (size + sizes[key])
+            if (score > top or score == top and (found is None or key < found)) and refs[key] not in exclude:
+                top, found = score, key
+        return None if found is None else (round(top, 4), refs[found])
+
+def duplicate_functions(functions: list, fn_facts: list) -> list:
+    """Per function, its most similar earlier function in the same file as (similarity, index), or None.
+
+    A function is never matched with a function nested in it or enclosing it.
+    """
+    index = CloneIndex()
+    best = [None] * len(functions)
+    for i in sorted(range(len(functions)), key=lambda i: functions[i].start):
+        fps = fn_facts[i].get('fingerprints')
+        if not fps:
+            continue
+        ancestors = set()
+        parent = fn_facts[i]['parent']
+        while parent is not None:
+            ancestors.add(parent)
+            parent = fn_facts[parent]['parent']
+        best[i] = index.best(fps, ancestors)
+        index.add(fps, i)
+    return best
+
+# ─── Function Extraction ───
+# One left-to-right regex scan per file. Functions are returned as offset
+# spans into the original source (start/end) plus line numbers looked up in a
+# precomputed line-offset index, so no body text is copied. Each span is a
+# FunctionSpan tuple rather than a dict, since generated files can hold tens
+# of thousands of functions; per-function metrics refer to spans by index.
+
+# Control-flow keywords that the method pattern would otherwise take for names
+JS_NON_FUNCTION_NAMES = {'if', 'for', 'while', 'switch', 'catch', 'with', 'function', 'return', 'typeof', 'await'}
+
+_JS_SCAN_RE = re.compile(
+    r'(?P<comment>//[^\n]*|/\*[\s\S]*?(?:\*/|\Z))'
+    r'|(?P<string>`(?:\\[\s\S]|[^\\`])*`?|\'(?:\\.|[^\\\'\n])*\'?|"(?:\\.|[^\\"\n])*"?)'
+    # A '/' after one of these characters starts a regex literal; the character itself may be a brace
+    r'|(?P<regex>[(,=:\[!&|?{};]\s*/(?![*/])(?:\\.|\[(?:\\.|[^\]\\\n])*\]|[^/\\\n\[])+/[a-z]*)'
+    r'|(?P<decl>(?<![\w$])(?:async\s+)?function\s*\*?\s*(?P<decl_name>[\w$]+)\s*\((?P<decl_params>[^)]*)\))'
+    # Only a function expression or an arrow counts, not `const x = (a + b) * 2`
+    r'|(?P<assign>(?:const|let|var)\s+(?P<assign_name>[\w$]+)\s*=\s*(?:async\s+)?(?:function\s*\*?\s*[\w$]*\s*)?'
+    r'\((?P<assign_params>[^)]*)\)(?=\s*(?::[^=;{]*?)?\s*(?:=>|\{)))'
+    # Method parameters never contain braces or statements, so `items.map(x => { if (y) {` is not a method
+    r'|(?P<method>(?<![\w$])(?P<method_name>[A-Za-z_$][\w$]*)\s*\((?P<method_params>[^(){};]*)\)\s*(?=\{))'
+    r'|(?P<brace>[{}])'
+)
+# Between a header and its body: optional TypeScript return type, then '{'
+_JS_BODY_RE = re.compile(r'\s*(?::\s*[^{;=]*?)?(?:=>\s*)?\{')
+
+def _js_params(params_str: str) -> list:
+    return [p.strip() for p in params_str.split(',') if p.strip()] if params_str else []
+
+def _py_params(params_str: str) -> list:
+    params = [p.strip().split(':')[0].split('=')[0].strip() for p in params_str.split(',') if p.strip()] if params_str else []
+    return [p for p in params if p not in ('self', 'cls')]
+
+def _line_of(offsets: List[int], pos: int) -> int:
+    return bisect_right(offsets, pos, 0, len(offsets) - 1)
+
+class FunctionSpan(NamedTuple):
+    name: str
+    params: list
+    start: int       # offset into the source
+    end: int         # offset just past the function
+    start_line: int  # 1-based
+    end_line: int
+    loc: int
+
+def _function_span(name: str, params: list, start: int, end: int, offsets: List[int]) -> FunctionSpan:
+    start_line = _line_of(offsets, start)
+    end_line = _line_of(offsets, max(start, end - 1))
+    return FunctionSpan(name, params, start, end, start_line, end_line, end_line - start_line + 1)
+
+def extract_js_functions(code: str, offsets: List[int]) -> list:
     functions = []
-    found = set()
-    patterns = [
-        r'(?:async\s+)?function\s+(\w+)\s*\(([^)]*)\)',
-        r'(?:const|let|var)\s+(\w+)\s*=\s*(?:async\s+)?(?:function\s*)?\(([^)]*)\)\s*(?:=>)?',
-        r'(\w+)\s*\(([^)]*)\)\s*\{',
-    ]
-    for pat in patterns:
-        for m in re.finditer(pat, code):
-            name = m.group(1)
-            params_str = m.group(2) if m.lastindex >= 2 else ''
-            params = [p.strip() for p in params_str.split(',') if p.strip()] if params_str else []
-            start_line = code[:m.start()].count('\n') + 1
-            key = f"{name}:{start_line}"
-            if key in found: continue
-            found.add(key)
-            end_line = find_js_function_end(lines, start_line - 1)
-            body = '\n'.join(lines[start_line - 1:end_line])
-            functions.append({
-                'name': name, 'params': params,
-                'startLine': start_line, 'endLine': end_line,
-                'body': body, 'loc': end_line - start_line + 1
-            })
-    return functions
+    stack = []          # one entry per open '{': index into functions, or None
+    body_braces = {}    # offset of a function's opening '{' -> index into functions
+    loc = len(offsets) - 1
+    for m in _JS_SCAN_RE.finditer(code):
+        kind = m.lastgroup
+        if kind == 'brace' or kind == 'regex':
+            ch = code[m.start()]
+            if ch == '{':
+                stack.append(body_braces.pop(m.start(), None))
+            elif ch == '}' and stack:
+                fn = stack.pop()
+                if fn is not None:
+                    functions[fn]['end'] = m.end()
+            continue
+        if kind == 'comment' or kind == 'string':
+            continue
+        name = m.group(kind + '_name')
+        if kind == 'method' and name in JS_NON_FUNCTION_NAMES:
+            continue
+        functions.append({'name': name, 'params': _js_params(m.group(kind + '_params')), 'start': m.start(), 'end': None})
+        body = _JS_BODY_RE.match(code, m.end())
+        if body:
+            body_braces[body.end() - 1] = len(functions) - 1
+        else:
+            # Expression-bodied arrow function: ends with its line
+            functions[-1]['end'] = offsets[_line_of(offsets, m.end() - 1)]
+
+    spans = []
+    for fn in functions:
+        end = fn['end']
+        if end is None:
+            # Unbalanced braces: cap the function at 50 lines
+            end = offsets[min(_line_of(offsets, fn['start']) + 49, loc)]
+        spans.append(_function_span(fn['name'], fn['params'], fn['start'], end, offsets))
+    return spans
+
+_PY_SCAN_RE = re.compile(
+    # Line starts come first so a line opening with a string or bracket still counts
+    r'^(?P<indent>[ \t]*)(?=[^\s#])(?:(?:async\s+)?def\s+(?P<name>\w+)\s*\((?P<params>[^)]*)\))?'
+    r'|(?P<comment>#[^\n]*)'
+    r'|(?P<string>[rRbBuUfF]{0,2}(?:\'\'\'(?:\\[\s\S]|[^\\])*?(?:\'\'\'|\Z)|"""(?:\\[\s\S]|[^\\])*?(?:"""|\Z)'
+    r'|\'(?:\\.|[^\\\'\n])*\'?|"(?:\\.|[^\\"\n])*"?))'
+    r'|(?P<open>[(\[{])|(?P<close>[)\]}])',
+    re.MULTILINE
+)
 
-def find_js_function_end(lines: list, start_idx: int) -> int:
-    brace_count = 0
-    started = False
-    for i in range(start_idx, len(lines)):
-        for ch in lines[i]:
-            if ch == '{': brace_count += 1; started = True
-            if ch == '}': brace_count -= 1
-            if started and brace_count == 0: return i + 1
-    return min(start_idx + 50, len(lines))
-
-def extract_py_functions(code: str, lines: list) -> list:
+def extract_py_functions(code: str, offsets: List[int]) -> list:
     functions = []
-    for m in re.finditer(r'^(\s*)(?:async\s+)?def\s+(\w+)\s*\(([^)]*)\)', code, re.MULTILINE):
-        indent = len(m.group(1))
-        name = m.group(2)
-        params_str = m.group(3)
-        params = [p.strip().split(':')[0].split('=')[0].strip() for p in params_str.split(',') if p.strip()] if params_str else []
-        params = [p for p in params if p not in ('self', 'cls')]
-        start_line = code[:m.start()].count('\n') + 1
-        end_line = find_py_function_end(lines, start_line - 1, indent)
-        body = '\n'.join(lines[start_line - 1:end_line])
-        functions.append({
-            'name': name, 'params': params,
-            'startLine': start_line, 'endLine': end_line,
-            'body': body, 'loc': end_line - start_line + 1
-        })
+    open_defs = []  # (indent, index into functions), innermost last
+    depth = 0       # bracket depth; lines starting inside brackets are continuations
+    for m in _PY_SCAN_RE.finditer(code):
+        kind = m.lastgroup
+        if kind == 'open':
+            depth += 1
+        elif kind == 'close':
+            depth = max(0, depth - 1)
+        elif kind == 'indent' or kind == 'name' or kind == 'params':
+            if depth:
+                continue
+            indent = len(m.group('indent'))
+            # A code line at or left of a def's indentation closes it; the def ends just before this line
+            while open_defs and open_defs[-1][0] >= indent:
+                functions[open_defs.pop()[1]]['end'] = m.start()
+            if m.group('name') is not None:
+                functions.append({'name': m.group('name'), 'params': _py_params(m.group('params')),
+                                  'start': m.start() + indent, 'end': len(code)})
+                open_defs.append((indent, len(functions) - 1))
+    return [_function_span(fn['name'], fn['params'], fn['start'], fn['end'], offsets) for fn in functions]
+
+# ─── Python Engine ───
+# With PYTHON_ENGINE=ast, Python that parses is analyzed with the stdlib: ast
+# gives exact function starts and parameters, tokenize gives the token stream
+# with strings, f-strings and comments exactly as the compiler sees them.
+# Functions end where the indentation scanner ends them, so both engines
+# count the same lines. Sources that do not parse fall back to the regex lexer
+# and indentation scanner above. The regex path stays the default: on CPython
+# 3.11, where tokenize is pure Python, it is several times faster on large
+# modules (see benchmarks/python_engine.py). PYTHON_ENGINE is read with
+# ANALYZER_VERSION.
+
+_PY_TOKEN_KINDS = {
+    tokenize.NUMBER: 'number', tokenize.STRING: 'string', tokenize.COMMENT: 'comment',
+    # Python 3.12+ splits f-strings; their literal parts are strings, their fields real code
+    **{getattr(tokenize, t): 'string' for t in ('FSTRING_START', 'FSTRING_MIDDLE', 'FSTRING_END') if hasattr(tokenize, t)}
+}
+_PY_PUNCT = {'(', ')', '[', ']', '{', '}', ';', ',', '.', '@', '...'}
+# Statement lists that may hold a def; expressions never do
+_PY_BODY_FIELDS = ('body', 'orelse', 'finalbody', 'handlers', 'cases')
+
+def tokenize_python(code: str, offsets: List[int]) -> List[Token]:
+    tokens = []
+    append = tokens.append
+    for tok_type, text, (row, col), _, _ in tokenize.generate_tokens(io.StringIO(code).readline):
+        if tok_type == tokenize.NAME:
+            kind = 'keyword' if text in PY_KEYWORDS else 'name'
+        elif tok_type == tokenize.OP:
+            kind = 'punct' if text in _PY_PUNCT else 'op'
+        else:
+            kind = _PY_TOKEN_KINDS.get(tok_type)
+            if kind is None:
+                continue
+        append(_new_token(Token, (kind, text, offsets[row - 1] + col, row, col)))
+    return tokens
+
+def _ast_params(args: ast.arguments) -> list:
+    params = [a.arg for a in args.posonlyargs + args.args]
+    if args.vararg:
+        params.append('*' + args.vararg.arg)
+    params.extend(a.arg for a in args.kwonlyargs)
+    if args.kwarg:
+        params.append('**' + args.kwarg.arg)
+    return [p for p in params if p not in ('self', 'cls')]
+
+def _py_code_lines(tokens: List[Token]) -> Iterator[Token]:
+    """Yield the first token of each line outside brackets: the lines the indentation scanner sees as code."""
+    depth = 0
+    last_line = 0
+    for tok in tokens:
+        if tok.kind == 'comment':
+            continue
+        if tok.line > last_line and not depth:
+            yield tok
+        last_line = tok.line + tok.text.count('\n')
+        if tok.kind == 'punct':
+            if tok.text in '([{':
+                depth += 1
+            elif tok.text in ')]}':
+                depth = max(0, depth - 1)
+
+def extract_py_functions_ast(tree: ast.Module, offsets: List[int], tokens: List[Token]) -> list:
+    defs = {}
+    pending = [tree]
+    while pending:
+        node = pending.pop()
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+            defs[node.lineno] = node
+        for field in _PY_BODY_FIELDS:
+            pending.extend(getattr(node, field, ()))
+
+    # Like the indentation scanner, a def ends just before the next code line
+    # at or left of its indentation, so trailing blank and comment lines stay in it
+    ends = {}
+    open_defs = []  # (indent, last line, node), innermost last
+    for tok in _py_code_lines(tokens):
+        while open_defs and open_defs[-1][0] >= tok.col and open_defs[-1][1] < tok.line:
+            ends[open_defs.pop()[2]] = offsets[tok.line - 1]
+        node = defs.get(tok.line)
+        if node is not None:
+            open_defs.append((node.col_offset, node.end_lineno, node))
+
+    functions = []
+    for lineno in sorted(defs):
+        node = defs[lineno]
+        # col_offset counts UTF-8 bytes, but only indentation precedes a def
+        start = offsets[lineno - 1] + node.col_offset
+        functions.append(_function_span(node.name, _ast_params(node.args), start, ends.get(node, offsets[-1]), offsets))
     return functions
 
-def find_py_function_end(lines: list, start_idx: int, base_indent: int) -> int:
-    for i in range(start_idx + 1, len(lines)):
-        line = lines[i]
-        if not line.strip(): continue
-        current_indent = len(line) - len(line.lstrip())
-        if current_indent <= base_indent and line.strip():
-            return i
-    return len(lines)
+def python_engine(code: str, offsets: List[int]) -> Tuple[list, Optional[List[Token]]]:
+    """Return (functions, tokens); tokens is None when the source needs the regex fallback."""
+    if PYTHON_ENGINE == 'ast':
+        try:
+            tree = ast.parse(code)
+            tokens = tokenize_python(code, offsets)
+            return extract_py_functions_ast(tree, offsets, tokens), tokens
+        except (SyntaxError, ValueError, RecursionError, tokenize.TokenError):
+            pass
+    return extract_py_functions(code, offsets), None
+
+COMPLEXITY_LEVELS = (
+    {'label': 'Low', 'color': '#3fb950', 'level': 0},
+    {'label': 'Moderate', 'color': '#d29922', 'level': 1},
+    {'label': 'High', 'color': '#f85149', 'level': 2},
+    {'label': 'Critical', 'color': '#da3633', 'level': 3},
+)
+
+MAINTAINABILITY_LEVELS = (
+    {'label': 'Excellent', 'color': '#3fb950', 'level': 0},
+    {'label': 'Good', 'color': '#58a6ff', 'level': 1},
+    {'label': 'Moderate', 'color': '#d29922', 'level': 2},
+    {'label': 'Poor', 'color': '#f85149', 'level': 3},
+    {'label': 'Critical', 'color': '#da3633', 'level': 4},
+)
 
+# Results share these dicts, so they must never be mutated
 def get_complexity_level(cc: int) -> dict:
-    if cc <= 5: return {'label': 'Low', 'color': '#3fb950', 'level': 0}
-    if cc <= 10: return {'label': 'Moderate', 'color': '#d29922', 'level': 1}
-    if cc <= 20: return {'label': 'High', 'color': '#f85149', 'level': 2}
-    return {'label': 'Critical', 'color': '#da3633', 'level': 3}
+    if cc <= 5: return COMPLEXITY_LEVELS[0]
+    if cc <= 10: return COMPLEXITY_LEVELS[1]
+    if cc <= 20: return COMPLEXITY_LEVELS[2]
+    return COMPLEXITY_LEVELS[3]
 
 def get_maintainability_level(mi: float) -> dict:
-    if mi >= 80: return {'label': 'Excellent', 'color': '#3fb950', 'level': 0}
-    if mi >= 60: return {'label': 'Good', 'color': '#58a6ff', 'level': 1}
-    if mi >= 40: return {'label': 'Moderate', 'color': '#d29922', 'level': 2}
-    if mi >= 20: return {'label': 'Poor', 'color': '#f85149', 'level': 3}
-    return {'label': 'Critical', 'color': '#da3633', 'level': 4}
+    if mi >= 80: return MAINTAINABILITY_LEVELS[0]
+    if mi >= 60: return MAINTAINABILITY_LEVELS[1]
+    if mi >= 40: return MAINTAINABILITY_LEVELS[2]
+    if mi >= 20: return MAINTAINABILITY_LEVELS[3]
+    return MAINTAINABILITY_LEVELS[4]
 
-def analyze_code(code: str, filename: str) -> dict:
-    language = detect_language(filename)
-    if language == 'unknown':
-        return {'error': 'Unsupported language', 'language': 'unknown'}
+# ─── Rule Engine ───
+# analyze_code computes every per-function fact once into a fact table; linter
+# and refactor rules only read rows of that table, so adding a rule never adds
+# a pass over the source. Each rule declares the facts it reads and its default
+# thresholds, and requests may disable rules or override thresholds per rule.
 
-    lines = code.split('\n')
-    loc = len(lines)
-    sloc = len([l for l in lines if l.strip() and not is_comment(l, language)])
-    blank_lines = len([l for l in lines if not l.strip()])
-    comment_lines = len([l for l in lines if is_comment(l, language)])
+FUNCTION_FACTS = {
+    'id', 'parentId', 'name', 'startLine', 'endLine', 'loc', 'params', 'paramCount',
+    'cc', 'nesting', 'returns', 'halstead', 'mi', 'exclusiveCc', 'exclusiveLoc', 'duplicate'
+}
 
-    if language in ('javascript', 'typescript'):
-        functions = extract_js_functions(code, lines)
-    else:
-        functions = extract_py_functions(code, lines)
+class Rule:
+    def __init__(self, rule_id: str, kind: str, facts: Tuple[str, ...], thresholds: dict, check):
+        self.id = rule_id
+        self.kind = kind
+        self.facts = facts
+        self.thresholds = thresholds
+        self.check = check
+
+    def describe(self) -> dict:
+        return {'id': self.id, 'kind': self.kind, 'facts': list(self.facts), 'thresholds': self.thresholds}
+
+RULES: Dict[str, Rule] = {}
+
+def rule(rule_id: str, kind: str, facts: Tuple[str, ...], **thresholds):
+    """Register check(fn, thresholds, language) -> finding dict or None; kind is 'lint' or 'refactor'."""
+    unknown = set(facts) - FUNCTION_FACTS
+    if unknown:
+        raise ValueError(f"Rule '{rule_id}' reads unknown facts: {sorted(unknown)}")
+
+    def register(check):
+        RULES[rule_id] = Rule(rule_id, kind, tuple(facts), thresholds, check)
+        return check
+    return register
+
+def validate_rule_config(config: Optional[dict]) -> Optional[dict]:
+    for rule_id, cfg in (config or {}).items():
+        if rule_id not in RULES:
+            raise ValueError(f"Unknown rule '{rule_id}'")
+        unknown = set(cfg.thresholds) - set(RULES[rule_id].thresholds)
+        if unknown:
+            raise ValueError(f"Rule '{rule_id}' has no thresholds {sorted(unknown)}")
+    return config
+
+def rule_overrides(config: Optional[dict]) -> Optional[dict]:
+    """Plain-dict form of a request's rule config, keeping only rules that differ from the defaults."""
+    overrides = {}
+    for rule_id, cfg in sorted((config or {}).items()):
+        thresholds = {**RULES[rule_id].thresholds, **cfg.thresholds}
+        if cfg.enabled and thresholds == RULES[rule_id].thresholds:
+            continue
+        overrides[rule_id] = {'enabled': cfg.enabled, 'thresholds': thresholds}
+    return overrides or None
+
+def rules_fingerprint(overrides: Optional[dict]) -> str:
+    if not overrides:
+        return ''
+    return hashlib.sha256(json.dumps(overrides, sort_keys=True).encode()).hexdigest()[:16]
+
+def apply_rules(fact_table: list, language: str, overrides: Optional[dict] = None) -> Tuple[list, list]:
+    """Run every enabled rule over the fact table; returns (linterIssues, refactorSuggestions)."""
+    overrides = overrides or {}
+    active = []
+    for r in RULES.values():
+        cfg = overrides.get(r.id)
+        if cfg is None:
+            active.append((r, r.thresholds))
+        elif cfg['enabled']:
+            active.append((r, cfg['thresholds']))
+
+    issues, suggestions = [], []
+    for fn in fact_table:
+        for r, thresholds in active:
+            finding = r.check(fn, thresholds, language)
+            if finding is None:
+                continue
+            if r.kind == 'lint':
+                issues.append({'rule': r.id, 'line': fn['startLine'], **finding})
+            else:
+                suggestions.append({'function': fn['name'], 'line': fn['startLine'], **finding})
+    return issues, suggestions
+
+@rule('max-function-length', 'lint', ('loc',), max=50, critical=100)
+def _max_function_length(fn, t, language):
+    if fn['loc'] > t['max']:
+        return {
+            'type': 'warning', 'message': f"Function '{fn['name']}' is {fn['loc']} lines long (max {t['max']:g})",
+            'severity': 'critical' if fn['loc'] > t['critical'] else 'warning'
+        }
+
+@rule('max-nesting-depth', 'lint', ('nesting',), max=3, critical=5)
+def _max_nesting_depth(fn, t, language):
+    if fn['nesting'] > t['max']:
+        return {
+            'type': 'warning', 'message': f"Function '{fn['name']}' has nesting depth of {fn['nesting']} (max {t['max']:g})",
+            'severity': 'critical' if fn['nesting'] > t['critical'] else 'warning'
+        }
+
+@rule('max-params', 'lint', ('paramCount',), max=5)
+def _max_params(fn, t, language):
+    if fn['paramCount'] > t['max']:
+        return {
+            'type': 'warning', 'message': f"Function '{fn['name']}' has {fn['paramCount']} parameters (max {t['max']:g})",
+            'severity': 'warning'
+        }
+
+@rule('multiple-returns', 'lint', ('returns',), max=3)
+def _multiple_returns(fn, t, language):
+    if fn['returns'] > t['max']:
+        return {
+            'type': 'info', 'message': f"Function '{fn['name']}' has {fn['returns']} return statements",
+            'severity': 'info'
+        }
+
+@rule('high-complexity', 'lint', ('cc',), max=10, critical=20)
+def _high_complexity(fn, t, language):
+    if fn['cc'] > t['max']:
+        return {
+            'type': 'warning',
+            'message': f"Function '{fn['name']}' has cyclomatic complexity of {fn['cc']} (threshold: {t['max']:g})",
+            'severity': 'critical' if fn['cc'] > t['critical'] else 'warning'
+        }
+
+@rule('decompose', 'refactor', ('cc',), max=15)
+def _decompose(fn, t, language):
+    if fn['cc'] > t['max']:
+        return {
+            'type': 'decompose', 'priority': 'high', 'title': 'Decompose Complex Function',
+            'description': f"Split '{fn['name']}' into smaller sub-functions. CC={fn['cc']}.",
+            'pattern': 'Extract Method'
+        }
+
+@rule('parameter-object', 'refactor', ('paramCount',), max=5)
+def _parameter_object(fn, t, language):
+    if fn['paramCount'] > t['max']:
+        return {
+            'type': 'parameter-object', 'priority': 'medium', 'title': 'Use Parameter Object',
+            'description': f"Replace {fn['paramCount']} parameters with a config object.",
+            'pattern': 'Use @dataclass' if language == 'python' else 'Use Options Object'
+        }
+
+@rule('extract-method', 'refactor', ('loc',), max=50)
+def _extract_method(fn, t, language):
+    if fn['loc'] > t['max']:
+        return {
+            'type': 'extract-method', 'priority': 'high', 'title': 'Extract Methods',
+            'description': f"{fn['loc']} LOC — extract logical blocks into named functions.",
+            'pattern': 'Extract Method + Single Responsibility'
+        }
+
+@rule('duplicate-logic', 'lint', ('duplicate',), min=0.8)
+def _duplicate_logic(fn, t, language):
+    duplicate = fn['duplicate']
+    if duplicate is not None and duplicate['similarity'] >= t['min']:
+        return {
+            'type': 'info',
+            'message': f"Functions '{duplicate['name']}' and '{fn['name']}' share {round(duplicate['similarity'] * 100)}% "
+                       f"similar structure — consider extracting common logic",
+            'severity': 'info'
+        }
 
-    halstead = compute_halstead(code, language)
-    file_cc = compute_cyclomatic_complexity(code, language)
-    mi = compute_maintainability_index(halstead['volume'], file_cc, loc)
+def function_tables(functions: list, fn_facts: list) -> Tuple[list, list]:
+    """Build (FunctionMetric dicts, rule fact table) from extracted spans and their facts.
 
+    The Halstead and exclusive dicts of the facts go into the metrics as they
+    are, not copied: like the level dicts, results must never mutate them.
+    """
     function_metrics = []
-    for fn in functions:
-        fn_cc = compute_cyclomatic_complexity(fn['body'], language)
-        fn_halstead = compute_halstead(fn['body'], language)
-        fn_mi = compute_maintainability_index(fn_halstead['volume'], fn_cc, fn['loc'])
-        fn_nesting = compute_max_nesting(fn['body'], language)
+    fact_table = []
+    duplicates = duplicate_functions(functions, fn_facts)
+    for fn_id, (fn, facts) in enumerate(zip(functions, fn_facts)):
+        fn_cc = facts['cyclomaticComplexity']
+        fn_halstead = facts['halstead']
+        fn_mi = compute_maintainability_index(fn_halstead['volume'], fn_cc, fn.loc)
+        fn_nesting = facts['maxNestingDepth']
+        exclusive = facts['exclusive']
+        duplicate = duplicates[fn_id]
+        if duplicate is not None:
+            score, other = duplicate
+            duplicate = {
+                'id': other, 'name': functions[other].name, 'startLine': functions[other].start_line,
+                'similarity': score
+            }
+        fact_table.append({
+            'id': fn_id, 'parentId': facts['parent'],
+            'name': fn.name, 'startLine': fn.start_line, 'endLine': fn.end_line,
+            'loc': fn.loc, 'params': fn.params,
+            'paramCount': sum(1 for p in fn.params if p not in ('self', 'cls')),
+            'cc': fn_cc, 'nesting': fn_nesting, 'returns': facts['returnCount'],
+            'halstead': fn_halstead, 'mi': fn_mi,
+            'exclusiveCc': exclusive['cyclomaticComplexity'], 'exclusiveLoc': exclusive['loc'],
+            'duplicate': duplicate
+        })
         function_metrics.append({
-            'name': fn['name'], 'startLine': fn['startLine'], 'endLine': fn['endLine'],
-            'loc': fn['loc'], 'params': fn['params'], 'paramCount': len(fn['params']),
+            'id': fn_id, 'parentId': facts['parent'], 'name': fn.name, 'startLine': fn.start_line, 'endLine': fn.end_line,
+            'loc': fn.loc, 'params': fn.params, 'paramCount': len(fn.params),
             'cyclomaticComplexity': fn_cc, 'complexityLevel': get_complexity_level(fn_cc),
             'halstead': fn_halstead, 'maintainabilityIndex': fn_mi,
             'maintainabilityLevel': get_maintainability_level(fn_mi),
-            'maxNestingDepth': fn_nesting, 'heatIntensity': 0
+            'maxNestingDepth': fn_nesting, 'exclusive': exclusive, 'heatIntensity': 0
         })
+    return function_metrics, fact_table
 
-    max_cc = max((f['cyclomaticComplexity'] for f in function_metrics), default=1)
-    if max_cc == 0: max_cc = 1
-    for fm in function_metrics:
-        fm['heatIntensity'] = fm['cyclomaticComplexity'] / max_cc
+def line_counts(lines: List[str], language: str) -> dict:
+    return {
+        'loc': len(lines),
+        'sloc': len([l for l in lines if l.strip() and not is_comment(l, language)]),
+        'blankLines': len([l for l in lines if not l.strip()]),
+        'commentLines': len([l for l in lines if is_comment(l, language)])
+    }
 
-    linter_issues = run_linter(functions, code, language)
-    refactor_suggestions = generate_refactor_suggestions(functions, language)
+def assemble_result(language: str, filename: str, counts: dict, file_cc: int, halstead: dict,
+                    function_metrics: list, linter_issues: list, refactor_suggestions: list) -> dict:
+    """The analysis result from file-level facts and the finished per-function tables.
 
+    The heatmap, which only repeats per-function fields, is left to shape_result.
+    """
+    mi = compute_maintainability_index(halstead['volume'], file_cc, counts['loc'])
+    # Exclusive CC, so code inside nested functions heats only the innermost one
+    max_cc = max((f['exclusive']['cyclomaticComplexity'] for f in function_metrics), default=1)
+    if max_cc == 0: max_cc = 1
+    for fm in function_metrics:
+        fm['heatIntensity'] = fm['exclusive']['cyclomaticComplexity'] / max_cc
     return {
         'language': language, 'filename': filename,
         'summary': {
-            'loc': loc, 'sloc': sloc, 'blankLines': blank_lines,
-            'commentLines': comment_lines, 'functionCount': len(functions),
+            **counts, 'functionCount': len(function_metrics),
             'cyclomaticComplexity': file_cc, 'complexityLevel': get_complexity_level(file_cc),
             'maintainabilityIndex': mi, 'maintainabilityLevel': get_maintainability_level(mi),
             'halstead': halstead
         },
         'functions': function_metrics,
         'linterIssues': linter_issues,
-        'refactorSuggestions': refactor_suggestions,
-        'heatmap': [{
-            'name': fm['name'], 'startLine': fm['startLine'], 'endLine': fm['endLine'],
-            'intensity': fm['heatIntensity'], 'complexity': fm['cyclomaticComplexity'],
-            'color': fm['complexityLevel']['color']
-        } for fm in function_metrics]
+        'refactorSuggestions': refactor_suggestions
     }
 
-def run_linter(functions: list, code: str, language: str) -> list:
-    issues = []
-    for fn in functions:
-        if fn['loc'] > 50:
-            issues.append({
-                'type': 'warning', 'rule': 'max-function-length',
-                'message': f"Function '{fn['name']}' is {fn['loc']} lines long (max 50)",
-                'line': fn['startLine'], 'severity': 'critical' if fn['loc'] > 100 else 'warning'
-            })
-        depth = compute_max_nesting(fn['body'], language)
-        if depth > 3:
-            issues.append({
-                'type': 'warning', 'rule': 'max-nesting-depth',
-                'message': f"Function '{fn['name']}' has nesting depth of {depth} (max 3)",
-                'line': fn['startLine'], 'severity': 'critical' if depth > 5 else 'warning'
-            })
-        params = [p for p in fn['params'] if p not in ('self', 'cls')]
-        if len(params) > 5:
-            issues.append({
-                'type': 'warning', 'rule': 'max-params',
-                'message': f"Function '{fn['name']}' has {len(params)} parameters (max 5)",
-                'line': fn['startLine'], 'severity': 'warning'
-            })
-        return_count = len(re.findall(r'\breturn\b', fn['body']))
-        if return_count > 3:
-            issues.append({
-                'type': 'info', 'rule': 'multiple-returns',
-                'message': f"Function '{fn['name']}' has {return_count} return statements",
-                'line': fn['startLine'], 'severity': 'info'
-            })
-        cc = compute_cyclomatic_complexity(fn['body'], language)
-        if cc > 10:
-            issues.append({
-                'type': 'warning', 'rule': 'high-complexity',
-                'message': f"Function '{fn['name']}' has cyclomatic complexity of {cc} (threshold: 10)",
-                'line': fn['startLine'], 'severity': 'critical' if cc > 20 else 'warning'
-            })
-    return issues
-
-def generate_refactor_suggestions(functions: list, language: str) -> list:
-    suggestions = []
-    for fn in functions:
-        cc = compute_cyclomatic_complexity(fn['body'], language)
-        if cc > 15:
-            suggestions.append({
-                'function': fn['name'], 'line': fn['startLine'], 'type': 'decompose',
-                'priority': 'high', 'title': 'Decompose Complex Function',
-                'description': f"Split '{fn['name']}' into smaller sub-functions. CC={cc}.",
-                'pattern': 'Extract Method'
-            })
-        params = [p for p in fn['params'] if p not in ('self', 'cls')]
-        if len(params) > 5:
-            suggestions.append({
-                'function': fn['name'], 'line': fn['startLine'], 'type': 'parameter-object',
-                'priority': 'medium', 'title': 'Use Parameter Object',
-                'description': f"Replace {len(params)} parameters with a config object.",
-                'pattern': 'Use @dataclass' if language == 'python' else 'Use Options Object'
-            })
-        if fn['loc'] > 50:
-            suggestions.append({
-                'function': fn['name'], 'line': fn['startLine'], 'type': 'extract-method',
-                'priority': 'high', 'title': 'Extract Methods',
-                'description': f"{fn['loc']} LOC — extract logical blocks into named functions.",
-                'pattern': 'Extract Method + Single Responsibility'
-            })
-    return suggestions
+# Stage boundaries timed inside analyze_code, in order
+ANALYZE_STAGES = ('lines', 'extract', 'spans', 'metrics', 'lint')
 
-# ─── API Routes ───
-@api_router.get("/")
-async def root():
-    return {"message": "NoseyCoder API"}
+def analyze_code(code: str, filename: str, rules: Optional[dict] = None, timings: Optional[dict] = None) -> dict:
+    """rules is the rule_overrides() form of a request's rule config; None runs every rule with defaults.
 
-@api_router.post("/analyze")
-async def analyze_endpoint(req: AnalyzeRequest):
-    result = analyze_code(req.code, req.filename)
+    timings, when given, receives the seconds spent in each of ANALYZE_STAGES.
+    """
+    language = detect_language(filename)
+    if language == 'unknown':
+        return {'error': 'Unsupported language', 'language': 'unknown'}
+    marks = [time.perf_counter()]
 
-    # Store analysis record
-    if 'error' not in result:
-        record = {
-            'id': str(uuid.uuid4()),
-            'filename': result['filename'],
-            'language': result['language'],
-            'loc': result['summary']['loc'],
-            'complexity': result['summary']['cyclomaticComplexity'],
-            'maintainability': result['summary']['maintainabilityIndex'],
-            'functionCount': result['summary']['functionCount'],
-            'issueCount': len(result['linterIssues']),
-            'timestamp': datetime.now(timezone.utc).isoformat()
-        }
-        await db.analysis_history.insert_one(record)
+    counts = line_counts(code.split('\n'), language)
+    marks.append(time.perf_counter())
+
+    offsets = line_offsets(code)
+    tokens = None
+    if language in ('javascript', 'typescript'):
+        functions = extract_js_functions(code, offsets)
+    else:
+        functions, tokens = python_engine(code, offsets)
+    marks.append(time.perf_counter())
+
+    file_facts, fn_facts = collect_span_facts(code, language, functions, offsets, tokens)
+    marks.append(time.perf_counter())
+
+    function_metrics, fact_table = function_tables(functions, fn_facts)
+    marks.append(time.perf_counter())
+
+    linter_issues, refactor_suggestions = apply_rules(fact_table, language, rules)
+    marks.append(time.perf_counter())
+    if timings is not None:
+        for stage, start, end in zip(ANALYZE_STAGES, marks, marks[1:]):
+            timings[stage] = end - start
 
+    result = assemble_result(language, filename, counts, file_facts['cyclomaticComplexity'], file_facts['halstead'],
+                             function_metrics, linter_issues, refactor_suggestions)
+    # Internal: aligned with functions, indexed for cross-file clone search and never sent to clients
+    result['cloneFingerprints'] = [facts['fingerprints'] for facts in fn_facts]
     return result
 
-@api_router.get("/history")
-async def get_history():
-    records = await db.analysis_history.find({}, {"_id": 0}).sort("timestamp", -1).to_list(50)
-    return records
+# ─── Instrumentation ───
+# Stage timings for each request go into a context-local dict that the timing
+# middleware turns into a Server-Timing header, and into per-process Prometheus
+# histograms served from /api/metrics. Workers can also cProfile a sample of
+# analyses and keep the dumps of the slowest ones.
 
-@api_router.get("/health")
-async def health():
-    return {"status": "ok", "service": "NoseyCoder API"}
+METRICS_DURATION_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+METRICS_LINE_BUCKETS = (10, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 25000, 50000, 100000, 200000)
+PROFILE_SAMPLE_RATE = float(os.environ.get('PROFILE_SAMPLE_RATE', '0'))
+PROFILE_MIN_SECONDS = float(os.environ.get('PROFILE_MIN_SECONDS', '0.5'))
+PROFILE_DIR = os.environ.get('PROFILE_DIR', '') or os.path.join(tempfile.gettempdir(), 'noseycoder-profiles')
+PROFILE_KEEP = int(os.environ.get('PROFILE_KEEP', '20'))
 
-# Include router
-app.include_router(api_router)
+request_timings: ContextVar[Optional[dict]] = ContextVar('request_timings', default=None)
 
-app.add_middleware(
-    CORSMiddleware,
-    allow_credentials=True,
-    allow_origins=os.environ.get('CORS_ORIGINS', '*').split(','),
-    allow_methods=["*"],
-    allow_headers=["*"],
+def _label_text(names: tuple, values: tuple) -> str:
+    if not names:
+        return ''
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for v in values)
+    return '{' + ','.join(f'{n}="{v}"' for n, v in zip(names, escaped)) + '}'
+
+def render_metric(name: str, help_text: str, kind: str, labels: tuple, samples) -> list:
+    """Prometheus text exposition lines for (label values, value) samples."""
+    lines = [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"]
+    lines.extend(f"{name}{_label_text(labels, values)} {value}" for values, value in samples)
+    return lines
+
+class Counter:
+    def __init__(self, name: str, help_text: str, labels: tuple = ()):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.series = {}
+
+    def inc(self, *values, amount: float = 1):
+        self.series[values] = self.series.get(values, 0) + amount
+
+    def render(self) -> list:
+        return render_metric(self.name, self.help_text, 'counter', self.labels, sorted(self.series.items()))
+
+class Histogram:
+    def __init__(self, name: str, help_text: str, labels: tuple, buckets: tuple):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.buckets = buckets
+        # label values -> [per-bucket counts (last is +Inf), sum, count]
+        self.series = {}
+
+    def observe(self, value: float, *values):
+        series = self.series.get(values)
+        if series is None:
+            series = self.series[values] = [0] * (len(self.buckets) + 1) + [0.0, 0]
+        series[bisect_left(self.buckets, value)] += 1
+        series[-2] += value
+        series[-1] += 1
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        bucket_labels = self.labels + ('le',)
+        for values, series in sorted(self.series.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), series):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{_label_text(bucket_labels, values + (bound,))} {cumulative}")
+            lines.append(f"{self.name}_sum{_label_text(self.labels, values)} {series[-2]:.6f}")
+            lines.append(f"{self.name}_count{_label_text(self.labels, values)} {series[-1]}")
+        return lines
+
+class Metrics:
+    def __init__(self):
+        self.requests = Histogram('noseycoder_request_duration_seconds', 'Time to response headers per API route.',
+                                  ('endpoint', 'status'), METRICS_DURATION_BUCKETS)
+        self.stages = Histogram('noseycoder_stage_duration_seconds', 'Time spent per analysis stage.',
+                                ('stage',), METRICS_DURATION_BUCKETS)
+        self.input_lines = Histogram('noseycoder_input_lines', 'Lines per analyzed source.',
+                                     ('language',), METRICS_LINE_BUCKETS)
+        self.input_chars = Counter('noseycoder_input_chars_total', 'Characters of analyzed source.', ('language',))
+        self.errors = Counter('noseycoder_errors_total', 'Failed requests and analyses by reason.', ('reason',))
+        self.degraded = Counter('noseycoder_degraded_total', 'Analyses answered with a degraded summary, by reason.',
+                                ('reason', 'language'))
+        self.queue_wait = Histogram('noseycoder_queue_wait_seconds', 'Time analyses waited for a worker.',
+                                    ('lane', 'priority'), METRICS_DURATION_BUCKETS)
+        self.rejections = Counter('noseycoder_rejections_total', 'Work rejected with 429, by priority class and reason.',
+                                  ('priority', 'reason'))
+
+    def render(self) -> str:
+        lines = []
+        for metric in (self.requests, self.stages, self.input_lines, self.input_chars, self.errors, self.degraded,
+                       self.queue_wait, self.rejections):
+            lines.extend(metric.render())
+        # Point-in-time state of the pool, cache and history writer
+        pool = analysis_pool.snapshot()
+        lines += render_metric('noseycoder_pool_pending', 'Analyses queued or running per pool lane.', 'gauge',
+                               ('lane',), [((lane,), stats['pending']) for lane, stats in pool.items()])
+        lines += render_metric('noseycoder_pool_rejected_total', 'Analyses rejected with 429 per pool lane.', 'counter',
+                               ('lane',), [((lane,), stats['rejected']) for lane, stats in pool.items()])
+        lines += render_metric('noseycoder_pool_queued', 'Analyses waiting for a worker per pool lane and priority class.',
+                               'gauge', ('lane', 'priority'),
+                               [((lane, priority), counts['queued'])
+                                for lane, stats in pool.items() for priority, counts in stats['classes'].items()])
+        lines += render_metric('noseycoder_cache_events_total', 'Result cache lookups by outcome, and evictions.', 'counter',
+                               ('event',), [((event,), count) for event, count in sorted(result_cache.stats.items())])
+        lines += render_metric('noseycoder_live_sessions', 'Open live analysis WebSocket sessions.', 'gauge',
+                               (), [((), live_sessions.active)])
+        lines += render_metric('noseycoder_history_queue_depth', 'History records waiting to be written.', 'gauge',
+                               (), [((), history_writer.snapshot()['queueDepth'])])
+        return '\n'.join(lines) + '\n'
+
+metrics = Metrics()
+
+def record_stage(stage: str, seconds: float):
+    metrics.stages.observe(seconds, stage)
+    timings = request_timings.get()
+    if timings is not None:
+        timings[stage] = timings.get(stage, 0.0) + seconds
+
+def server_timing(timings: dict) -> str:
+    return ', '.join(f"{stage};dur={seconds * 1000:.2f}" for stage, seconds in timings.items())
+
+class StageTimingMiddleware:
+    """Collects stage timings per /api request and reports them in a Server-Timing header."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http' or not scope['path'].startswith('/api/'):
+            return await self.app(scope, receive, send)
+        timings = {}
+        token = request_timings.set(timings)
+        started = time.perf_counter()
+        status = 500
+
+        async def send_with_timing(message):
+            nonlocal status
+            if message['type'] == 'http.response.start':
+                status = message['status']
+                timings['total'] = time.perf_counter() - started
+                headers = MutableHeaders(scope=message)
+                headers.append('Server-Timing', server_timing(timings))
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            request_timings.reset(token)
+            # Route templates, not raw paths, so unknown URLs cannot blow up label cardinality
+            endpoint = getattr(scope.get('route'), 'path', 'other')
+            metrics.requests.observe(time.perf_counter() - started, endpoint, str(status))
+            if status >= 400:
+                metrics.errors.inc(f"http_{status}")
+
+def _save_profile(profiler: cProfile.Profile, seconds: float, filename: str):
+    """Dump a profile named by its duration, keeping only the PROFILE_KEEP slowest dumps."""
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    stem = re.sub(r'[^\w.-]', '_', os.path.basename(filename))[:60]
+    profiler.dump_stats(os.path.join(PROFILE_DIR, f"{int(seconds * 1000):09d}ms-{uuid.uuid4().hex[:8]}-{stem}.prof"))
+    dumps = sorted(name for name in os.listdir(PROFILE_DIR) if name.endswith('.prof'))
+    for name in dumps[:-PROFILE_KEEP] if PROFILE_KEEP > 0 else dumps:
+        try:
+            os.remove(os.path.join(PROFILE_DIR, name))
+        except FileNotFoundError:
+            pass  # another worker pruned it first
+
+def timed_analysis(code: str, filename: str, rules: Optional[dict] = None) -> Tuple[dict, dict]:
+    """analyze_code plus its stage timings; a PROFILE_SAMPLE_RATE share of runs is profiled."""
+    timings = {}
+    if PROFILE_SAMPLE_RATE <= 0 or random.random() >= PROFILE_SAMPLE_RATE:
+        return analyze_code(code, filename, rules, timings), timings
+    profiler = cProfile.Profile()
+    started = time.perf_counter()
+    result = profiler.runcall(analyze_code, code, filename, rules, timings)
+    seconds = time.perf_counter() - started
+    if seconds >= PROFILE_MIN_SECONDS:
+        try:
+            _save_profile(profiler, seconds, filename)
+        except OSError as e:
+            logger.warning("profile dump failed: %s", e)
+    return result, timings
+
+# ─── Analysis Budget ───
+# Pathological sources (minified bundles, generated tables, inputs that make
+# the scanners backtrack) must not pin a worker. Oversized sources are refused
+# up front. In a worker, every analysis runs under a CPU-time interval timer;
+# sources with very long lines, or that run out of budget, get a degraded
+# summary instead: line counts plus CC and Halstead estimated from one linear
+# token pass, with no per-function results. RLIMIT_CPU backs the timer up for
+# work stuck in C code that never returns to the signal handler: the kernel
+# kills the worker and the API process asks a fresh one for the summary.
+
+ANALYSIS_MAX_BYTES = int(os.environ.get('ANALYSIS_MAX_BYTES', str(10 * 1024 * 1024)))
+ANALYSIS_MAX_LINE_CHARS = int(os.environ.get('ANALYSIS_MAX_LINE_CHARS', '20000'))
+ANALYSIS_CPU_BUDGET = float(os.environ.get('ANALYSIS_CPU_BUDGET', '10'))
+ANALYSIS_CPU_GRACE = float(os.environ.get('ANALYSIS_CPU_GRACE', '5'))
+DEGRADED_RECENT = 20
+ESTIMATE_SLICE = 1 << 20
+
+_JS_ESTIMATE_RE = re.compile(rf'[A-Za-z_$][\w$]*|{_NUMBER_PATTERN}|{_operator_pattern(JS_OPERATORS)}')
+_PY_ESTIMATE_RE = re.compile(rf'[A-Za-z_]\w*|{_NUMBER_PATTERN}|{_operator_pattern(PY_OPERATORS)}')
+
+class AnalysisBudgetExceeded(Exception):
+    pass
+
+# Set by the pool initializer; the API process and thread-mode pools never arm the timer
+_budget_armed = False
+
+def _on_cpu_budget(signum, frame):
+    raise AnalysisBudgetExceeded()
+
+def init_analysis_worker():
+    """ProcessPoolExecutor initializer: lets the CPU timer interrupt analyses in this worker."""
+    global _budget_armed
+    if ANALYSIS_CPU_BUDGET <= 0 or not hasattr(signal, 'setitimer'):
+        return
+    signal.signal(signal.SIGPROF, _on_cpu_budget)
+    if resource is not None:
+        # A worker killed by SIGXCPU should not leave a core dump of its heap behind
+        resource.setrlimit(resource.RLIMIT_CORE, (0, 0))
+    _budget_armed = True
+
+def _reset_cpu_limit():
+    """Move the RLIMIT_CPU soft limit to budget plus grace past this worker's CPU time so far."""
+    if resource is None:
+        return
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    soft = math.ceil(usage.ru_utime + usage.ru_stime + ANALYSIS_CPU_BUDGET + ANALYSIS_CPU_GRACE)
+    hard = resource.getrlimit(resource.RLIMIT_CPU)[1]
+    if hard != resource.RLIM_INFINITY:
+        soft = min(soft, hard)
+    resource.setrlimit(resource.RLIMIT_CPU, (soft, hard))
+
+def run_with_cpu_budget(fn, *args):
+    """fn(*args), raising AnalysisBudgetExceeded once it has used ANALYSIS_CPU_BUDGET seconds of CPU."""
+    if not _budget_armed:
+        return fn(*args)
+    _reset_cpu_limit()
+    signal.setitimer(signal.ITIMER_PROF, ANALYSIS_CPU_BUDGET)
+    try:
+        return fn(*args)
+    finally:
+        signal.setitimer(signal.ITIMER_PROF, 0)
+
+def longest_line(code: str) -> int:
+    return max(map(len, code.split('\n')))
+
+def estimate_facts(code: str, language: str) -> dict:
+    """CC and Halstead counts from names, numbers and operators alone; strings and comments are not skipped."""
+    python = language == 'python'
+    pattern = _PY_ESTIMATE_RE if python else _JS_ESTIMATE_RE
+    keywords = PY_KEYWORDS if python else JS_KEYWORDS
+    decisions = PY_DECISIONS if python else JS_DECISIONS
+    tally = TokenTally()
+    # Sliced so the token list never holds more than ESTIMATE_SLICE characters' worth
+    for pos in range(0, len(code), ESTIMATE_SLICE):
+        tally.update(pattern.findall(code, pos, pos + ESTIMATE_SLICE))
+    cc = 1
+    operators = {}
+    operands = {}
+    for text, count in tally.items():
+        if text in keywords or not (text[0].isalnum() or text[0] in '_$'):
+            operators[text] = count
+            if text in decisions:
+                cc += count
+        else:
+            operands[text] = count
+    return {'cyclomaticComplexity': cc, 'operators': operators, 'operands': operands}
+
+def degraded_result(code: str, filename: str, reason: str, detail: str) -> dict:
+    """Summary-only result for a source too costly to analyze in full, flagged with why."""
+    language = detect_language(filename)
+    facts = estimate_facts(code, language)
+    result = assemble_result(
+        language, filename, line_counts(code.split('\n'), language), facts['cyclomaticComplexity'],
+        halstead_from_counts(facts['operators'], facts['operands']), [], [], []
+    )
+    result['degraded'] = {'reason': reason, 'detail': detail}
+    return result
+
+def budget_detail(reason: str) -> str:
+    if reason == 'long_line':
+        return f"A line is longer than {ANALYSIS_MAX_LINE_CHARS} characters"
+    if reason == 'cpu_budget':
+        return f"Analysis used more than {ANALYSIS_CPU_BUDGET:g}s of CPU time"
+    return f"The analysis worker was killed after {ANALYSIS_CPU_BUDGET + ANALYSIS_CPU_GRACE:g}s of CPU time"
+
+def budgeted_analysis(code: str, filename: str, rules: Optional[dict] = None) -> Tuple[dict, dict]:
+    """timed_analysis under the CPU budget; long lines and budget overruns get degraded_result."""
+    reason = None
+    if ANALYSIS_MAX_LINE_CHARS > 0 and longest_line(code) > ANALYSIS_MAX_LINE_CHARS:
+        reason = 'long_line'
+    else:
+        try:
+            return run_with_cpu_budget(timed_analysis, code, filename, rules)
+        except AnalysisBudgetExceeded:
+            reason = 'cpu_budget'
+    started = time.perf_counter()
+    if _budget_armed:
+        _reset_cpu_limit()  # the summary gets a fresh allowance before the kernel steps in
+    result = degraded_result(code, filename, reason, budget_detail(reason))
+    return result, {'degraded': time.perf_counter() - started}
+
+recent_degraded = deque(maxlen=DEGRADED_RECENT)
+
+def note_degraded(result: dict, size: int, digest: Optional[str] = None):
+    """Count a degraded analysis and remember it among the recent offenders."""
+    degraded = result['degraded']
+    metrics.degraded.inc(degraded['reason'], result['language'])
+    recent_degraded.append({
+        'filename': result['filename'], 'language': result['language'], 'size': size, 'resultId': digest,
+        **degraded, 'timestamp': datetime.now(timezone.utc).isoformat()
+    })
+    logger.warning("Degraded analysis of %s (size %d, %s): %s",
+                   result['filename'], size, (digest or 'streamed')[:12], degraded['detail'])
+
+def budget_snapshot() -> dict:
+    return {
+        'maxBytes': ANALYSIS_MAX_BYTES, 'maxLineChars': ANALYSIS_MAX_LINE_CHARS,
+        'cpuBudgetSeconds': ANALYSIS_CPU_BUDGET, 'cpuGraceSeconds': ANALYSIS_CPU_GRACE,
+        'recentDegraded': list(recent_degraded)
+    }
+
+# ─── Result Cache ───
+# Two tiers keyed by content hash + language + analyzer version: a per-process
+# LRU with TTL, backed by the shared analysis_cache collection so every worker
+# benefits. Identical requests already in flight await the same computation.
+
+class ResultCache:
+    def __init__(self, max_entries: int, ttl: float):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._inflight = {}
+        self.stats = {'memoryHits': 0, 'mongoHits': 0, 'misses': 0, 'coalesced': 0, 'evictions': 0}
+
+    @staticmethod
+    def key(digest: str, language: str, rules: Optional[dict] = None) -> str:
+        key = f"{digest}:{language}:{ANALYZER_VERSION}"
+        return f"{key}:{rules_fingerprint(rules)}" if rules else key
+
+    def get(self, key: str) -> Optional[dict]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        stored_at, result = entry
+        if time.monotonic() - stored_at > self.ttl:
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return result
+
+    def put(self, key: str, result: dict):
+        self._entries[key] = (time.monotonic(), result)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.stats['evictions'] += 1
+
+    async def get_or_compute(self, key: str, compute) -> dict:
+        result = self.get(key)
+        if result is not None:
+            self.stats['memoryHits'] += 1
+            return result
+        pending = self._inflight.get(key)
+        if pending is not None:
+            self.stats['coalesced'] += 1
+            return await asyncio.shield(pending)
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            result = await _load_cached_result(key)
+            if result is not None:
+                self.stats['mongoHits'] += 1
+            else:
+                self.stats['misses'] += 1
+                result = await compute()
+                await _store_cached_result(key, result)
+            self.put(key, result)
+            future.set_result(result)
+            return result
+        except BaseException as e:
+            future.set_exception(e)
+            # Mark retrieved so a failure with no coalesced waiters is not logged as unhandled
+            future.exception()
+            raise
+        finally:
+            del self._inflight[key]
+
+    async def lookup(self, key: str) -> Optional[dict]:
+        """The result for key from either tier, or None; never computes."""
+        result = self.get(key)
+        if result is not None:
+            self.stats['memoryHits'] += 1
+            return result
+        result = await _load_cached_result(key)
+        if result is not None:
+            self.stats['mongoHits'] += 1
+            self.put(key, result)
+        return result
+
+    def snapshot(self) -> dict:
+        lookups = sum(self.stats[k] for k in ('memoryHits', 'mongoHits', 'misses', 'coalesced'))
+        hits = lookups - self.stats['misses']
+        return {
+            **self.stats, 'entries': len(self._entries), 'maxEntries': self.max_entries,
+            'ttlSeconds': self.ttl, 'hitRate': round(hits / lookups, 4) if lookups else 0,
+            'analyzerVersion': ANALYZER_VERSION
+        }
+
+result_cache = ResultCache(
+    max_entries=int(os.environ.get('ANALYSIS_CACHE_SIZE', '512')),
+    ttl=float(os.environ.get('ANALYSIS_CACHE_TTL', '3600')),
 )
 
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-logger = logging.getLogger(__name__)
+async def _load_cached_result(key: str) -> Optional[dict]:
+    try:
+        doc = await db.analysis_cache.find_one({'_id': key}, {'_id': 0, 'result': 1})
+    except Exception as e:
+        logger.warning("analysis_cache lookup failed: %s", e)
+        return None
+    return doc['result'] if doc else None
+
+async def _store_cached_result(key: str, result: dict):
+    try:
+        await db.analysis_cache.replace_one(
+            {'_id': key},
+            {'_id': key, 'version': ANALYZER_VERSION, 'result': result, 'createdAt': datetime.now(timezone.utc)},
+            upsert=True
+        )
+    except Exception as e:
+        # Oversized documents (>16MB) and Mongo outages only cost us the second tier
+        logger.warning("analysis_cache store failed: %s", e)
+
+def content_digest(code: str) -> str:
+    return hashlib.sha256(code.encode('utf-8', 'surrogatepass')).hexdigest()
+
+async def analyze_cached(code: str, filename: str, rules: Optional[dict] = None, digest: Optional[str] = None) -> dict:
+    """Analyze through the cache; successful results carry resultId, the source's content digest.
+
+    digest, when the caller already hashed the source, saves hashing it again.
+    """
+    language = detect_language(filename)
+    if language == 'unknown':
+        metrics.errors.inc('unsupported_language')
+        return analyze_code(code, filename)
+    # Characters never outnumber UTF-8 bytes, so only long sources need encoding to be measured
+    if len(code) > ANALYSIS_MAX_BYTES // 4 and len(code.encode('utf-8', 'surrogatepass')) > ANALYSIS_MAX_BYTES:
+        metrics.errors.inc('too_large')
+        raise HTTPException(
+            status_code=413, detail=f"Source exceeds {ANALYSIS_MAX_BYTES} bytes; send it to /api/analyze/stream instead"
+        )
+    metrics.input_lines.observe(code.count('\n') + 1, language)
+    metrics.input_chars.inc(language, amount=len(code))
+    started = time.perf_counter()
+    digest = digest or content_digest(code)
+    pool_seconds = 0.0
+
+    async def compute(degraded_reason: Optional[str] = None):
+        nonlocal pool_seconds
+        sent = time.perf_counter()
+        if degraded_reason:
+            result, timings = await analysis_pool.run_degraded(code, filename, degraded_reason)
+        else:
+            result, timings = await analysis_pool.run(code, filename, rules)
+        elapsed = time.perf_counter() - sent
+        pool_seconds += elapsed
+        for stage, seconds in timings.items():
+            record_stage(stage, seconds)
+        # Queue wait plus moving the source and result between processes
+        record_stage('pool', max(0.0, elapsed - sum(timings.values())))
+        result['resultId'] = digest
+        if 'degraded' in result:
+            note_degraded(result, len(code), digest)
+        return result
+
+    try:
+        result = await result_cache.get_or_compute(ResultCache.key(digest, language, rules), compute)
+    except AnalysisBudgetExceeded:
+        # Not cached: a worker crash during a long analysis would look the same
+        try:
+            result = await compute('worker_killed')
+        except AnalysisBudgetExceeded:
+            raise HTTPException(status_code=503, detail="Analysis worker crashed", headers={'Retry-After': '1'})
+    # Hashing plus both cache tiers; on a hit this is the whole analysis
+    record_stage('cache', time.perf_counter() - started - pool_seconds)
+    return result if result['filename'] == filename else {**result, 'filename': filename}
+
+# ─── Fair Scheduling ───
+# Browser requests and bulk CI work share each pool lane's workers. Every
+# analysis waits in the queue of its priority class: interactive for
+# /analyze, /analyze/incremental, /analyze/stream and live sessions, bulk for
+# batches, archives and jobs. A freed worker goes to interactive work first,
+# and bulk work never holds the last SCHED_INTERACTIVE_RESERVE workers of a
+# lane, so a bulk backlog delays an interactive request by at most one
+# analysis while still using every idle worker. Inside a class, clients
+# (API key, else Origin, else address) share the workers by weighted fair
+# queuing, and each client's analysis requests are rate limited by a token
+# bucket before they reach a queue.
+
+SCHED_CLASSES = ('interactive', 'bulk')
+SCHED_BULK_PATHS = ('/api/analyze/batch', '/api/analyze/archive', '/api/jobs')
+# Endpoints that start analyses; /api/analyze/probe only looks up the cache and is free
+SCHED_RATED_PATHS = frozenset({
+    '/api/analyze', '/api/analyze/incremental', '/api/analyze/stream', '/api/analyze/batch', '/api/analyze/archive',
+    '/api/jobs', '/api/jobs/archive', '/api/live'
+})
+SCHED_API_KEY_HEADER = os.environ.get('SCHED_API_KEY_HEADER', 'X-API-Key')
+SCHED_INTERACTIVE_RESERVE = int(os.environ.get('SCHED_INTERACTIVE_RESERVE', '1'))
+SCHED_INTERACTIVE_TARGET = float(os.environ.get('SCHED_INTERACTIVE_TARGET_MS', '250')) / 1000
+SCHED_CLIENT_RATE = float(os.environ.get('SCHED_CLIENT_RATE', '20'))
+SCHED_CLIENT_BURST = float(os.environ.get('SCHED_CLIENT_BURST', '40'))
+# "client=weight,..." with clients written as key:<api key>, origin:<origin> or addr:<address>
+SCHED_CLIENT_WEIGHTS = {
+    client.strip(): float(weight)
+    for client, _, weight in (entry.rpartition('=') for entry in os.environ.get('SCHED_CLIENT_WEIGHTS', '').split(','))
+    if client.strip() and float(weight) > 0
+}
+# Bytes of source counted as one unit of work when ordering a client's analyses
+SCHED_COST_BYTES = 65536
+SCHED_WAIT_WINDOW = 1000
+SCHED_MAX_BUCKETS = 10000
+
+# (priority class, client key) of the request or job the current task works for
+analysis_context: ContextVar[Tuple[str, str]] = ContextVar('analysis_context', default=('interactive', ''))
+
+def client_key(scope) -> str:
+    headers = Headers(scope=scope)
+    if headers.get(SCHED_API_KEY_HEADER):
+        return f"key:{headers[SCHED_API_KEY_HEADER]}"
+    if headers.get('origin'):
+        return f"origin:{headers['origin']}"
+    return f"addr:{scope['client'][0] if scope.get('client') else ''}"
+
+def request_priority(path: str) -> str:
+    return 'bulk' if path.startswith(SCHED_BULK_PATHS) else 'interactive'
+
+def wait_p95(waits) -> Optional[float]:
+    if not waits:
+        return None
+    ordered = sorted(waits)
+    return round(ordered[math.ceil(0.95 * len(ordered)) - 1], 4)
+
+class ClientBuckets:
+    """Token bucket per client key: SCHED_CLIENT_RATE analysis requests a second, bursts of SCHED_CLIENT_BURST."""
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = max(1.0, burst)
+        self.buckets = {}  # client -> (tokens, monotonic time of the last update)
+        self.limited = dict.fromkeys(SCHED_CLASSES, 0)
+
+    def take(self, client: str, priority: str) -> float:
+        """0 if client may send a request now (and charge it), else seconds until it may."""
+        if self.rate <= 0:
+            return 0.0
+        now = time.monotonic()
+        tokens, updated = self.buckets.get(client, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - updated) * self.rate)
+        if tokens < 1:
+            self.buckets[client] = (tokens, now)
+            self.limited[priority] += 1
+            metrics.rejections.inc(priority, 'rate_limited')
+            return (1 - tokens) / self.rate
+        self.buckets[client] = (tokens - 1, now)
+        if len(self.buckets) > SCHED_MAX_BUCKETS:
+            # A bucket that has refilled is the same as no bucket
+            self.buckets = {
+                c: (t, u) for c, (t, u) in self.buckets.items() if t + (now - u) * self.rate < self.burst
+            }
+        return 0.0
+
+    def snapshot(self) -> dict:
+        return {'clients': len(self.buckets), 'rate': self.rate, 'burst': self.burst, 'rateLimited': dict(self.limited)}
+
+client_buckets = ClientBuckets(SCHED_CLIENT_RATE, SCHED_CLIENT_BURST)
+
+class FairQueue:
+    """Start-time fair queuing across clients: each client gets workers in proportion to its weight."""
+
+    def __init__(self):
+        self.heap = []     # (finish tag, sequence, start tag, waiter)
+        self.finish = {}   # client -> finish tag of its last queued analysis
+        self.virtual = 0.0
+        self.sequence = 0
+        self.waiting = 0
+
+    def push(self, client: str, cost: float, waiter: asyncio.Future):
+        start = max(self.virtual, self.finish.get(client, 0.0))
+        finish = self.finish[client] = start + cost / SCHED_CLIENT_WEIGHTS.get(client, 1.0)
+        self.sequence += 1
+        heapq.heappush(self.heap, (finish, self.sequence, start, waiter))
+        self.waiting += 1
+
+    def pop(self) -> Optional[asyncio.Future]:
+        """The next live waiter; cancelled ones were already uncounted and are dropped here."""
+        while self.heap:
+            _, _, start, waiter = heapq.heappop(self.heap)
+            if not waiter.done():
+                self.virtual = start
+                self.waiting -= 1
+                return waiter
+        # Every client is idle, so none has a backlog left to account for
+        self.finish.clear()
+        self.virtual = 0.0
+        return None
+
+class FairSchedulingMiddleware:
+    """Tags each /api request with its priority class and client, and rate limits analysis requests per client."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] not in ('http', 'websocket') or not scope['path'].startswith('/api/'):
+            return await self.app(scope, receive, send)
+        priority, client = request_priority(scope['path']), client_key(scope)
+        # Only new work is charged; GETs such as job status polls are not
+        if scope['path'] in SCHED_RATED_PATHS and (scope['type'] == 'websocket' or scope['method'] == 'POST'):
+            wait = client_buckets.take(client, priority)
+            if wait > 0:
+                if scope['type'] == 'websocket':
+                    return await send({'type': 'websocket.close', 'code': WS_TRY_AGAIN})
+                response = Response(
+                    dump_json({'detail': 'Too many analysis requests from this client'}), status_code=429,
+                    media_type='application/json', headers={'Retry-After': str(math.ceil(wait))}
+                )
+                return await response(scope, receive, send)
+        token = analysis_context.set((priority, client))
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            analysis_context.reset(token)
+
+def scheduler_snapshot() -> dict:
+    lanes = (analysis_pool.small, analysis_pool.large)
+    interactive = [wait for lane in lanes for wait in lane.waits['interactive']]
+    return {
+        **client_buckets.snapshot(), 'interactiveReserve': SCHED_INTERACTIVE_RESERVE,
+        'interactiveTargetSeconds': SCHED_INTERACTIVE_TARGET, 'interactiveP95WaitSeconds': wait_p95(interactive),
+        'weightedClients': len(SCHED_CLIENT_WEIGHTS)
+    }
+
+# ─── Worker Pool ───
+# analyze_code is CPU-bound, so it runs in worker processes instead of on the
+# event loop. Small inputs get their own lane so they never queue behind large
+# files. Each lane schedules its workers as described under Fair Scheduling
+# and rejects work with 429 once a priority class's queue is full.
+
+def _worker_source(payload) -> str:
+    """Source text sent to a worker, either inline or as a (name, size) shared memory segment."""
+    if isinstance(payload, str):
+        return payload
+    shm_name, size = payload
+    # Spawned workers share the parent's resource tracker, which unlinks the segment
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        return bytes(shm.buf[:size]).decode('utf-8', 'surrogatepass')
+    finally:
+        shm.close()
+
+def _analyze_in_worker(payload, filename: str, rules: Optional[dict] = None) -> Tuple[dict, dict]:
+    return budgeted_analysis(_worker_source(payload), filename, rules)
+
+def _degraded_in_worker(payload, filename: str, reason: str) -> Tuple[dict, dict]:
+    started = time.perf_counter()
+    result = degraded_result(_worker_source(payload), filename, reason, budget_detail(reason))
+    return result, {'degraded': time.perf_counter() - started}
+
+class PoolLane:
+    def __init__(self, name: str, workers: int, queue_size: int):
+        self.name = name
+        self.workers = workers
+        # workers=0 runs analyses in threads of this process, one at a time per lane
+        self.slots = max(1, workers)
+        self.bulk_slots = max(1, self.slots - SCHED_INTERACTIVE_RESERVE)
+        self.queue_size = queue_size
+        self.pending = 0
+        self.rejected = 0
+        self.restarts = 0
+        self.avg_seconds = 0.05
+        self.executor = None
+        self.queues = {priority: FairQueue() for priority in SCHED_CLASSES}
+        self.running = dict.fromkeys(SCHED_CLASSES, 0)
+        self.stats = {priority: {'admitted': 0, 'rejected': 0} for priority in SCHED_CLASSES}
+        self.waits = {priority: deque(maxlen=SCHED_WAIT_WINDOW) for priority in SCHED_CLASSES}
+
+    def start(self):
+        if self.workers > 0:
+            self.executor = ProcessPoolExecutor(
+                max_workers=self.workers, mp_context=multiprocessing.get_context('spawn'),
+                initializer=init_analysis_worker
+            )
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
+
+    def retry_after(self) -> int:
+        return max(1, math.ceil(self.avg_seconds * self.pending / self.slots))
+
+    def _may_start(self, priority: str) -> bool:
+        if sum(self.running.values()) >= self.slots:
+            return False
+        return priority == 'interactive' or (
+            not self.queues['interactive'].waiting and self.running['bulk'] < self.bulk_slots
+        )
+
+    def _dispatch(self):
+        """Hand free workers to waiting analyses, interactive ones first."""
+        while sum(self.running.values()) < self.slots:
+            priority, waiter = 'interactive', self.queues['interactive'].pop()
+            if waiter is None and self.running['bulk'] < self.bulk_slots:
+                priority, waiter = 'bulk', self.queues['bulk'].pop()
+            if waiter is None:
+                return
+            self.running[priority] += 1
+            waiter.set_result(None)
+
+    async def _acquire(self, priority: str, client: str, cost: float):
+        """Wait for a worker of this lane, in priority and fair-queue order."""
+        queue = self.queues[priority]
+        enqueued = time.monotonic()
+        if not queue.waiting and self._may_start(priority):
+            self.running[priority] += 1
+        elif queue.waiting >= self.queue_size:
+            self.rejected += 1
+            self.stats[priority]['rejected'] += 1
+            metrics.rejections.inc(priority, 'queue_full')
+            raise HTTPException(
+                status_code=429, detail=f"Analysis queue '{self.name}' is full",
+                headers={'Retry-After': str(self.retry_after())}
+            )
+        else:
+            waiter = asyncio.get_running_loop().create_future()
+            queue.push(client, cost, waiter)
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                if waiter.done() and not waiter.cancelled():
+                    # Granted a worker just as the caller went away
+                    self._release(priority)
+                else:
+                    waiter.cancel()
+                    queue.waiting -= 1
+                raise
+        wait = time.monotonic() - enqueued
+        self.stats[priority]['admitted'] += 1
+        self.waits[priority].append(wait)
+        metrics.queue_wait.observe(wait, self.name, priority)
+
+    def _release(self, priority: str):
+        self.running[priority] -= 1
+        self._dispatch()
+
+    async def submit(self, fn, payload, *args, cost: float = 1.0):
+        priority, client = analysis_context.get()
+        self.pending += 1
+        try:
+            await self._acquire(priority, client, cost)
+        except BaseException:
+            self.pending -= 1
+            raise
+        started = time.monotonic()
+        executor = self.executor
+        try:
+            loop = asyncio.get_running_loop()
+            # workers=0 runs in a thread of the current process (development and tests)
+            if executor is None:
+                return await loop.run_in_executor(None, fn, payload, *args)
+            value, hits, misses = await loop.run_in_executor(executor, _with_memo_counts, fn, payload, *args)
+            span_memo_stats['hits'] += hits
+            span_memo_stats['misses'] += misses
+            return value
+        except BrokenProcessPool:
+            # Every call in flight on the broken pool ends up here. Only the first replaces it;
+            # there is no await between the check and the swap, so a later caller cannot shut
+            # down the replacement and cancel the work already queued on it.
+            if self.executor is executor:
+                logger.error("Analysis lane '%s' lost a worker; restarting pool", self.name)
+                self.restarts += 1
+                self.shutdown()
+                self.start()
+            # Running past budget plus grace means RLIMIT_CPU most likely killed the worker over this input
+            if ANALYSIS_CPU_BUDGET > 0 and time.monotonic() - started >= ANALYSIS_CPU_BUDGET + ANALYSIS_CPU_GRACE:
+                raise AnalysisBudgetExceeded()
+            raise HTTPException(status_code=503, detail="Analysis worker crashed", headers={'Retry-After': '1'})
+        finally:
+            self.pending -= 1
+            self._release(priority)
+            self.avg_seconds = 0.8 * self.avg_seconds + 0.2 * (time.monotonic() - started)
+
+    def snapshot(self) -> dict:
+        return {
+            'workers': self.workers, 'bulkWorkers': self.bulk_slots, 'queueSize': self.queue_size,
+            'pending': self.pending,
+            'rejected': self.rejected, 'restarts': self.restarts, 'avgSeconds': round(self.avg_seconds, 4),
+            'classes': {
+                priority: {
+                    'running': self.running[priority], 'queued': self.queues[priority].waiting,
+                    **self.stats[priority], 'p95WaitSeconds': wait_p95(self.waits[priority])
+                } for priority in SCHED_CLASSES
+            }
+        }
+
+class AnalysisPool:
+    def __init__(self):
+        workers = int(os.environ.get('ANALYSIS_WORKERS', str(max(1, (os.cpu_count() or 2) - 1))))
+        queue_size = int(os.environ.get('ANALYSIS_QUEUE_SIZE', str(max(1, workers) * 4)))
+        self.small_bytes = int(os.environ.get('ANALYSIS_SMALL_BYTES', '65536'))
+        self.shm_bytes = int(os.environ.get('ANALYSIS_SHM_BYTES', '262144'))
+        self.small = PoolLane('small', min(workers, int(os.environ.get('ANALYSIS_SMALL_WORKERS', '1'))), queue_size)
+        self.large = PoolLane('large', workers, queue_size)
+
+    def start(self):
+        self.small.start()
+        self.large.start()
+
+    def shutdown(self):
+        self.small.shutdown()
+        self.large.shutdown()
+
+    async def call(self, fn, code: str, *args):
+        """Run fn(payload, *args) in the lane for code's size; fn reads the source with _worker_source."""
+        lane = self.small if len(code) < self.small_bytes else self.large
+        cost = 1.0 + len(code) / SCHED_COST_BYTES
+        if lane.executor is None or len(code) < self.shm_bytes:
+            return await lane.submit(fn, code, *args, cost=cost)
+        # Large sources go through shared memory: one copy in, nothing pickled through the call queue
+        data = code.encode('utf-8', 'surrogatepass')
+        shm = shared_memory.SharedMemory(create=True, size=max(1, len(data)))
+        try:
+            shm.buf[:len(data)] = data
+            return await lane.submit(fn, (shm.name, len(data)), *args, cost=cost)
+        finally:
+            shm.close()
+            shm.unlink()
+
+    async def run(self, code: str, filename: str, rules: Optional[dict] = None) -> Tuple[dict, dict]:
+        """(result, analyze_code stage timings) from a worker process; may be a degraded summary."""
+        return await self.call(_analyze_in_worker, code, filename, rules)
+
+    async def run_degraded(self, code: str, filename: str, reason: str) -> Tuple[dict, dict]:
+        return await self.call(_degraded_in_worker, code, filename, reason)
+
+    def snapshot(self) -> dict:
+        return {'small': self.small.snapshot(), 'large': self.large.snapshot()}
+
+analysis_pool = AnalysisPool()
+
+POOL_RETRIES = 3
+
+async def analyze_with_retry(code: str, filename: str, rules: Optional[dict] = None) -> dict:
+    """Bulk-work entry point: waits out a full pool queue and turns failures into an error dict."""
+    for attempt in range(POOL_RETRIES + 1):
+        try:
+            return await analyze_cached(code, filename, rules)
+        except HTTPException as e:
+            # A full pool queue is transient for bulk work; wait as the server asks
+            if e.status_code != 429 or attempt == POOL_RETRIES:
+                metrics.errors.inc(f"item_http_{e.status_code}")
+                return {'error': e.detail}
+            await asyncio.sleep(float((e.headers or {}).get('Retry-After', 1)))
+        except Exception as e:
+            logger.exception("Analysis of %s failed", filename)
+            metrics.errors.inc('item_exception')
+            return {'error': str(e) or type(e).__name__}
+
+# ─── Metric Distributions ───
+# Rollups over many files keep one compact column per metric instead of the
+# per-function result dicts. Halstead measures and MI are computed from the
+# count columns in one vectorized step (the same formulas as
+# halstead_from_counts and compute_maintainability_index), then summarized
+# as percentiles, fixed-edge histograms and z-score outliers.
+
+OUTLIER_Z = float(os.environ.get('ROLLUP_OUTLIER_Z', '3'))
+ROLLUP_OUTLIERS = 20
+DISTRIBUTION_PERCENTILES = (10, 25, 50, 75, 90, 99)
+# Fixed edges so histograms from different repositories and batches line up
+HISTOGRAM_EDGES = {
+    'cyclomaticComplexity': (1, 2, 3, 4, 6, 11, 21, 51),
+    'maintainabilityIndex': (0, 20, 40, 60, 80),
+    'loc': (0, 5, 10, 25, 50, 100, 250, 500, 1000),
+    'volume': (0, 10, 100, 1000, 10000, 100000),
+    'difficulty': (0, 1, 5, 10, 20, 50, 100),
+    'effort': (0, 100, 1000, 10000, 100000, 1000000, 10000000),
+}
+
+def halstead_columns(n1: np.ndarray, n2: np.ndarray, N1: np.ndarray, N2: np.ndarray) -> dict:
+    """Vectorized halstead_from_counts over count columns (unrounded)."""
+    vocabulary = n1 + n2
+    length = N1 + N2
+    with np.errstate(divide='ignore', invalid='ignore'):
+        volume = np.where((length > 0) & (vocabulary > 0), length * np.log2(vocabulary), 0.0)
+        difficulty = np.where(n2 > 0, (n1 / 2) * (N2 / n2), 0.0)
+    effort = volume * difficulty
+    return {'volume': volume, 'difficulty': difficulty, 'effort': effort, 'time': effort / 18, 'bugs': volume / 3000}
+
+def maintainability_columns(volume: np.ndarray, cc: np.ndarray, loc: np.ndarray) -> np.ndarray:
+    """Vectorized compute_maintainability_index (unrounded)."""
+    valid = (loc > 0) & (volume > 0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mi = 171 - 5.2 * np.log(volume) - 0.23 * cc - 16.2 * np.log(loc)
+    return np.where(valid, np.clip(mi * 100 / 171, 0, 100), 100.0)
+
+def histogram(values: np.ndarray, edges: tuple) -> list:
+    """Counts per [lo, hi) bucket; the last bucket is open-ended (hi null)."""
+    indexes = np.searchsorted(np.asarray(edges, dtype=float), values, side='right') - 1
+    counts = np.bincount(np.clip(indexes, 0, len(edges) - 1), minlength=len(edges))
+    highs = list(edges[1:]) + [None]
+    return [{'lo': lo, 'hi': hi, 'count': int(count)} for lo, hi, count in zip(edges, highs, counts)]
+
+def distribution(values: np.ndarray, edges: tuple) -> dict:
+    if not len(values):
+        return {'count': 0}
+    percentiles = np.percentile(values, DISTRIBUTION_PERCENTILES)
+    return {
+        'count': int(len(values)), 'mean': round(float(values.mean()), 2), 'std': round(float(values.std()), 2),
+        'min': round(float(values.min()), 2), 'max': round(float(values.max()), 2),
+        **{f"p{p}": round(float(v), 2) for p, v in zip(DISTRIBUTION_PERCENTILES, percentiles)},
+        'histogram': histogram(values, edges)
+    }
+
+class MetricColumns:
+    """Per-function count, CC and LOC columns across files, for vectorized metrics and distributions."""
+
+    def __init__(self):
+        self.columns = {name: array('q') for name in ('n1', 'n2', 'N1', 'N2', 'cc', 'loc')}
+        self.paths = []       # one per file
+        self.file_index = array('l')
+        self.names = []
+        self.start_lines = array('l')
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def add(self, path: str, result: dict):
+        file_index = len(self.paths)
+        self.paths.append(path)
+        c = self.columns
+        for fn in result['functions']:
+            h = fn['halstead']
+            c['n1'].append(h['uniqueOperators'])
+            c['n2'].append(h['uniqueOperands'])
+            c['N1'].append(h['totalOperators'])
+            c['N2'].append(h['totalOperands'])
+            c['cc'].append(fn['cyclomaticComplexity'])
+            c['loc'].append(fn['loc'])
+            self.file_index.append(file_index)
+            self.names.append(fn['name'])
+            self.start_lines.append(fn['startLine'])
+
+    def compute(self) -> dict:
+        """All per-function metric columns, Halstead measures and MI included."""
+        c = {name: np.frombuffer(column, dtype=np.int64).astype(float) if len(column) else np.zeros(0)
+             for name, column in self.columns.items()}
+        metrics = halstead_columns(c['n1'], c['n2'], c['N1'], c['N2'])
+        metrics['maintainabilityIndex'] = maintainability_columns(metrics['volume'], c['cc'], c['loc'])
+        metrics['cyclomaticComplexity'] = c['cc']
+        metrics['loc'] = c['loc']
+        return metrics
+
+    def outliers(self, metrics: dict) -> list:
+        """Functions at least OUTLIER_Z standard deviations worse than the mean, the most extreme first."""
+        found = []
+        for name, sign in (('cyclomaticComplexity', 1), ('volume', 1), ('loc', 1), ('maintainabilityIndex', -1)):
+            values = metrics[name]
+            std = values.std()
+            if not std:
+                continue
+            z = sign * (values - values.mean()) / std
+            for i in np.flatnonzero(z >= OUTLIER_Z):
+                found.append((float(z[i]), name, int(i)))
+        found.sort(reverse=True)
+        return [{
+            'path': self.paths[self.file_index[i]], 'name': self.names[i], 'startLine': self.start_lines[i],
+            'metric': name, 'value': round(float(metrics[name][i]), 2), 'zScore': round(z, 2)
+        } for z, name, i in found[:ROLLUP_OUTLIERS]]
+
+    def summary(self) -> dict:
+        metrics = self.compute()
+        return {
+            'functions': len(self),
+            **{name: distribution(metrics[name], edges) for name, edges in HISTOGRAM_EDGES.items()},
+            'estimatedBugs': round(float(metrics['bugs'].sum()), 3),
+            'outliers': self.outliers(metrics)
+        }
+
+# ─── Archive Ingestion ───
+# Repository archives are read member by member from the request body; only a
+# bounded window of member sources is held in memory at any time.
+
+ARCHIVE_MAX_FILE_BYTES = int(os.environ.get('ARCHIVE_MAX_FILE_BYTES', str(1024 * 1024)))
+ARCHIVE_SPOOL_BYTES = int(os.environ.get('ARCHIVE_SPOOL_BYTES', str(8 * 1024 * 1024)))
+ARCHIVE_WORST_FUNCTIONS = 10
+ROLLUP_CLONE_PAIRS = 20
+# Fingerprints a rollup indexes for cross-file clones; later files are still matched, just not indexed
+ROLLUP_CLONE_FINGERPRINTS = int(os.environ.get('ROLLUP_CLONE_FINGERPRINTS', '500000'))
+
+async def _next_chunk(chunks):
+    return await chunks.__anext__()
+
+class _AsyncBodyReader(io.RawIOBase):
+    """Blocking file object over an async byte stream, for use from a worker thread."""
+
+    def __init__(self, chunks, loop):
+        self._chunks = chunks.__aiter__()
+        self._loop = loop
+        self._buf = b''
+        self._eof = False
+
+    def readable(self):
+        return True
+
+    def _fill(self) -> bool:
+        if self._eof:
+            return False
+        try:
+            chunk = asyncio.run_coroutine_threadsafe(_next_chunk(self._chunks), self._loop).result()
+        except StopAsyncIteration:
+            self._eof = True
+            return False
+        self._buf += chunk
+        return True
+
+    def peek(self, n: int) -> bytes:
+        while len(self._buf) < n and self._fill():
+            pass
+        return self._buf[:n]
+
+    def readinto(self, b) -> int:
+        while not self._buf and self._fill():
+            pass
+        n = min(len(b), len(self._buf))
+        b[:n] = self._buf[:n]
+        self._buf = self._buf[n:]
+        return n
+
+def _iter_archive_members(reader: _AsyncBodyReader):
+    """Yield (path, data) for supported source files; data is None when the member is skipped."""
+    if reader.peek(4)[:2] == b'PK':
+        # The zip central directory sits at the end, so zips need a seekable spool
+        spool = tempfile.SpooledTemporaryFile(max_size=ARCHIVE_SPOOL_BYTES)
+        shutil.copyfileobj(reader, spool)
+        spool.seek(0)
+        with spool, zipfile.ZipFile(spool) as zf:
+            for info in zf.infolist():
+                if info.is_dir() or detect_language(info.filename) == 'unknown':
+                    continue
+                if info.file_size > ARCHIVE_MAX_FILE_BYTES:
+                    yield info.filename, None
+                    continue
+                with zf.open(info) as f:
+                    yield info.filename, f.read()
+        return
+    with tarfile.open(fileobj=reader, mode='r|*') as tf:
+        for member in tf:
+            if not member.isfile() or detect_language(member.name) == 'unknown':
+                continue
+            if member.size > ARCHIVE_MAX_FILE_BYTES:
+                yield member.name, None
+                continue
+            yield member.name, tf.extractfile(member).read()
+
+def _read_archive(reader: _AsyncBodyReader, loop, members: asyncio.Queue, stop: threading.Event, consumers: int):
+    try:
+        for path, data in _iter_archive_members(reader):
+            if stop.is_set():
+                return
+            item = (path, data.decode('utf-8', 'replace') if data is not None else None)
+            # Blocks while the window is full, which in turn stops reading the body
+            asyncio.run_coroutine_threadsafe(members.put(item), loop).result()
+    finally:
+        if not stop.is_set():
+            for _ in range(consumers):
+                asyncio.run_coroutine_threadsafe(members.put(None), loop).result()
+
+class RepoRollup:
+    """Repository-level aggregate; per file it keeps only counters and a few numbers per function."""
+
+    def __init__(self):
+        self.files = 0
+        self.skipped = 0
+        self.errors = 0
+        self.loc = 0
+        self.sloc = 0
+        self.functions = 0
+        self.issues = 0
+        self.cc_total = 0
+        self.mi_total = 0.0
+        # MI is rounded to 2 decimals in [0, 100], so 10001 buckets give exact percentiles
+        self.mi_histogram = [0] * 10001
+        self.worst = []  # min-heap of (cc, -mi, seq, entry), capped at ARCHIVE_WORST_FUNCTIONS
+        self._seq = 0
+        self.columns = MetricColumns()
+        self.clones = CloneIndex(ROLLUP_CLONE_FINGERPRINTS)
+        self.clone_pairs = []  # min-heap of (similarity, seq, entry), capped at ROLLUP_CLONE_PAIRS
+        self.clone_count = 0
+
+    def add(self, path: str, result: dict):
+        summary = result['summary']
+        self.files += 1
+        self.loc += summary['loc']
+        self.sloc += summary['sloc']
+        self.functions += summary['functionCount']
+        self.issues += len(result['linterIssues'])
+        self.cc_total += summary['cyclomaticComplexity']
+        self.mi_total += summary['maintainabilityIndex']
+        self.mi_histogram[int(round(summary['maintainabilityIndex'] * 100))] += 1
+        self.columns.add(path, result)
+        for fn in result['functions']:
+            self._seq += 1
+            key = (fn['cyclomaticComplexity'], -fn['maintainabilityIndex'], self._seq)
+            if len(self.worst) < ARCHIVE_WORST_FUNCTIONS or key > self.worst[0][:3]:
+                entry = {
+                    'path': path, 'name': fn['name'], 'startLine': fn['startLine'],
+                    'cyclomaticComplexity': fn['cyclomaticComplexity'],
+                    'maintainabilityIndex': fn['maintainabilityIndex'], 'loc': fn['loc']
+                }
+                if len(self.worst) < ARCHIVE_WORST_FUNCTIONS:
+                    heapq.heappush(self.worst, (*key, entry))
+                else:
+                    heapq.heapreplace(self.worst, (*key, entry))
+        self.add_clones(path, result)
+
+    def add_clones(self, path: str, result: dict):
+        """Match each function against the functions of earlier files, then index the file's own.
+
+        Clones within one file are reported by the duplicate-logic rule instead.
+        """
+        threshold = RULES['duplicate-logic'].thresholds['min']
+        indexed = []
+        for fn, fps in zip(result['functions'], result.get('cloneFingerprints') or ()):
+            if not fps:
+                continue
+            own = (path, fn['name'], fn['startLine'])
+            indexed.append((fps, own))
+            match = self.clones.best(fps)
+            if match is None or match[0] < threshold:
+                continue
+            score, other = match
+            self.clone_count += 1
+            self._seq += 1
+            if len(self.clone_pairs) < ROLLUP_CLONE_PAIRS or score > self.clone_pairs[0][0]:
+                entry = {
+                    'similarity': score,
+                    'functions': [{'path': p, 'name': name, 'startLine': line} for p, name, line in (other, own)]
+                }
+                if len(self.clone_pairs) < ROLLUP_CLONE_PAIRS:
+                    heapq.heappush(self.clone_pairs, (score, -self._seq, entry))
+                else:
+                    heapq.heapreplace(self.clone_pairs, (score, -self._seq, entry))
+        for fps, own in indexed:
+            self.clones.add(fps, own)
+
+    def mi_percentile(self, pct: float) -> Optional[float]:
+        if not self.files:
+            return None
+        rank = max(1, math.ceil(pct / 100 * self.files))
+        seen = 0
+        for bucket, count in enumerate(self.mi_histogram):
+            seen += count
+            if seen >= rank:
+                return bucket / 100
+        return 100.0
+
+    def snapshot(self) -> dict:
+        return {
+            'files': self.files, 'skipped': self.skipped, 'errors': self.errors,
+            'loc': self.loc, 'sloc': self.sloc, 'functionCount': self.functions, 'issueCount': self.issues,
+            'meanCyclomaticComplexity': round(self.cc_total / self.files, 2) if self.files else 0,
+            'maintainabilityIndex': {
+                'mean': round(self.mi_total / self.files, 2) if self.files else None,
+                'p10': self.mi_percentile(10), 'p50': self.mi_percentile(50), 'p90': self.mi_percentile(90)
+            },
+            'worstFunctions': [entry for *_, entry in sorted(self.worst, reverse=True)],
+            'functionMetrics': self.columns.summary(),
+            'clones': {
+                'pairs': self.clone_count, 'indexedFunctions': len(self.clones), 'truncated': self.clones.truncated,
+                'top': [entry for *_, entry in sorted(self.clone_pairs, reverse=True)]
+            }
+        }
+
+async def _archive_consumer(members: asyncio.Queue, out: asyncio.Queue, rollup: RepoRollup):
+    while True:
+        item = await members.get()
+        if item is None:
+            return
+        path, code = item
+        if code is None:
+            rollup.skipped += 1
+            await out.put({'filename': path, 'skipped': f"larger than {ARCHIVE_MAX_FILE_BYTES} bytes"})
+            continue
+        result = await analyze_with_retry(code, path)
+        if 'error' in result:
+            rollup.errors += 1
+            await out.put({'filename': path, **result})
+            continue
+        rollup.add(path, result)
+        await out.put({
+            'filename': path, 'language': result['language'], 'summary': result['summary'],
+            'issueCount': len(result['linterIssues'])
+        })
+
+class DuplexStreamingResponse(StreamingResponse):
+    """StreamingResponse that leaves receive() to the body iterator.
+
+    The stock response listens for disconnects on receive(), which would swallow
+    request body chunks the iterator is still reading.
+    """
+
+    async def __call__(self, scope, receive, send):
+        await self.stream_response(send)
+        if self.background is not None:
+            await self.background()
+
+async def stream_archive_analysis(chunks):
+    """NDJSON lines: one per source file as it completes, then a final {"rollup": ...} line."""
+    loop = asyncio.get_running_loop()
+    consumers = max(1, analysis_pool.small.workers + analysis_pool.large.workers) * 2
+    members = asyncio.Queue(maxsize=consumers)
+    out = asyncio.Queue()
+    stop = threading.Event()
+    rollup = RepoRollup()
+    reader = loop.run_in_executor(
+        None, _read_archive, _AsyncBodyReader(chunks, loop), loop, members, stop, consumers
+    )
+    workers = [asyncio.ensure_future(_archive_consumer(members, out, rollup)) for _ in range(consumers)]
+    done = asyncio.ensure_future(asyncio.gather(*workers))
+    done.add_done_callback(lambda _: out.put_nowait(None))
+    try:
+        while (line := await out.get()) is not None:
+            yield json.dumps(line, separators=(',', ':')) + '\n'
+        await done
+        try:
+            await reader
+        except (tarfile.TarError, zipfile.BadZipFile, EOFError, OSError) as e:
+            yield json.dumps({'error': f"Unreadable archive: {e}"}) + '\n'
+        yield json.dumps({'rollup': await asyncio.to_thread(rollup.snapshot)}, separators=(',', ':')) + '\n'
+    finally:
+        stop.set()
+        done.cancel()
+        # The gather ends with the consumers' CancelledError; retrieve it so it is not logged as lost
+        done.add_done_callback(lambda future: future.cancelled() or future.exception())
+        # Unblock the reader thread if it is waiting on a full window
+        while not members.empty():
+            members.get_nowait()
+
+# ─── Streaming Ingestion ───
+# A raw source body is analyzed while it arrives. The API process buffers text
+# until it reaches a cut: a line start where no function, comment, string or
+# bracket is open. Workers analyze everything before the cut with the regular
+# extractors and span facts, so only the open tail of the source (at least the
+# largest function) is ever held in memory. Python always uses the regex
+# scanner here; the ast engine needs the whole module.
+
+STREAM_CHUNK_BYTES = int(os.environ.get('STREAM_CHUNK_BYTES', str(256 * 1024)))
+STREAM_MAX_BYTES = int(os.environ.get('STREAM_MAX_BYTES', str(256 * 1024 * 1024)))
+
+def _js_stream_cut(code: str) -> int:
+    """Last line start in code outside every function body and scanner token (0 if none).
+
+    Mirrors extract_js_functions. Only line starts before the final scanner
+    token count, since that token may continue in text not received yet.
+    """
+    stack = []          # per open '{': True when it opens a function body
+    body_braces = set()
+    open_functions = 0
+    cut = 0
+    prev_end = 0
+    for m in _JS_SCAN_RE.finditer(code):
+        if not open_functions and not body_braces:
+            # The last newline between two tokens while no function is open or pending
+            newline = code.rfind('\n', prev_end, m.start())
+            if newline >= 0:
+                cut = newline + 1
+        prev_end = m.end()
+        kind = m.lastgroup
+        if kind == 'brace' or kind == 'regex':
+            ch = code[m.start()]
+            if ch == '{':
+                is_body = m.start() in body_braces
+                body_braces.discard(m.start())
+                stack.append(is_body)
+                open_functions += is_body
+            elif ch == '}' and stack:
+                open_functions -= stack.pop()
+        elif kind != 'comment' and kind != 'string':
+            if kind == 'method' and m.group('method_name') in JS_NON_FUNCTION_NAMES:
+                continue
+            body = _JS_BODY_RE.match(code, m.end())
+            if body:
+                body_braces.add(body.end() - 1)
+    return cut
+
+def _py_stream_cut(code: str) -> int:
+    """Start of the last code line in code that closes every open def (0 if none); mirrors extract_py_functions."""
+    open_defs = []
+    depth = 0
+    cut = 0
+    for m in _PY_SCAN_RE.finditer(code):
+        kind = m.lastgroup
+        if kind == 'open':
+            depth += 1
+        elif kind == 'close':
+            depth = max(0, depth - 1)
+        elif (kind == 'indent' or kind == 'name' or kind == 'params') and not depth:
+            indent = len(m.group('indent'))
+            while open_defs and open_defs[-1] >= indent:
+                open_defs.pop()
+            if not open_defs:
+                cut = m.start()
+            if m.group('name') is not None:
+                open_defs.append(indent)
+    return cut
+
+def analyze_stream_chunk(payload, language: str, final: bool, base_line: int, base_id: int,
+                         rules: Optional[dict] = None) -> dict:
+    """Analyze the source up to its last cut (all of it when final) as the lines after base_line.
+
+    Returns the cut offset with the chunk's line counts, CC and Halstead counts,
+    and its function metrics and rule findings numbered from base_id; just
+    {'cut': 0} when a function is still open. Long lines and budget overruns
+    get degraded_stream_chunk instead.
+    """
+    code = _worker_source(payload)
+    if ANALYSIS_MAX_LINE_CHARS > 0 and longest_line(code) > ANALYSIS_MAX_LINE_CHARS:
+        return degraded_stream_chunk(code, language, final, 'long_line')
+    try:
+        return run_with_cpu_budget(_analyze_stream_chunk, code, language, final, base_line, base_id, rules)
+    except AnalysisBudgetExceeded:
+        if _budget_armed:
+            _reset_cpu_limit()
+        return degraded_stream_chunk(code, language, final, 'cpu_budget')
+
+def degraded_stream_chunk(payload, language: str, final: bool, reason: str) -> dict:
+    """Line counts and estimated CC and Halstead counts for all of the source, with no functions.
+
+    Without function spans there is no cut to look for; the source holds whole
+    lines unless final, so all of it is consumed.
+    """
+    code = _worker_source(payload)
+    lines = code.split('\n')
+    if not final:
+        lines.pop()
+    facts = estimate_facts(code, language)
+    return {
+        'cut': len(code), 'counts': line_counts(lines, language), **facts,
+        'functions': [], 'linterIssues': [], 'refactorSuggestions': [], 'degraded': reason
+    }
+
+def _analyze_stream_chunk(code: str, language: str, final: bool, base_line: int, base_id: int,
+                          rules: Optional[dict]) -> dict:
+    cut = len(code) if final else (_py_stream_cut(code) if language == 'python' else _js_stream_cut(code))
+    if not cut and not final:
+        return {'cut': 0}
+    chunk = code[:cut]
+    lines = chunk.split('\n')
+    if not final:
+        lines.pop()  # the chunk ends with a newline; the next chunk starts the following line
+    offsets = line_offsets(chunk)
+    if language == 'python':
+        functions = extract_py_functions(chunk, offsets)
+    else:
+        functions = extract_js_functions(chunk, offsets)
+    file_facts, fn_facts = collect_span_facts(chunk, language, functions, offsets)
+    function_metrics, fact_table = function_tables(functions, fn_facts)
+    for table in (function_metrics, fact_table):
+        for fn in table:
+            fn['id'] += base_id
+            if fn['parentId'] is not None:
+                fn['parentId'] += base_id
+            fn['startLine'] += base_line
+            fn['endLine'] += base_line
+    linter_issues, refactor_suggestions = apply_rules(fact_table, language, rules)
+    return {
+        'cut': cut, 'counts': line_counts(lines, language),
+        'cyclomaticComplexity': file_facts['cyclomaticComplexity'],
+        'operators': file_facts['operators'], 'operands': file_facts['operands'],
+        'functions': function_metrics, 'linterIssues': linter_issues, 'refactorSuggestions': refactor_suggestions
+    }
+
+class StreamAnalysis:
+    """Running totals of a streamed source: per-function results and Halstead counts, no source text."""
+
+    def __init__(self, language: str, filename: str):
+        self.language = language
+        self.filename = filename
+        self.counts = {'loc': 0, 'sloc': 0, 'blankLines': 0, 'commentLines': 0}
+        self.cc = 1
+        self.operators = {}
+        self.operands = {}
+        self.functions = []
+        self.issues = []
+        self.suggestions = []
+        self.chunks = 0
+        self.degraded = []
+
+    def add(self, chunk: dict):
+        self.chunks += 1
+        if 'degraded' in chunk:
+            self.degraded.append(chunk['degraded'])
+        for key, count in chunk['counts'].items():
+            self.counts[key] += count
+        self.cc += chunk['cyclomaticComplexity'] - 1
+        _merge_counts(self.operators, chunk['operators'])
+        _merge_counts(self.operands, chunk['operands'])
+        self.functions.extend(chunk['functions'])
+        self.issues.extend(chunk['linterIssues'])
+        self.suggestions.extend(chunk['refactorSuggestions'])
+
+    def result(self) -> dict:
+        result = assemble_result(
+            self.language, self.filename, self.counts, self.cc, halstead_from_counts(self.operators, self.operands),
+            self.functions, self.issues, self.suggestions
+        )
+        if self.degraded:
+            # Degraded chunks contribute estimated counts and no functions
+            result['degraded'] = {
+                'reason': self.degraded[0],
+                'detail': f"{len(self.degraded)} of {self.chunks} chunks summarized: {budget_detail(self.degraded[0])}"
+            }
+        return result
+
+async def analyze_stream(chunks, filename: str, rules: Optional[dict] = None) -> dict:
+    """Analyze a source arriving as an async stream of UTF-8 byte chunks."""
+    language = detect_language(filename)
+    if language == 'unknown':
+        return {'error': 'Unsupported language', 'language': 'unknown'}
+    decoder = codecs.getincrementaldecoder('utf-8')('replace')
+    analysis = StreamAnalysis(language, filename)
+    parts, size = [], 0
+    scan_at = STREAM_CHUNK_BYTES
+    received = 0
+    started = time.perf_counter()
+
+    async def analyze_chunk(text: str, final: bool) -> dict:
+        base = (analysis.counts['loc'], len(analysis.functions), rules)
+        try:
+            return await analysis_pool.call(analyze_stream_chunk, text, language, final, *base)
+        except AnalysisBudgetExceeded:
+            return await analysis_pool.call(degraded_stream_chunk, text, language, final, 'worker_killed')
+
+    async for data in chunks:
+        received += len(data)
+        if received > STREAM_MAX_BYTES:
+            metrics.errors.inc('too_large')
+            raise HTTPException(status_code=413, detail=f"Stream exceeds {STREAM_MAX_BYTES} bytes")
+        text = decoder.decode(data)
+        parts.append(text)
+        size += len(text)
+        if size < scan_at:
+            continue
+        buffer = ''.join(parts)
+        complete = buffer.rfind('\n') + 1  # only whole lines can be cut
+        chunk = {'cut': 0}
+        if complete:
+            chunk = await analyze_chunk(buffer[:complete], False)
+        if chunk['cut']:
+            analysis.add(chunk)
+            buffer = buffer[chunk['cut']:]
+            scan_at = len(buffer) + STREAM_CHUNK_BYTES
+        else:
+            # A function is still open; rescan once the buffer doubles so rescans stay linear overall
+            scan_at = 2 * len(buffer)
+        parts, size = [buffer], len(buffer)
+    buffer = ''.join(parts) + decoder.decode(b'', final=True)
+    analysis.add(await analyze_chunk(buffer, True))
+    record_stage('stream', time.perf_counter() - started)
+    metrics.input_lines.observe(analysis.counts['loc'], language)
+    result = analysis.result()
+    if 'degraded' in result:
+        note_degraded(result, received)
+    return {**result, 'streamed': {'chunks': analysis.chunks}}
+
+# ─── Incremental Analysis ───
+# Sources are kept by content digest so a client can send a unified diff
+# against a previous result instead of the whole file. Only the spans whose
+# text changed miss the span memo and get re-lexed.
+
+SOURCE_TTL = int(os.environ.get('ANALYSIS_SOURCE_TTL', '86400'))
+_HUNK_RE = re.compile(r'^@@ -(\d+)(?:,(\d+))? \+(\d+)(?:,(\d+))? @@')
+
+def apply_unified_diff(source: str, diff: str) -> Tuple[str, List[Tuple[int, int]]]:
+    """Apply a unified diff; return the new source and the changed line spans in it.
+
+    Raises ValueError when the diff does not apply cleanly.
+    """
+    old_lines = source.split('\n')
+    new_lines = []
+    spans = []
+    pos = 0  # index into old_lines
+    span = None
+    in_hunk = False
+    for raw in diff.split('\n'):
+        m = _HUNK_RE.match(raw)
+        if m:
+            start = int(m.group(1))
+            # A zero-length old range is anchored after line `start`
+            target = start if m.group(2) == '0' else start - 1
+            if target < pos or target > len(old_lines):
+                raise ValueError(f"hunk '{raw}' is out of order or out of range")
+            new_lines.extend(old_lines[pos:target])
+            pos = target
+            in_hunk = True
+            span = None
+            continue
+        if not in_hunk or raw.startswith('\\'):
+            continue  # file headers and "\ No newline at end of file"
+        tag, text = raw[:1] or ' ', raw[1:]
+        if tag == ' ':
+            if pos >= len(old_lines) or old_lines[pos] != text:
+                if not raw and pos >= len(old_lines):
+                    continue  # trailing newline of the diff text itself
+                raise ValueError(f"context mismatch at line {pos + 1}")
+            new_lines.append(text)
+            pos += 1
+            span = None
+            continue
+        if tag == '-':
+            if pos >= len(old_lines) or old_lines[pos] != text:
+                raise ValueError(f"removed line {pos + 1} does not match the source")
+            pos += 1
+            line = len(new_lines) + 1  # a deletion touches the line that now follows it
+        elif tag == '+':
+            new_lines.append(text)
+            line = len(new_lines)
+        else:
+            raise ValueError(f"unexpected diff line {raw[:40]!r}")
+        if span is None:
+            span = [line, line]
+            spans.append(span)
+        span[1] = max(span[1], line)
+    if not in_hunk:
+        raise ValueError("diff contains no hunks")
+    new_lines.extend(old_lines[pos:])
+    last = max(1, len(new_lines))
+    return '\n'.join(new_lines), [(min(a, last), min(b, last)) for a, b in spans]
+
+async def store_source(result_id: str, code: str, filename: str):
+    try:
+        await db.analysis_sources.replace_one(
+            {'_id': result_id},
+            {'_id': result_id, 'code': code, 'filename': filename, 'createdAt': datetime.now(timezone.utc)},
+            upsert=True
+        )
+    except Exception as e:
+        logger.warning("analysis_sources store failed: %s", e)
+
+# ─── Clone Index ───
+# Fingerprints of each source analyzed through /analyze or /analyze/incremental
+# are kept per content digest in clone_fingerprints, so later sources can be
+# checked against earlier ones. Every function also puts its CLONE_SKETCH
+# smallest fingerprints into the document's multikey-indexed sketch: functions
+# with mostly the same fingerprints share most of their smallest ones, so one
+# $in query over a source's sketch finds the sources that may hold its clones.
+
+CLONE_SKETCH = 8
+CLONE_INDEX_TTL = int(os.environ.get('CLONE_INDEX_TTL', str(30 * 24 * 3600)))
+CLONE_CANDIDATE_FILES = int(os.environ.get('CLONE_CANDIDATE_FILES', '200'))
+CLONE_QUERY_KEYS = 4096
+
+def clone_document(result: dict) -> dict:
+    functions = [
+        {'id': fn['id'], 'name': fn['name'], 'startLine': fn['startLine'], 'fps': fps}
+        for fn, fps in zip(result['functions'], result.get('cloneFingerprints') or ()) if fps
+    ]
+    return {
+        'filename': result['filename'], 'language': result['language'], 'version': ANALYZER_VERSION,
+        'functions': functions, 'sketch': sorted({fp for fn in functions for fp in fn['fps'][:CLONE_SKETCH]})
+    }
+
+async def store_clone_fingerprints(result_id: str, result: dict):
+    try:
+        await db.clone_fingerprints.update_one(
+            {'_id': result_id},
+            {'$setOnInsert': clone_document(result), '$set': {'createdAt': datetime.now(timezone.utc)}},
+            upsert=True
+        )
+    except Exception as e:
+        logger.warning("clone_fingerprints store failed: %s", e)
+
+def score_clones(functions: list, candidates: list, min_similarity: float) -> list:
+    """(similarity, own function, candidate document, candidate function) at least min_similarity alike."""
+    index = CloneIndex()
+    for fn in functions:
+        index.add(fn['fps'], fn)
+    found = []
+    for doc in candidates:
+        for other in doc['functions']:
+            for score, own in index.matches(other['fps'], min_similarity):
+                found.append((score, own, doc, other))
+    found.sort(key=lambda m: (-m[0], m[1]['startLine'], m[2]['_id'], m[3]['startLine']))
+    return found
+
+async def find_clones(result_id: str, min_similarity: float, limit: int) -> Optional[dict]:
+    """Functions of other indexed sources that duplicate the functions of result_id; None when it is not indexed."""
+    doc = await db.clone_fingerprints.find_one({'_id': result_id, 'version': ANALYZER_VERSION})
+    if doc is None:
+        return None
+    candidates = []
+    if doc['sketch']:
+        candidates = await db.clone_fingerprints.find(
+            {'sketch': {'$in': doc['sketch'][:CLONE_QUERY_KEYS]}, '_id': {'$ne': result_id}, 'version': ANALYZER_VERSION},
+            {'sketch': 0}
+        ).limit(CLONE_CANDIDATE_FILES).to_list(CLONE_CANDIDATE_FILES)
+    found = await asyncio.to_thread(score_clones, doc['functions'], candidates, min_similarity)
+    return {
+        'resultId': result_id, 'filename': doc['filename'], 'candidateFiles': len(candidates), 'count': len(found),
+        'clones': [{
+            'similarity': score,
+            'function': {'id': own['id'], 'name': own['name'], 'startLine': own['startLine']},
+            'match': {
+                'resultId': other_doc['_id'], 'filename': other_doc['filename'],
+                'id': other['id'], 'name': other['name'], 'startLine': other['startLine']
+            }
+        } for score, own, other_doc, other in found[:limit]]
+    }
+
+# ─── History Writer ───
+# History records are written behind the response: endpoints enqueue them and a
+# background task batches them into insert_many by size or time. While Mongo is
+# unreachable records stay queued up to HISTORY_MAX_QUEUE; beyond that the
+# oldest spill to a JSON-lines file (when HISTORY_SPILL_PATH is set, up to
+# HISTORY_SPILL_MAX_BYTES) or are dropped. Spilled records are replayed after
+# the next successful flush. Records use their id as _id, so a retried batch
+# that was partly written cannot duplicate them.
+
+class HistoryWriter:
+    def __init__(self, batch_size: int, flush_interval: float, max_queue: int,
+                 spill_path: str, spill_max_bytes: int, shutdown_timeout: float):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_queue = max_queue
+        self.spill_path = spill_path
+        self.spill_max_bytes = spill_max_bytes
+        self.shutdown_timeout = shutdown_timeout
+        self._queue = []
+        self._full = None
+        self._lock = None
+        self._task = None
+        self._retry_delay = 0.0
+        self.stats = {
+            'enqueued': 0, 'written': 0, 'dropped': 0, 'spilled': 0, 'replayed': 0,
+            'flushes': 0, 'failures': 0, 'lastFlushSeconds': 0.0, 'maxFlushSeconds': 0.0
+        }
+        self._flush_seconds_total = 0.0
+
+    def start(self):
+        self._full = asyncio.Event()
+        self._lock = asyncio.Lock()
+        self._task = asyncio.ensure_future(self._run())
+
+    def add(self, record: dict):
+        self._queue.append({'_id': record['id'], **record})
+        self.stats['enqueued'] += 1
+        self._shed()
+        if len(self._queue) >= self.batch_size and self._full is not None:
+            self._full.set()
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._full.wait(), self.flush_interval + self._retry_delay)
+            except asyncio.TimeoutError:
+                pass
+            self._full.clear()
+            if await self.flush():
+                self._retry_delay = 0.0
+            else:
+                # Back off while Mongo is down instead of retrying every interval
+                self._retry_delay = min(30.0, max(self.flush_interval, self._retry_delay * 2))
+
+    async def flush(self) -> bool:
+        """Write everything queued; False if Mongo failed and records were requeued."""
+        async with self._lock:
+            while self._queue:
+                batch = self._queue[:self.batch_size]
+                del self._queue[:len(batch)]
+                if not await self._insert(batch):
+                    self._queue[:0] = batch
+                    self._shed()
+                    return False
+            await self._replay_spill()
+            return True
+
+    async def _insert(self, batch: list) -> bool:
+        started = time.monotonic()
+        inserted = batch
+        try:
+            await db.analysis_history.insert_many(batch, ordered=False)
+            self.stats['written'] += len(batch)
+        except BulkWriteError as e:
+            # Duplicate keys are records a failed earlier attempt already wrote (but never rolled up)
+            errors = [err for err in e.details.get('writeErrors', []) if err.get('code') != 11000]
+            failed = {err['index'] for err in errors}
+            inserted = [r for i, r in enumerate(batch) if i not in failed]
+            self.stats['written'] += len(inserted)
+            self.stats['dropped'] += len(errors)
+            if errors:
+                logger.warning("analysis_history dropped %d invalid records: %s", len(errors), errors[0].get('errmsg'))
+        except Exception as e:
+            self.stats['failures'] += 1
+            logger.warning("analysis_history flush of %d records failed: %s", len(batch), e)
+            return False
+        finally:
+            elapsed = time.monotonic() - started
+            self.stats['flushes'] += 1
+            self.stats['lastFlushSeconds'] = round(elapsed, 4)
+            self.stats['maxFlushSeconds'] = round(max(self.stats['maxFlushSeconds'], elapsed), 4)
+            self._flush_seconds_total += elapsed
+        await update_history_rollups(inserted)
+        return True
+
+    def _shed(self):
+        excess = len(self._queue) - self.max_queue
+        if excess > 0:
+            self._spill(self._queue[:excess])
+            del self._queue[:excess]
+
+    def _spill(self, records: list):
+        if self.spill_path:
+            try:
+                size = os.path.getsize(self.spill_path) if os.path.exists(self.spill_path) else 0
+                lines = ''.join(json.dumps(r, separators=(',', ':')) + '\n' for r in records)
+                if size + len(lines) <= self.spill_max_bytes:
+                    with open(self.spill_path, 'a', encoding='utf-8') as f:
+                        f.write(lines)
+                    self.stats['spilled'] += len(records)
+                    return
+            except OSError as e:
+                logger.warning("analysis_history spill to %s failed: %s", self.spill_path, e)
+        self.stats['dropped'] += len(records)
+
+    async def _replay_spill(self):
+        if not self.spill_path or not os.path.exists(self.spill_path):
+            return
+        # Claim the file first so concurrent API processes never replay it twice
+        claimed = f"{self.spill_path}.{os.getpid()}.replay"
+        try:
+            os.replace(self.spill_path, claimed)
+            with open(claimed, encoding='utf-8') as f:
+                records = [json.loads(line) for line in f if line.strip()]
+        except (OSError, ValueError) as e:
+            logger.warning("analysis_history spill replay failed: %s", e)
+            return
+        for i in range(0, len(records), self.batch_size):
+            batch = records[i:i + self.batch_size]
+            if not await self._insert(batch):
+                self._spill(records[i:])
+                break
+            self.stats['replayed'] += len(batch)
+        os.remove(claimed)
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._lock is not None:
+            try:
+                await asyncio.wait_for(self.flush(), self.shutdown_timeout)
+            except asyncio.TimeoutError:
+                logger.warning("analysis_history flush timed out at shutdown")
+        if self._queue:
+            self._spill(self._queue)
+            self._queue = []
+
+    def snapshot(self) -> dict:
+        writes = self.stats['flushes']
+        return {
+            **self.stats, 'queueDepth': len(self._queue), 'maxQueue': self.max_queue,
+            'batchSize': self.batch_size, 'flushIntervalSeconds': self.flush_interval,
+            'avgFlushSeconds': round(self._flush_seconds_total / writes, 4) if writes else 0,
+            'spillBytes': os.path.getsize(self.spill_path) if self.spill_path and os.path.exists(self.spill_path) else 0
+        }
+
+history_writer = HistoryWriter(
+    batch_size=int(os.environ.get('HISTORY_BATCH_SIZE', '100')),
+    flush_interval=float(os.environ.get('HISTORY_FLUSH_INTERVAL', '1.0')),
+    max_queue=int(os.environ.get('HISTORY_MAX_QUEUE', '10000')),
+    spill_path=os.environ.get('HISTORY_SPILL_PATH', ''),
+    spill_max_bytes=int(os.environ.get('HISTORY_SPILL_MAX_BYTES', str(64 * 1024 * 1024))),
+    shutdown_timeout=float(os.environ.get('HISTORY_SHUTDOWN_TIMEOUT', '5.0')),
+)
+
+# ─── History Queries ───
+# History pages are read newest first by keyset on (timestamp, id), which the
+# startup indexes cover; a page's last record becomes the next page's cursor.
+# Dashboards read trends from hourly and daily rollup documents that every
+# history flush updates incrementally, never from the raw collection.
+
+HISTORY_PAGE_MAX = int(os.environ.get('HISTORY_PAGE_MAX', '500'))
+# Length of the ISO timestamp prefix naming a bucket, and what completes it to a full timestamp
+ROLLUP_GRANULARITIES = {'hour': (13, ':00:00+00:00'), 'day': (10, 'T00:00:00+00:00')}
+ROLLUP_STEPS = {'hour': timedelta(hours=1), 'day': timedelta(days=1)}
+ROLLUP_DEFAULT_SPAN = {'hour': timedelta(hours=48), 'day': timedelta(days=30)}
+
+def iso_timestamp(moment: datetime) -> str:
+    """Render a query bound like history timestamps so they compare as strings."""
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=timezone.utc)
+    return moment.astimezone(timezone.utc).isoformat(timespec='microseconds')
+
+def encode_history_cursor(record: dict) -> str:
+    return base64.urlsafe_b64encode(f"{record['timestamp']}|{record['id']}".encode()).decode()
+
+def decode_history_cursor(cursor: str) -> Tuple[str, str]:
+    try:
+        timestamp, record_id = base64.urlsafe_b64decode(cursor.encode()).decode().split('|', 1)
+    except (ValueError, UnicodeError):
+        raise HTTPException(status_code=400, detail="Invalid history cursor")
+    return timestamp, record_id
+
+def history_query(language: Optional[str], filename_prefix: Optional[str], since: Optional[datetime],
+                  until: Optional[datetime], cursor: Optional[str]) -> dict:
+    query = {}
+    if language:
+        query['language'] = language
+    if filename_prefix:
+        # An anchored, case-sensitive prefix regex can use the filename index
+        query['filename'] = {'$regex': '^' + re.escape(filename_prefix)}
+    time_range = {}
+    if since:
+        time_range['$gte'] = iso_timestamp(since)
+    if until:
+        time_range['$lt'] = iso_timestamp(until)
+    if time_range:
+        query['timestamp'] = time_range
+    if cursor:
+        timestamp, record_id = decode_history_cursor(cursor)
+        query['$or'] = [{'timestamp': {'$lt': timestamp}}, {'timestamp': timestamp, 'id': {'$lt': record_id}}]
+    return query
+
+def rollup_bucket(timestamp: str, granularity: str) -> str:
+    length, suffix = ROLLUP_GRANULARITIES[granularity]
+    return timestamp[:length] + suffix
+
+def rollup_bucket_after(moment: datetime, granularity: str) -> str:
+    """Name the first bucket starting at or after moment, in bucket format so it compares with bucket keys."""
+    timestamp = iso_timestamp(moment)
+    start = datetime.fromisoformat(rollup_bucket(timestamp, granularity))
+    if start < datetime.fromisoformat(timestamp):
+        start += ROLLUP_STEPS[granularity]
+    return rollup_bucket(iso_timestamp(start), granularity)
+
+def rollup_updates(records: list) -> list:
+    totals = {}
+    for r in records:
+        for granularity in ROLLUP_GRANULARITIES:
+            key = (granularity, rollup_bucket(r['timestamp'], granularity), r['language'])
+            t = totals.get(key)
+            if t is None:
+                t = totals[key] = {
+                    'count': 0, 'complexitySum': 0, 'maintainabilitySum': 0.0, 'locSum': 0,
+                    'functionCount': 0, 'issueCount': 0,
+                    'complexityMax': r['complexity'], 'maintainabilityMin': r['maintainability']
+                }
+            t['count'] += 1
+            t['complexitySum'] += r['complexity']
+            t['maintainabilitySum'] += r['maintainability']
+            t['locSum'] += r['loc']
+            t['functionCount'] += r['functionCount']
+            t['issueCount'] += r['issueCount']
+            t['complexityMax'] = max(t['complexityMax'], r['complexity'])
+            t['maintainabilityMin'] = min(t['maintainabilityMin'], r['maintainability'])
+    updates = []
+    for (granularity, bucket, language), t in totals.items():
+        complexity_max, maintainability_min = t.pop('complexityMax'), t.pop('maintainabilityMin')
+        updates.append(UpdateOne(
+            {'_id': f"{granularity}:{bucket}:{language}"},
+            {
+                '$setOnInsert': {'granularity': granularity, 'bucket': bucket, 'language': language},
+                '$inc': t, '$max': {'complexityMax': complexity_max}, '$min': {'maintainabilityMin': maintainability_min}
+            },
+            upsert=True
+        ))
+    return updates
+
+async def update_history_rollups(records: list):
+    if not records:
+        return
+    try:
+        await db.analysis_rollups.bulk_write(rollup_updates(records), ordered=False)
+    except Exception as e:
+        logger.warning("analysis_rollups update for %d records failed: %s", len(records), e)
+
+def rollup_rebuild_pipeline(granularity: str) -> list:
+    length, suffix = ROLLUP_GRANULARITIES[granularity]
+    return [
+        {'$group': {
+            '_id': {'bucket': {'$concat': [{'$substrCP': ['$timestamp', 0, length]}, suffix]}, 'language': '$language'},
+            'count': {'$sum': 1}, 'complexitySum': {'$sum': '$complexity'},
+            'maintainabilitySum': {'$sum': '$maintainability'}, 'locSum': {'$sum': '$loc'},
+            'functionCount': {'$sum': '$functionCount'}, 'issueCount': {'$sum': '$issueCount'},
+            'complexityMax': {'$max': '$complexity'}, 'maintainabilityMin': {'$min': '$maintainability'}
+        }},
+        {'$project': {
+            '_id': {'$concat': [granularity, ':', '$_id.bucket', ':', '$_id.language']},
+            'granularity': {'$literal': granularity}, 'bucket': '$_id.bucket', 'language': '$_id.language',
+            'count': 1, 'complexitySum': 1, 'maintainabilitySum': 1, 'locSum': 1,
+            'functionCount': 1, 'issueCount': 1, 'complexityMax': 1, 'maintainabilityMin': 1
+        }},
+        {'$merge': {'into': 'analysis_rollups', 'whenMatched': 'replace', 'whenNotMatched': 'insert'}}
+    ]
+
+def history_stats_pipeline(granularity: str, language: Optional[str], since: datetime, until: Optional[datetime]) -> list:
+    match = {'granularity': granularity, 'bucket': {'$gte': rollup_bucket(iso_timestamp(since), granularity)}}
+    if until:
+        match['bucket']['$lt'] = rollup_bucket_after(until, granularity)
+    if language:
+        match['language'] = language
+    sums = {
+        field: {'$sum': '$' + field}
+        for field in ('count', 'complexitySum', 'maintainabilitySum', 'locSum', 'functionCount', 'issueCount')
+    }
+    sums.update(complexityMax={'$max': '$complexityMax'}, maintainabilityMin={'$min': '$maintainabilityMin'})
+
+    def averages(extra: dict) -> dict:
+        count = {'$max': ['$count', 1]}
+        return {
+            '_id': 0, **extra, 'count': 1, 'functionCount': 1, 'issueCount': 1,
+            'avgComplexity': {'$round': [{'$divide': ['$complexitySum', count]}, 2]},
+            'maxComplexity': '$complexityMax',
+            'avgMaintainability': {'$round': [{'$divide': ['$maintainabilitySum', count]}, 2]},
+            'minMaintainability': '$maintainabilityMin',
+            'avgLoc': {'$round': [{'$divide': ['$locSum', count]}, 1]}
+        }
+
+    return [
+        {'$match': match},
+        {'$facet': {
+            'buckets': [{'$group': {'_id': '$bucket', **sums}}, {'$sort': {'_id': 1}}, {'$project': averages({'bucket': '$_id'})}],
+            'totals': [{'$group': {'_id': None, **sums}}, {'$project': averages({})}]
+        }}
+    ]
+
+# ─── Git Trends ───
+# backend/git_trends.py replays the history of a local git clone offline and
+# stores the series next to analysis_history: one point per commit in
+# analysis_trend_commits and one point per changed file in
+# analysis_trend_files. Sources are summarized once per blob SHA and language
+# in analysis_blob_summaries, so unchanged files are never analyzed twice,
+# not even across runs. Points are ordered by first-parent depth, which holds
+# even where commit times tie or go backwards.
+
+TREND_PAGE_MAX = int(os.environ.get('TREND_PAGE_MAX', '5000'))
+
+def blob_summary_key(blob: str, language: str) -> str:
+    return f"{blob}:{language}:{ANALYZER_VERSION}"
+
+def blob_summary(result: dict) -> dict:
+    """What trend points keep of one file's analysis."""
+    summary = result['summary']
+    doc = {
+        'loc': summary['loc'], 'sloc': summary['sloc'], 'functionCount': summary['functionCount'],
+        'cyclomaticComplexity': summary['cyclomaticComplexity'],
+        'maintainabilityIndex': summary['maintainabilityIndex'], 'issueCount': len(result['linterIssues'])
+    }
+    if 'degraded' in result:
+        doc['degraded'] = result['degraded']['reason']
+    return doc
+
+def trend_query(repo: str, since: Optional[datetime], until: Optional[datetime], path: Optional[str] = None) -> dict:
+    query = {'repo': repo}
+    if path is not None:
+        query['path'] = path
+    time_range = {}
+    if since:
+        time_range['$gte'] = iso_timestamp(since)
+    if until:
+        time_range['$lt'] = iso_timestamp(until)
+    if time_range:
+        query['timestamp'] = time_range
+    return query
+
+async def read_trend(collection, query: dict, limit: int) -> list:
+    """The newest limit points of a series, oldest first."""
+    points = await collection.find(query, {'_id': 0}).sort('depth', -1).limit(limit).to_list(limit)
+    points.reverse()
+    return points
+
+# ─── Response Encoding ───
+# Results can be trimmed to a detail level and packed compactly: the level
+# tables and Halstead field names are sent once and each function refers to
+# them by index, and the heatmap (a copy of per-function fields) is dropped.
+# Results are kept, cached and passed between processes without the heatmap;
+# shape_result derives it from the functions when a response includes it.
+# JSON goes through orjson when it is installed; clients that accept
+# application/msgpack get MessagePack when the msgpack package is. Results of
+# /analyze carry a strong ETag so unchanged sources can be answered with 304
+# before any analysis, and large bodies are brotli or gzip compressed.
+
+DetailLevel = Literal['summary', 'functions', 'full']
+HALSTEAD_FIELDS = (
+    'uniqueOperators', 'uniqueOperands', 'totalOperators', 'totalOperands', 'vocabulary', 'length',
+    'volume', 'difficulty', 'effort', 'time', 'bugs'
+)
+MSGPACK_TYPES = ('application/msgpack', 'application/x-msgpack')
+RESPONSE_VARY = 'Accept, Accept-Encoding'
+COMPRESS_MIN_BYTES = int(os.environ.get('COMPRESS_MIN_BYTES', '4096'))
+GZIP_LEVEL = 5
+BROTLI_QUALITY = 4
+
+def dump_json(obj) -> bytes:
+    if orjson is not None:
+        try:
+            return orjson.dumps(obj)
+        except TypeError:
+            pass  # lone surrogates from undecodable sources; the stdlib escapes them
+    return json.dumps(obj, separators=(',', ':')).encode()
+
+def heatmap_entries(functions: list) -> list:
+    return [{
+        'name': fm['name'], 'startLine': fm['startLine'], 'endLine': fm['endLine'],
+        'intensity': fm['heatIntensity'], 'complexity': fm['cyclomaticComplexity'],
+        'color': fm['complexityLevel']['color']
+    } for fm in functions]
+
+def _compact_function(fm: dict) -> dict:
+    fm = {
+        **fm, 'complexityLevel': fm['complexityLevel']['level'],
+        'maintainabilityLevel': fm['maintainabilityLevel']['level']
+    }
+    if 'halstead' in fm:
+        fm['halstead'] = [fm['halstead'][k] for k in HALSTEAD_FIELDS]
+        exclusive = fm['exclusive']
+        fm['exclusive'] = {**exclusive, 'halstead': [exclusive['halstead'][k] for k in HALSTEAD_FIELDS]}
+    return fm
+
+def shape_result(result: dict, detail: str = 'full', compact: bool = False) -> dict:
+    """result trimmed to a detail level, in the compact form when asked; the input is not modified.
+
+    summary drops functions, the heatmap and rule findings (keeping their counts);
+    functions drops per-function Halstead metrics. Clone fingerprints are always dropped.
+    """
+    if 'error' in result:
+        return result
+    shaped = {key: value for key, value in result.items() if key not in ('cloneFingerprints', 'heatmap')}
+    if not compact and detail != 'summary':
+        shaped['heatmap'] = heatmap_entries(result['functions'])
+    if detail == 'full' and not compact:
+        return shaped
+    if detail == 'summary':
+        shaped['issueCount'] = len(result['linterIssues'])
+        shaped['suggestionCount'] = len(result['refactorSuggestions'])
+        for key in ('functions', 'linterIssues', 'refactorSuggestions'):
+            del shaped[key]
+    elif detail == 'functions':
+        shaped['functions'] = [{
+            **{k: v for k, v in fm.items() if k != 'halstead'},
+            'exclusive': {k: v for k, v in fm['exclusive'].items() if k != 'halstead'}
+        } for fm in result['functions']]
+    if compact:
+        summary = result['summary']
+        shaped['summary'] = {
+            **summary, 'complexityLevel': summary['complexityLevel']['level'],
+            'maintainabilityLevel': summary['maintainabilityLevel']['level']
+        }
+        shaped['levels'] = {'complexity': COMPLEXITY_LEVELS, 'maintainability': MAINTAINABILITY_LEVELS}
+        if 'functions' in shaped:
+            if detail == 'full':
+                shaped['halsteadFields'] = HALSTEAD_FIELDS
+            shaped['functions'] = [_compact_function(fm) for fm in shaped['functions']]
+        shaped['compact'] = True
+    return shaped
+
+def wants_msgpack(request: Request) -> bool:
+    accept = request.headers.get('accept', '')
+    return msgpack is not None and any(media_type in accept for media_type in MSGPACK_TYPES)
+
+def result_etag(digest: str, filename: str, rules: Optional[dict], detail: str, compact: bool, packed: bool) -> str:
+    """Strong validator for one representation of the analysis of a source.
+
+    Analysis is deterministic, so the digest, analyzer version and every input
+    that changes the body identify it without running the analysis.
+    """
+    variant = '|'.join((
+        digest, ANALYZER_VERSION, filename, rules_fingerprint(rules) if rules else '', detail,
+        'compact' if compact else '', 'msgpack' if packed else 'json'
+    ))
+    return '"' + hashlib.sha256(variant.encode('utf-8', 'surrogatepass')).hexdigest()[:32] + '"'
+
+def matching_etag(request: Request, etag: str) -> Optional[str]:
+    """The If-None-Match entry naming etag, compressed variants included, or None."""
+    for candidate in request.headers.get('if-none-match', '').split(','):
+        candidate = candidate.strip()
+        # If-None-Match uses the weak comparison
+        tag = candidate[2:] if candidate.startswith('W/') else candidate
+        if tag == etag or tag[:-1].rsplit('-', 1)[0] + '"' == etag:
+            return candidate
+    return None
+
+def not_modified(etag: str) -> Response:
+    return Response(status_code=304, headers={'ETag': etag, 'Vary': RESPONSE_VARY})
+
+def accepted_encodings(header: str) -> set:
+    accepted = set()
+    for part in header.split(','):
+        coding, _, params = part.partition(';')
+        params = params.strip()
+        try:
+            if params.startswith('q=') and float(params[2:]) <= 0:
+                continue
+        except ValueError:
+            continue
+        accepted.add(coding.strip().lower())
+    return accepted
+
+def compress_body(request: Request, body: bytes) -> Tuple[bytes, Optional[str]]:
+    """body, brotli or gzip compressed when it is large and the client accepts it, with the coding used."""
+    if len(body) < COMPRESS_MIN_BYTES:
+        return body, None
+    accepted = accepted_encodings(request.headers.get('accept-encoding', ''))
+    if brotli is not None and 'br' in accepted:
+        return brotli.compress(body, quality=BROTLI_QUALITY), 'br'
+    if 'gzip' in accepted:
+        return gzip.compress(body, GZIP_LEVEL, mtime=0), 'gzip'
+    return body, None
+
+def encoded_response(request: Request, result: dict, detail: str = 'full', compact: bool = False,
+                     etag: Optional[str] = None) -> Response:
+    """The shaped result as MessagePack when the client accepts it and msgpack is installed, else JSON.
+
+    Large bodies are compressed per Accept-Encoding; a compressed body gets its
+    own ETag, the given one with the coding appended.
+    """
+    started = time.perf_counter()
+    body = shape_result(result, detail, compact)
+    if wants_msgpack(request):
+        content, media_type = msgpack.packb(body, use_bin_type=True), 'application/msgpack'
+    else:
+        content, media_type = dump_json(body), 'application/json'
+    record_stage('serialize', time.perf_counter() - started)
+    started = time.perf_counter()
+    content, coding = compress_body(request, content)
+    headers = {'Vary': RESPONSE_VARY}
+    if coding:
+        headers['Content-Encoding'] = coding
+        record_stage('compress', time.perf_counter() - started)
+    # A summary made after a worker was killed is not cached, so it must not be revalidated either
+    if etag and 'error' not in result and result.get('degraded', {}).get('reason') != 'worker_killed':
+        headers['ETag'] = f'{etag[:-1]}-{coding}"' if coding else etag
+    return Response(content, media_type=media_type, headers=headers)
+
+# ─── Live Analysis ───
+# Editors keep a WebSocket open on /api/live and send text edits as the user
+# types. Edits are applied to the session's copy of the document at once; the
+# analysis runs once edits pause for LIVE_DEBOUNCE seconds, on the latest text
+# only. It goes through analyze_cached, so the span memo re-lexes only the
+# functions whose text changed. Results go back as splices of the result lists
+# against the previous result; items after a splice are unchanged apart from a
+# uniform shift of their line numbers (and function ids).
+
+LIVE_DEBOUNCE = float(os.environ.get('LIVE_DEBOUNCE_MS', '150')) / 1000
+LIVE_MAX_SESSIONS = int(os.environ.get('LIVE_MAX_SESSIONS', '64'))
+LIVE_MAX_SESSIONS_PER_CLIENT = int(os.environ.get('LIVE_MAX_SESSIONS_PER_CLIENT', '4'))
+# Per-connection memory cap: the document, and so each message, may not grow beyond this many characters
+LIVE_MAX_DOCUMENT_CHARS = int(os.environ.get('LIVE_MAX_DOCUMENT_CHARS', str(1024 * 1024)))
+LIVE_IDLE_TIMEOUT = float(os.environ.get('LIVE_IDLE_TIMEOUT', '600'))
+LIVE_LISTS = ('functions', 'linterIssues', 'refactorSuggestions', 'heatmap')
+# Close codes (RFC 6455 and the IANA registry)
+WS_UNSUPPORTED = 1003
+WS_POLICY = 1008
+WS_TOO_BIG = 1009
+WS_TRY_AGAIN = 1013
+
+class LiveLimitExceeded(Exception):
+    pass
+
+class LiveSessions:
+    """Admission control for live sessions, per process and per client address."""
+
+    def __init__(self):
+        self.per_client = {}
+        self.active = 0
+        self.stats = {'opened': 0, 'rejected': 0, 'analyses': 0, 'deltas': 0}
+
+    def admit(self, client: str) -> bool:
+        if self.active >= LIVE_MAX_SESSIONS or self.per_client.get(client, 0) >= LIVE_MAX_SESSIONS_PER_CLIENT:
+            self.stats['rejected'] += 1
+            return False
+        self.active += 1
+        self.per_client[client] = self.per_client.get(client, 0) + 1
+        self.stats['opened'] += 1
+        return True
+
+    def release(self, client: str):
+        self.active -= 1
+        if self.per_client[client] <= 1:
+            del self.per_client[client]
+        else:
+            self.per_client[client] -= 1
+
+    def snapshot(self) -> dict:
+        return {
+            **self.stats, 'active': self.active, 'clients': len(self.per_client),
+            'maxSessions': LIVE_MAX_SESSIONS, 'maxSessionsPerClient': LIVE_MAX_SESSIONS_PER_CLIENT,
+            'maxDocumentChars': LIVE_MAX_DOCUMENT_CHARS, 'debounceSeconds': LIVE_DEBOUNCE
+        }
+
+live_sessions = LiveSessions()
+
+def _moved(item: dict, lines: int, ids: int, old_end: int) -> dict:
+    """item after a splice moved it: lines added to its line fields, ids added to ids at or after old_end."""
+    moved = dict(item)
+    for key in ('line', 'startLine', 'endLine'):
+        if key in moved:
+            moved[key] += lines
+    for key in ('id', 'parentId'):
+        if moved.get(key) is not None and moved[key] >= old_end:
+            moved[key] += ids
+    return moved
+
+def list_splice(old: list, new: list, lines: int) -> Optional[dict]:
+    """{start, deleteCount, items} turning old into new once the kept tail is moved; None when nothing changed.
+
+    The kept tail is every item after the inserted ones, moved by lines and,
+    for ids at or after start + deleteCount, by the change in list length.
+    """
+    limit = min(len(old), len(new))
+    start = 0
+    while start < limit and old[start] == new[start]:
+        start += 1
+    if start == len(old) == len(new):
+        return None
+    ids = len(new) - len(old)
+    kept = 0
+    while kept < limit - start:
+        j = len(old) - kept - 1
+        if _moved(old[j], lines, ids, j) != new[j + ids]:
+            break
+        kept += 1
+    # A longer tail can move the parentId of an item kept earlier; shrink until the whole tail holds
+    while kept:
+        old_end = len(old) - kept
+        bad = next((j for j in range(old_end, len(old)) if _moved(old[j], lines, ids, old_end) != new[j + ids]), None)
+        if bad is None:
+            break
+        kept = len(old) - bad - 1
+    return {'start': start, 'deleteCount': len(old) - kept - start, 'items': new[start:len(new) - kept]}
+
+def result_delta(old: dict, new: dict) -> dict:
+    """What changed from old to new (shaped results): replaced top-level fields, and a splice per list."""
+    lines = new['summary']['loc'] - old['summary']['loc']
+    delta = {
+        'lineShift': lines, 'idShift': len(new.get('functions', ())) - len(old.get('functions', ())),
+        'set': {}, 'splices': {}
+    }
+    for key in old.keys() | new.keys():
+        if key in LIVE_LISTS:
+            splice = list_splice(old.get(key, []), new.get(key, []), lines)
+            if splice is not None:
+                delta['splices'][key] = splice
+        elif old.get(key) != new.get(key):
+            delta['set'][key] = new.get(key)
+    return delta
+
+def check_live_size(text: str):
+    if len(text) > LIVE_MAX_DOCUMENT_CHARS:
+        raise LiveLimitExceeded(f"Document exceeds {LIVE_MAX_DOCUMENT_CHARS} characters")
+
+def live_offset(text: str, offsets: list, pos: LivePosition) -> int:
+    """Source offset of a position; like LSP, lines and columns past the end clamp to it."""
+    if pos.line >= len(offsets) - 1:
+        return len(text)
+    line_end = offsets[pos.line + 1]
+    if line_end > offsets[pos.line] and text[line_end - 1] == '\n':
+        line_end -= 1
+    return min(offsets[pos.line] + pos.character, line_end)
+
+class LiveSession:
+    """One editor document: edits apply immediately, analyses run debounced on the latest text."""
+
+    def __init__(self, opened: LiveOpenMessage, send, detail: str, compact: bool):
+        self.filename = opened.filename
+        self.rules = rule_overrides(opened.rules)
+        self.text = ''
+        self.version = opened.version
+        self.send = send
+        self.detail = detail
+        self.compact = compact
+        self.offsets = None
+        self.sent = None          # shaped result the client holds
+        self.sent_version = None
+        self.changed = asyncio.Event()
+        self.last_edit = 0.0      # the opening text is analyzed without waiting
+        self.replace(opened.text)
+        self.changed.set()
+
+    def replace(self, text: str):
+        check_live_size(text)
+        self.text = text
+        self.offsets = None
+
+    def apply(self, edit: LiveEditMessage):
+        """Apply all of edit's changes, or none of them if any is invalid or oversized."""
+        text, offsets = self.text, self.offsets
+        for change in edit.changes:
+            if change.range is None:
+                text = change.text
+            else:
+                if offsets is None:
+                    offsets = line_offsets(text)
+                start, end = live_offset(text, offsets, change.range.start), live_offset(text, offsets, change.range.end)
+                if end < start:
+                    raise ValueError("range end is before its start")
+                text = text[:start] + change.text + text[end:]
+            offsets = None
+            check_live_size(text)
+        self.text, self.offsets = text, offsets
+        self.version = edit.version
+        self.last_edit = time.monotonic()
+        self.changed.set()
+
+    async def run(self):
+        """Analyze after each pause in editing and push the result, or a delta against the last one sent."""
+        while True:
+            await self.changed.wait()
+            while (quiet := time.monotonic() - self.last_edit) < LIVE_DEBOUNCE:
+                await asyncio.sleep(LIVE_DEBOUNCE - quiet)
+            self.changed.clear()
+            text, version = self.text, self.version
+            try:
+                result = await analyze_cached(text, self.filename, self.rules)
+            except HTTPException as e:
+                await self.send({'type': 'error', 'version': version, 'status': e.status_code, 'message': e.detail})
+                if e.status_code == 429:
+                    # The pool is saturated: try again once it has room, unless newer edits arrive first
+                    await asyncio.sleep(float((e.headers or {}).get('Retry-After', 1)))
+                    self.changed.set()
+                continue
+            except Exception as e:
+                logger.exception("Live analysis of %s failed", self.filename)
+                metrics.errors.inc('live_exception')
+                await self.send({'type': 'error', 'version': version, 'status': 500, 'message': str(e) or type(e).__name__})
+                continue
+            live_sessions.stats['analyses'] += 1
+            shaped = shape_result(result, self.detail, self.compact)
+            # Live documents are never stored, so there is nothing a resultId could refer to
+            shaped.pop('resultId', None)
+            if self.sent is None:
+                await self.send({'type': 'result', 'version': version, 'result': shaped})
+            else:
+                live_sessions.stats['deltas'] += 1
+                await self.send({
+                    'type': 'delta', 'version': version, 'baseVersion': self.sent_version,
+                    **result_delta(self.sent, shaped)
+                })
+            self.sent, self.sent_version = shaped, version
+
+async def receive_live_message(websocket: WebSocket) -> dict:
+    message = await asyncio.wait_for(websocket.receive(), LIVE_IDLE_TIMEOUT)
+    if message['type'] == 'websocket.disconnect':
+        raise WebSocketDisconnect(message.get('code', 1000))
+    data = message.get('text')
+    if data is None:
+        data = message.get('bytes') or b''
+    # Each edit is bounded by the document cap, plus room for the JSON around it
+    if len(data) > 2 * LIVE_MAX_DOCUMENT_CHARS + 4096:
+        raise LiveLimitExceeded(f"Message exceeds the {LIVE_MAX_DOCUMENT_CHARS}-character document limit")
+    return json.loads(data)
+
+async def run_live_session(websocket: WebSocket, detail: str, compact: bool):
+    async def send(message: dict):
+        await websocket.send_text(dump_json(message).decode())
+
+    try:
+        opened = LiveOpenMessage.model_validate(await receive_live_message(websocket))
+    except ValueError as e:
+        await send({'type': 'error', 'message': f"Expected an open message: {e}"})
+        await websocket.close(code=WS_POLICY)
+        return
+    if detect_language(opened.filename) == 'unknown':
+        await send({'type': 'error', 'message': 'Unsupported language'})
+        await websocket.close(code=WS_UNSUPPORTED)
+        return
+    session = LiveSession(opened, send, detail, compact)
+    analyzer = asyncio.ensure_future(session.run())
+    try:
+        while True:
+            try:
+                session.apply(LiveEditMessage.model_validate(await receive_live_message(websocket)))
+            except LiveLimitExceeded as e:
+                # Edits apply all or nothing, so the document is still the one at session.version
+                await send({'type': 'error', 'version': session.version, 'status': 413, 'message': str(e)})
+            except ValueError as e:
+                await send({'type': 'error', 'version': session.version, 'message': f"Invalid edit: {e}"})
+    finally:
+        analyzer.cancel()
+
+# ─── Job Queue ───
+# Work too large for one request is submitted to /api/jobs and runs on any
+# process with job runners: the API process itself (JOB_RUNNERS) or dedicated
+# nodes started with backend/job_worker.py, all sharing analysis_jobs. A
+# runner claims the oldest runnable job with one find_one_and_update that
+# marks it running under a lease, and renews the lease while it works; a job
+# whose lease runs out because its runner died is claimed again, up to
+# JOB_MAX_ATTEMPTS. Inputs and NDJSON results are stored in JOB_CHUNK_BYTES
+# pieces in analysis_job_chunks, so neither is bound by Mongo's document size.
+# Result chunks are keyed by attempt, and a job only completes while its
+# runner still holds the lease, so a runner that lost its job never mixes its
+# output into the result.
+
+JOB_RUNNERS = int(os.environ.get('JOB_RUNNERS', '1'))
+JOB_LEASE_SECONDS = float(os.environ.get('JOB_LEASE_SECONDS', '60'))
+JOB_MAX_ATTEMPTS = int(os.environ.get('JOB_MAX_ATTEMPTS', '3'))
+JOB_POLL_INTERVAL = float(os.environ.get('JOB_POLL_INTERVAL', '1.0'))
+JOB_CHUNK_BYTES = int(os.environ.get('JOB_CHUNK_BYTES', str(1024 * 1024)))
+JOB_MAX_INPUT_BYTES = int(os.environ.get('JOB_MAX_INPUT_BYTES', str(1024 * 1024 * 1024)))
+JOB_MAX_ITEMS = int(os.environ.get('JOB_MAX_ITEMS', '100000'))
+JOB_TTL = int(os.environ.get('JOB_TTL', str(7 * 24 * 3600)))
+JOB_STATUSES = ('queued', 'running', 'done', 'failed', 'cancelled')
+LEASE_FIELDS = {'leaseOwner': '', 'leaseExpiresAt': ''}
+
+class JobLeaseLost(Exception):
+    """The job was cancelled or claimed by another runner while this one worked on it."""
+
+class ChunkWriter:
+    """Appends bytes to one part ('input' or 'result.<attempt>') of a job in analysis_job_chunks."""
+
+    def __init__(self, job_id: str, part: str):
+        self.job_id = job_id
+        self.part = part
+        self.buffer = bytearray()
+        self.chunks = 0
+        self.size = 0
+        self.lines = 0
+
+    async def write(self, data: bytes):
+        self.buffer += data
+        self.size += len(data)
+        self.lines += data.count(b'\n')
+        while len(self.buffer) >= JOB_CHUNK_BYTES:
+            await self._put(bytes(self.buffer[:JOB_CHUNK_BYTES]))
+            del self.buffer[:JOB_CHUNK_BYTES]
+
+    async def close(self):
+        if self.buffer:
+            await self._put(bytes(self.buffer))
+            self.buffer.clear()
+
+    async def _put(self, data: bytes):
+        # Keyed by position, so rewriting a chunk after a failed write cannot duplicate it
+        await db.analysis_job_chunks.replace_one(
+            {'_id': f"{self.job_id}:{self.part}:{self.chunks}"},
+            {'job': self.job_id, 'part': self.part, 'n': self.chunks, 'data': data, 'createdAt': datetime.now(timezone.utc)},
+            upsert=True
+        )
+        self.chunks += 1
+
+async def read_chunks(job_id: str, part: str):
+    """A stored part's bytes in order, one chunk in memory at a time."""
+    async for chunk in db.analysis_job_chunks.find({'job': job_id, 'part': part}, {'data': 1}).sort('n', 1):
+        yield chunk['data']
+
+async def delete_chunks(job_id: str, part: Optional[str] = None, keep: Optional[str] = None):
+    """Delete a job's chunks: all of them, one part, or all but the part to keep."""
+    query = {'job': job_id}
+    if part:
+        query['part'] = part
+    elif keep:
+        query['part'] = {'$ne': keep}
+    try:
+        await db.analysis_job_chunks.delete_many(query)
+    except Exception as e:
+        logger.warning("analysis_job_chunks cleanup failed: %s", e)
+
+async def finish_chunks(job_ids: list, finished_at: datetime):
+    """Start the JOB_TTL clock on the jobs' chunks; set before the job itself ends, so none outlive it."""
+    await db.analysis_job_chunks.update_many({'job': {'$in': job_ids}}, {'$set': {'finishedAt': finished_at}})
+
+def job_status(job: dict) -> dict:
+    status = {
+        'id': job['_id'], 'kind': job['kind'], 'status': job['status'], 'attempts': job['attempts'],
+        'inputBytes': job['inputBytes'], 'resultLines': job.get('resultLines', 0)
+    }
+    for field in ('createdAt', 'startedAt', 'finishedAt'):
+        if job.get(field):
+            status[field] = iso_timestamp(job[field])
+    if job['status'] == 'done':
+        status['resultBytes'] = job['resultBytes']
+    if job.get('error'):
+        status['error'] = job['error']
+    return status
+
+async def submit_job(kind: str, params: dict, body) -> dict:
+    """Store body (an async iterable of bytes) as the job's input, then queue it."""
+    job_id = str(uuid.uuid4())
+    writer = ChunkWriter(job_id, 'input')
+    try:
+        async for data in body:
+            if writer.size + len(data) > JOB_MAX_INPUT_BYTES:
+                await delete_chunks(job_id)
+                raise HTTPException(status_code=413, detail=f"Job input exceeds {JOB_MAX_INPUT_BYTES} bytes")
+            await writer.write(data)
+        await writer.close()
+        job = {
+            '_id': job_id, 'kind': kind, 'params': params, 'status': 'queued', 'attempts': 0,
+            'inputBytes': writer.size, 'client': analysis_context.get()[1], 'createdAt': datetime.now(timezone.utc)
+        }
+        await db.analysis_jobs.insert_one(job)
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.warning("analysis_jobs submit failed: %s", e)
+        await delete_chunks(job_id)
+        raise HTTPException(status_code=503, detail="Job store unavailable", headers={'Retry-After': '5'})
+    return job
+
+async def claim_job(owner: str) -> Optional[dict]:
+    """The oldest queued job, or one whose runner let its lease expire, now running under owner's lease."""
+    now = datetime.now(timezone.utc)
+    # Jobs whose runner died on every attempt fail instead of being retried forever
+    exhausted = {'status': 'running', 'leaseExpiresAt': {'$lt': now}, 'attempts': {'$gte': JOB_MAX_ATTEMPTS}}
+    dead = [job['_id'] async for job in db.analysis_jobs.find(exhausted, {'_id': 1})]
+    if dead:
+        await finish_chunks(dead, now)
+        await db.analysis_jobs.update_many(
+            {**exhausted, '_id': {'$in': dead}},
+            {'$set': {'status': 'failed', 'finishedAt': now, 'error': f"Lease expired on all {JOB_MAX_ATTEMPTS} attempts"},
+             '$unset': LEASE_FIELDS}
+        )
+    return await db.analysis_jobs.find_one_and_update(
+        {'$or': [
+            {'status': 'queued'},
+            {'status': 'running', 'leaseExpiresAt': {'$lt': now}, 'attempts': {'$lt': JOB_MAX_ATTEMPTS}}
+        ]},
+        {'$set': {'status': 'running', 'leaseOwner': owner, 'startedAt': now,
+                  'leaseExpiresAt': now + timedelta(seconds=JOB_LEASE_SECONDS)},
+         '$inc': {'attempts': 1}},
+        sort=[('createdAt', 1)], return_document=ReturnDocument.AFTER
+    )
+
+async def produce_job_result(job: dict, result: ChunkWriter):
+    """Run a claimed job, writing its NDJSON lines to result."""
+    if job['kind'] == 'archive':
+        lines = stream_archive_analysis(read_chunks(job['_id'], 'input'))
+    else:
+        lines = batch_lines(batch_job_items(job['_id']), **job['params'])
+    async for line in lines:
+        await result.write(line.encode() if isinstance(line, str) else line)
+    await result.close()
+
+class JobRunner:
+    """Claims jobs from analysis_jobs and runs them in this process, one per runner task."""
+
+    def __init__(self):
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._tasks = []
+        self.stats = {'claimed': 0, 'completed': 0, 'failed': 0, 'lost': 0, 'released': 0}
+
+    def start(self, runners: int):
+        self._tasks = [asyncio.ensure_future(self._loop()) for _ in range(runners)]
+
+    async def _loop(self):
+        while True:
+            try:
+                job = await claim_job(self.owner)
+            except Exception as e:
+                logger.warning("analysis_jobs claim failed: %s", e)
+                job = None
+            if job is None:
+                # Jitter keeps idle runners on many nodes from polling in lockstep
+                await asyncio.sleep(JOB_POLL_INTERVAL * random.uniform(0.5, 1.5))
+                continue
+            await self.run(job)
+
+    async def _renew(self, lease: dict, result: ChunkWriter) -> bool:
+        """False once the job is no longer ours; a failed renewal is retried at the next beat."""
+        try:
+            renewed = await db.analysis_jobs.update_one(lease, {'$set': {
+                'leaseExpiresAt': datetime.now(timezone.utc) + timedelta(seconds=JOB_LEASE_SECONDS),
+                'resultLines': result.lines
+            }})
+        except Exception as e:
+            logger.warning("analysis_jobs lease renewal failed: %s", e)
+            return True
+        return renewed.matched_count > 0
+
+    async def run(self, job: dict):
+        self.stats['claimed'] += 1
+        lease = {'_id': job['_id'], 'status': 'running', 'leaseOwner': self.owner, 'attempts': job['attempts']}
+        result = ChunkWriter(job['_id'], f"result.{job['attempts']}")
+        # The job's analyses are bulk work of the client that submitted it, wherever it runs
+        token = analysis_context.set(('bulk', job.get('client', '')))
+        work = asyncio.ensure_future(produce_job_result(job, result))
+        analysis_context.reset(token)
+        try:
+            while not (await asyncio.wait({work}, timeout=JOB_LEASE_SECONDS / 3))[0]:
+                if not await self._renew(lease, result):
+                    raise JobLeaseLost()
+            work.result()
+            finished_at = datetime.now(timezone.utc)
+            await finish_chunks([job['_id']], finished_at)
+            finished = await db.analysis_jobs.update_one(lease, {'$set': {
+                'status': 'done', 'finishedAt': finished_at, 'resultPart': result.part,
+                'resultBytes': result.size, 'resultLines': result.lines
+            }, '$unset': {**LEASE_FIELDS, 'error': ''}})
+            if not finished.matched_count:
+                raise JobLeaseLost()
+            self.stats['completed'] += 1
+            # The input and the output of earlier attempts are no longer needed
+            await delete_chunks(job['_id'], keep=result.part)
+        except JobLeaseLost:
+            await self._stop(work)
+            self.stats['lost'] += 1
+            logger.warning("Job %s was cancelled or reclaimed while running", job['_id'])
+            await delete_chunks(job['_id'], part=result.part)
+            try:
+                # A runner that reclaimed the job still needs its input
+                await db.analysis_job_chunks.update_many(
+                    {'job': job['_id'], 'part': 'input'}, {'$unset': {'finishedAt': ''}}
+                )
+            except Exception as e:
+                logger.warning("analysis_job_chunks update failed: %s", e)
+        except asyncio.CancelledError:
+            # Shutting down: hand the job back without spending one of its attempts
+            await self._stop(work)
+            await self._release(lease, result)
+            raise
+        except Exception as e:
+            logger.exception("Job %s failed", job['_id'])
+            self.stats['failed'] += 1
+            await self._fail(lease, job, result, str(e) or type(e).__name__)
+        finally:
+            work.cancel()
+
+    @staticmethod
+    async def _stop(work: asyncio.Future):
+        """Cancel the job's work and wait until it has stopped writing chunks."""
+        work.cancel()
+        await asyncio.wait({work})
+
+    async def _release(self, lease: dict, result: ChunkWriter):
+        try:
+            await db.analysis_jobs.update_one(
+                lease, {'$set': {'status': 'queued'}, '$inc': {'attempts': -1}, '$unset': LEASE_FIELDS}
+            )
+            self.stats['released'] += 1
+        except Exception as e:
+            logger.warning("analysis_jobs release failed: %s", e)
+        await delete_chunks(lease['_id'], part=result.part)
+
+    async def _fail(self, lease: dict, job: dict, result: ChunkWriter, error: str):
+        """Requeue the job for another attempt, or fail it once none are left."""
+        update = {'$set': {'status': 'queued', 'error': error}, '$unset': LEASE_FIELDS}
+        try:
+            if job['attempts'] >= JOB_MAX_ATTEMPTS:
+                update['$set'].update(status='failed', finishedAt=datetime.now(timezone.utc))
+                await finish_chunks([job['_id']], update['$set']['finishedAt'])
+            await db.analysis_jobs.update_one(lease, update)
+        except Exception as e:
+            logger.warning("analysis_jobs failure update failed: %s", e)
+        await delete_chunks(job['_id'], part=result.part)
+
+    async def close(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def snapshot(self) -> dict:
+        return {'owner': self.owner, 'runners': len(self._tasks), **self.stats}
+
+job_runner = JobRunner()
+
+# ─── API Routes ───
+@api_router.get("/")
+async def root():
+    return {"message": "NoseyCoder API"}
+
+def history_record(result: dict) -> dict:
+    return {
+        'id': str(uuid.uuid4()),
+        'filename': result['filename'],
+        'language': result['language'],
+        'loc': result['summary']['loc'],
+        'complexity': result['summary']['cyclomaticComplexity'],
+        'maintainability': result['summary']['maintainabilityIndex'],
+        'functionCount': result['summary']['functionCount'],
+        'issueCount': len(result['linterIssues']),
+        # Always six fraction digits, so records, cursors and since/until bounds compare as strings
+        'timestamp': iso_timestamp(datetime.now(timezone.utc))
+    }
+
+@api_router.post("/analyze")
+async def analyze_endpoint(req: AnalyzeRequest, request: Request, detail: DetailLevel = 'full', compact: bool = False):
+    rules = rule_overrides(req.rules)
+    digest = etag = None
+    if detect_language(req.filename) != 'unknown':
+        digest = content_digest(req.code)
+        etag = result_etag(digest, req.filename, rules, detail, compact, wants_msgpack(request))
+        # The client already holds this exact result: skip the analysis, history and source store
+        matched = matching_etag(request, etag)
+        if matched:
+            return not_modified(matched)
+    result = await analyze_cached(req.code, req.filename, rules, digest)
+
+    # Store analysis record
+    if 'error' not in result:
+        started = time.perf_counter()
+        history_writer.add(history_record(result))
+        await asyncio.gather(
+            store_source(result['resultId'], req.code, req.filename),
+            store_clone_fingerprints(result['resultId'], result)
+        )
+        record_stage('store', time.perf_counter() - started)
+
+    # Rendered here rather than by FastAPI so serialization shows up as its own stage
+    return encoded_response(request, result, detail, compact, etag)
+
+@api_router.post("/analyze/probe")
+async def analyze_probe_endpoint(req: ProbeRequest, request: Request, detail: DetailLevel = 'full', compact: bool = False):
+    """A cached result looked up by source digest, so unchanged sources need not be uploaded; 404 when not cached."""
+    language = detect_language(req.filename)
+    if language == 'unknown':
+        raise HTTPException(status_code=422, detail="Unsupported language")
+    rules = rule_overrides(req.rules)
+    etag = result_etag(req.digest, req.filename, rules, detail, compact, wants_msgpack(request))
+    matched = matching_etag(request, etag)
+    if matched:
+        return not_modified(matched)
+    result = await result_cache.lookup(ResultCache.key(req.digest, language, rules))
+    if result is None:
+        raise HTTPException(status_code=404, detail="No cached result; POST the source to /api/analyze")
+    if result['filename'] != req.filename:
+        result = {**result, 'filename': req.filename}
+    return encoded_response(request, result, detail, compact, etag)
+
+@api_router.post("/analyze/incremental")
+async def analyze_incremental_endpoint(req: IncrementalAnalyzeRequest, request: Request,
+                                       detail: DetailLevel = 'full', compact: bool = False):
+    previous = await db.analysis_sources.find_one({'_id': req.resultId}, {'_id': 0})
+    if not previous:
+        raise HTTPException(status_code=404, detail="Unknown or expired resultId")
+    try:
+        code, spans = apply_unified_diff(previous['code'], req.diff)
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=f"Diff does not apply: {e}")
+    filename = req.filename or previous['filename']
+    result = await analyze_cached(code, filename, rule_overrides(req.rules))
+    if 'error' in result:
+        return result
+    history_writer.add(history_record(result))
+    await asyncio.gather(store_source(result['resultId'], code, filename), store_clone_fingerprints(result['resultId'], result))
+
+    changed = [
+        fm['name'] for fm in result['functions']
+        if any(fm['startLine'] <= end and start <= fm['endLine'] for start, end in spans)
+    ]
+    return encoded_response(request, {
+        **result, 'previousResultId': req.resultId,
+        'changedSpans': [{'startLine': start, 'endLine': end} for start, end in spans],
+        'changedFunctions': changed
+    }, detail, compact)
+
+BATCH_MAX_ITEMS = int(os.environ.get('ANALYSIS_BATCH_MAX_ITEMS', '1000'))
+
+async def _analyze_batch_item(index: int, item: AnalyzeRequest) -> dict:
+    result = await analyze_with_retry(item.code, item.filename, rule_overrides(item.rules))
+    if 'error' in result:
+        return {'index': index, 'filename': item.filename, **result}
+    return {**result, 'index': index}
+
+async def _iterate(items):
+    for item in items:
+        yield item
+
+async def batch_lines(items, detail: DetailLevel = 'full', compact: bool = False, rollup: bool = False):
+    """One NDJSON line per item (a list or an async iterable), in completion order; each line carries its item index.
+
+    With rollup, a final {"rollup": ...} line aggregates the batch like an archive.
+    """
+    # Keep the pool saturated while holding only a window of items in memory and in its queue
+    window = max(1, analysis_pool.small.workers + analysis_pool.large.workers) * 2
+    source = items if hasattr(items, '__aiter__') else _iterate(items)
+    running = set()
+    index = 0
+    totals = RepoRollup() if rollup else None
+    try:
+        while True:
+            while len(running) < window and (item := await anext(source, None)) is not None:
+                running.add(asyncio.ensure_future(_analyze_batch_item(index, item)))
+                index += 1
+            if not running:
+                break
+            done, running = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                result = task.result()
+                if 'error' not in result:
+                    history_writer.add(history_record(result))
+                    if totals is not None:
+                        totals.add(result['filename'], result)
+                elif totals is not None:
+                    totals.errors += 1
+                yield dump_json(shape_result(result, detail, compact)) + b'\n'
+        if totals is not None:
+            yield dump_json({'rollup': await asyncio.to_thread(totals.snapshot)}) + b'\n'
+    finally:
+        for task in running:
+            task.cancel()
+
+@api_router.post("/analyze/batch")
+async def analyze_batch_endpoint(req: BatchAnalyzeRequest, detail: DetailLevel = 'full', compact: bool = False,
+                                 rollup: bool = False):
+    """Stream one NDJSON line per item (see batch_lines); larger batches go through /api/jobs."""
+    if len(req.items) > BATCH_MAX_ITEMS:
+        raise HTTPException(status_code=413, detail=f"Batch exceeds {BATCH_MAX_ITEMS} items")
+    return StreamingResponse(batch_lines(req.items, detail, compact, rollup), media_type='application/x-ndjson')
+
+@api_router.post("/analyze/archive")
+async def analyze_archive_endpoint(request: Request):
+    """Raw .tar(.gz|.bz2|.xz) or .zip request body; streams per-file NDJSON and a repo rollup."""
+    return DuplexStreamingResponse(stream_archive_analysis(request.stream()), media_type='application/x-ndjson')
+
+@api_router.post("/analyze/stream")
+async def analyze_stream_endpoint(request: Request, filename: str = Query(..., min_length=1), rules: Optional[str] = None,
+                                  detail: DetailLevel = 'full', compact: bool = False):
+    """Raw source as the request body (text/plain, any length, chunked or not); rules is the JSON rule config."""
+    overrides = None
+    if rules:
+        try:
+            overrides = rule_overrides(RuleOverrides.model_validate({'rules': json.loads(rules)}).rules)
+        except ValueError as e:
+            raise HTTPException(status_code=422, detail=f"Invalid rules: {e}")
+    result = await analyze_stream(request.stream(), filename, overrides)
+    if 'error' not in result:
+        history_writer.add(history_record(result))
+    return encoded_response(request, result, detail, compact)
+
+async def batch_job_input(items: list):
+    """A batch job's stored input: one JSON item per line, so runners can read it a window at a time."""
+    for item in items:
+        yield dump_json(item.model_dump(exclude_none=True)) + b'\n'
+
+async def batch_job_items(job_id: str):
+    pending = b''
+    async for chunk in read_chunks(job_id, 'input'):
+        *lines, pending = (pending + chunk).split(b'\n')
+        for line in lines:
+            yield AnalyzeRequest.model_validate_json(line)
+
+async def find_job(job_id: str) -> dict:
+    job = await db.analysis_jobs.find_one({'_id': job_id})
+    if job is None:
+        raise HTTPException(status_code=404, detail="Unknown or expired job")
+    return job
+
+@api_router.post("/jobs", status_code=202)
+async def submit_batch_job(req: BatchAnalyzeRequest, response: Response, detail: DetailLevel = 'full',
+                           compact: bool = False, rollup: bool = False):
+    """Queue a batch too large for /analyze/batch; its result is the NDJSON that endpoint would stream."""
+    if len(req.items) > JOB_MAX_ITEMS:
+        raise HTTPException(status_code=413, detail=f"Job exceeds {JOB_MAX_ITEMS} items")
+    params = {'detail': detail, 'compact': compact, 'rollup': rollup}
+    job = await submit_job('batch', params, batch_job_input(req.items))
+    response.headers['Location'] = f"/api/jobs/{job['_id']}"
+    return job_status(job)
+
+@api_router.post("/jobs/archive", status_code=202)
+async def submit_archive_job(request: Request, response: Response):
+    """Queue a raw .tar(.gz|.bz2|.xz) or .zip body, stored as it arrives; its result is the /analyze/archive NDJSON."""
+    job = await submit_job('archive', {}, request.stream())
+    response.headers['Location'] = f"/api/jobs/{job['_id']}"
+    return job_status(job)
+
+@api_router.get("/jobs/stats")
+async def job_stats():
+    """Jobs per status across all nodes, plus this process's runners."""
+    counts = dict.fromkeys(JOB_STATUSES, 0)
+    rows = await db.analysis_jobs.aggregate([{'$group': {'_id': '$status', 'count': {'$sum': 1}}}]).to_list(None)
+    for row in rows:
+        counts[row['_id']] = row['count']
+    return {'jobs': counts, 'runner': job_runner.snapshot()}
+
+@api_router.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    """Status and progress; resultLines counts the NDJSON lines written so far."""
+    return job_status(await find_job(job_id))
+
+@api_router.get("/jobs/{job_id}/result")
+async def get_job_result(job_id: str):
+    job = await find_job(job_id)
+    if job['status'] != 'done':
+        raise HTTPException(status_code=409, detail=f"Job is {job['status']}")
+    return StreamingResponse(
+        read_chunks(job_id, job['resultPart']), media_type='application/x-ndjson',
+        headers={'Content-Length': str(job['resultBytes'])}
+    )
+
+@api_router.delete("/jobs/{job_id}")
+async def cancel_job(job_id: str):
+    """Cancel a queued or running job; a runner working on it stops at its next lease renewal."""
+    job = await db.analysis_jobs.find_one_and_update(
+        {'_id': job_id, 'status': {'$in': ['queued', 'running']}},
+        {'$set': {'status': 'cancelled', 'finishedAt': datetime.now(timezone.utc)}, '$unset': LEASE_FIELDS},
+        return_document=ReturnDocument.AFTER
+    )
+    if job is None:
+        raise HTTPException(status_code=409, detail=f"Job is already {(await find_job(job_id))['status']}")
+    await delete_chunks(job_id)
+    return job_status(job)
+
+@api_router.get("/clones/{result_id}")
+async def get_clones(result_id: str, minSimilarity: float = Query(0.8, ge=CLONE_MIN_SIMILARITY, le=1),
+                     limit: int = Query(50, ge=1, le=500)):
+    """Functions in previously analyzed sources that duplicate functions of this result, the most similar first."""
+    clones = await find_clones(result_id, minSimilarity, limit)
+    if clones is None:
+        raise HTTPException(status_code=404, detail="Unknown or expired resultId")
+    return clones
+
+@api_router.websocket("/live")
+async def live_endpoint(websocket: WebSocket, detail: DetailLevel = 'full', compact: bool = False):
+    """Live analysis of one document: an open message, then edit messages; results come back as deltas."""
+    client = websocket.client.host if websocket.client else ''
+    await websocket.accept()
+    if not live_sessions.admit(client):
+        await websocket.close(code=WS_TRY_AGAIN, reason="Too many live sessions")
+        return
+    try:
+        await run_live_session(websocket, detail, compact)
+    except WebSocketDisconnect:
+        pass
+    except asyncio.TimeoutError:
+        await websocket.close(code=1000, reason="Idle timeout")
+    except LiveLimitExceeded as e:
+        await websocket.close(code=WS_TOO_BIG, reason=str(e))
+    finally:
+        live_sessions.release(client)
+
+@api_router.get("/live/stats")
+async def live_stats():
+    return live_sessions.snapshot()
+
+@api_router.get("/rules")
+async def list_rules():
+    return [r.describe() for r in RULES.values()]
+
+@api_router.get("/history")
+async def get_history(
+    response: Response,
+    limit: int = Query(50, ge=1, le=HISTORY_PAGE_MAX),
+    cursor: Optional[str] = None,
+    language: Optional[str] = None,
+    filenamePrefix: Optional[str] = None,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+):
+    """Newest records first; when more may follow, X-Next-Cursor holds the cursor for the next page."""
+    query = history_query(language, filenamePrefix, since, until, cursor)
+    records = await db.analysis_history.find(query, {"_id": 0}).sort(
+        [("timestamp", -1), ("id", -1)]
+    ).limit(limit).to_list(limit)
+    if len(records) == limit:
+        response.headers['X-Next-Cursor'] = encode_history_cursor(records[-1])
+    return records
+
+@api_router.get("/history/stats")
+async def get_history_stats(
+    granularity: str = Query('day', pattern='^(hour|day)$'),
+    language: Optional[str] = None,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+):
+    """Complexity and maintainability trends per hour or day, read from the rollup documents."""
+    if since is None:
+        since = (until or datetime.now(timezone.utc)) - ROLLUP_DEFAULT_SPAN[granularity]
+    pipeline = history_stats_pipeline(granularity, language, since, until)
+    facets = await db.analysis_rollups.aggregate(pipeline).to_list(1)
+    totals = facets[0]['totals'] if facets else []
+    return {
+        'granularity': granularity, 'language': language,
+        'since': iso_timestamp(since), 'until': iso_timestamp(until) if until else None,
+        'buckets': facets[0]['buckets'] if facets else [],
+        'totals': totals[0] if totals else {'count': 0}
+    }
+
+@api_router.get("/trends/{repo}")
+async def get_repo_trend(repo: str, since: Optional[datetime] = None, until: Optional[datetime] = None,
+                         limit: int = Query(1000, ge=1, le=TREND_PAGE_MAX)):
+    """Per-commit repository totals written by git_trends.py, oldest first."""
+    points = await read_trend(db.analysis_trend_commits, trend_query(repo, since, until), limit)
+    return {'repo': repo, 'count': len(points), 'points': points}
+
+@api_router.get("/trends/{repo}/file")
+async def get_file_trend(repo: str, path: str = Query(..., min_length=1), since: Optional[datetime] = None,
+                         until: Optional[datetime] = None, limit: int = Query(1000, ge=1, le=TREND_PAGE_MAX)):
+    """One file's metrics at each commit that changed it, oldest first; deletions are points with deleted set."""
+    points = await read_trend(db.analysis_trend_files, trend_query(repo, since, until, path), limit)
+    return {'repo': repo, 'path': path, 'count': len(points), 'points': points}
+
+@api_router.get("/history/writer/stats")
+async def history_writer_stats():
+    return history_writer.snapshot()
+
+@api_router.get("/cache/stats")
+async def cache_stats():
+    return {**result_cache.snapshot(), 'spanMemo': span_memo_snapshot()}
+
+@api_router.get("/pool/stats")
+async def pool_stats():
+    return {**analysis_pool.snapshot(), 'budget': budget_snapshot(), 'scheduler': scheduler_snapshot()}
+
+@api_router.get("/metrics")
+async def prometheus_metrics():
+    """Prometheus text exposition; counters are per server process."""
+    return Response(metrics.render(), media_type='text/plain; version=0.0.4; charset=utf-8')
+
+@api_router.get("/health")
+async def health():
+    return {"status": "ok", "service": "NoseyCoder API"}
+
+# Include router
+app.include_router(api_router)
+
+# Inside CORS, so a rate-limited browser can still read its 429
+app.add_middleware(FairSchedulingMiddleware)
+app.add_middleware(
+    CORSMiddleware,
+    allow_credentials=True,
+    allow_origins=os.environ.get('CORS_ORIGINS', '*').split(','),
+    allow_methods=["*"],
+    allow_headers=["*"],
+    expose_headers=["X-Next-Cursor", "Server-Timing", "ETag"],
+)
+app.add_middleware(StageTimingMiddleware)
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+@app.on_event("startup")
+async def start_analysis_pool():
+    analysis_pool.start()
+    history_writer.start()
+    job_runner.start(JOB_RUNNERS)
+
+@app.on_event("startup")
+async def prepare_history_collections():
+    try:
+        await db.analysis_history.create_index([('timestamp', -1), ('id', -1)])
+        await db.analysis_history.create_index([('language', 1), ('timestamp', -1), ('id', -1)])
+        await db.analysis_history.create_index([('filename', 1), ('timestamp', -1)])
+        await db.analysis_rollups.create_index([('granularity', 1), ('bucket', 1), ('language', 1)])
+        # Rollups are maintained by history flushes; build them once for history that predates them
+        if not await db.analysis_rollups.find_one({}) and await db.analysis_history.find_one({}):
+            for granularity in ROLLUP_GRANULARITIES:
+                await db.analysis_history.aggregate(rollup_rebuild_pipeline(granularity)).to_list(None)
+    except Exception as e:
+        logger.warning("analysis_history setup failed: %s", e)
+
+@app.on_event("startup")
+async def prepare_analysis_cache():
+    ttl = int(result_cache.ttl)
+    try:
+        await db.analysis_cache.create_index('createdAt', expireAfterSeconds=ttl)
+        # Results from other analyzer releases can never be hit again
+        await db.analysis_cache.delete_many({'version': {'$nin': list(ANALYZER_VERSIONS.values())}})
+        await db.analysis_sources.create_index('createdAt', expireAfterSeconds=SOURCE_TTL)
+    except Exception as e:
+        logger.warning("analysis_cache setup failed: %s", e)
+
+@app.on_event("startup")
+async def prepare_clone_index():
+    try:
+        await db.clone_fingerprints.create_index('sketch')
+        await db.clone_fingerprints.create_index('createdAt', expireAfterSeconds=CLONE_INDEX_TTL)
+        # Fingerprints from other analyzer releases may be normalized differently
+        await db.clone_fingerprints.delete_many({'version': {'$nin': list(ANALYZER_VERSIONS.values())}})
+    except Exception as e:
+        logger.warning("clone_fingerprints setup failed: %s", e)
+
+@app.on_event("startup")
+async def prepare_trend_collections():
+    """Also called by git_trends.py, which may run before the server ever has."""
+    try:
+        await db.analysis_trend_commits.create_index([('repo', 1), ('depth', -1)])
+        await db.analysis_trend_files.create_index([('repo', 1), ('path', 1), ('depth', -1)])
+        # Summaries from other analyzer releases are never looked up again
+        await db.analysis_blob_summaries.delete_many({'version': {'$nin': list(ANALYZER_VERSIONS.values())}})
+    except Exception as e:
+        logger.warning("trend collections setup failed: %s", e)
+
+@app.on_event("startup")
+async def prepare_job_collections():
+    """Also called by job_worker.py."""
+    try:
+        await db.analysis_jobs.create_index([('status', 1), ('createdAt', 1)])
+        await db.analysis_jobs.create_index([('status', 1), ('leaseExpiresAt', 1)])
+        # finishedAt is only set once a job is done, failed or cancelled, so queued and running jobs never expire
+        for collection in (db.analysis_jobs, db.analysis_job_chunks):
+            if 'createdAt_1' in await collection.index_information():
+                await collection.drop_index('createdAt_1')
+            await collection.create_index('finishedAt', expireAfterSeconds=JOB_TTL)
+        await db.analysis_job_chunks.create_index([('job', 1), ('part', 1), ('n', 1)])
+    except Exception as e:
+        logger.warning("analysis_jobs setup failed: %s", e)
 
 @app.on_event("shutdown")
 async def shutdown_db_client():
+    await job_runner.close()
+    analysis_pool.shutdown()
+    await history_writer.close()
     client.close()
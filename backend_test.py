@@ -6,13 +6,48 @@ Validates JavaScript and Python code analysis functionality
 """
 
 import requests
+from websockets.sync.client import connect as open_websocket
+import asyncio
+import hashlib
+import io
 import json
+import os
 import sys
+import tarfile
+import time
 from datetime import datetime
+from pathlib import Path
 
 # Use the public URL for testing
 BACKEND_URL = "https://github-metrics-hub.preview.emergentagent.com"
 API_BASE = f"{BACKEND_URL}/api"
+WS_BASE = API_BASE.replace("http", "ws", 1)
+
+# SHA-256 prefixes of the detail=full and compact bodies for each benchmark corpus (1000 lines, regex
+# Python engine), as served before FunctionSpan records. Update them only with ANALYZER_VERSION.
+RESULT_DIGESTS = {
+    "javascript/many_small": ("7a8aeb6652ca4d6a", "20489cffbbc612b8"),
+    "javascript/huge_function": ("d5dc2147114b25d9", "6ddcc100ad8c473b"),
+    "javascript/deep_nesting": ("50eeae11399636dd", "0058df6c67d83fc4"),
+    "javascript/long_strings": ("b102f3dce9e2206d", "c75963d629a9203f"),
+    "typescript/many_small": ("b8cb37a4cad95ce9", "ac3b2f0267662129"),
+    "typescript/huge_function": ("ca840a8eb61bc163", "d33ef11eb0a49874"),
+    "typescript/deep_nesting": ("b9fa751803e67bc7", "a9f1eaf9c3ebef8f"),
+    "typescript/long_strings": ("117913178bc82836", "8682a14e846853a9"),
+    "python/many_small": ("fd3b196fd75ec39b", "e6059c2a709dc6f1"),
+    "python/huge_function": ("7a5b2976c85e105e", "8bca1a830cf0241a"),
+    "python/deep_nesting": ("8095b30435f85238", "3676cb72d2a1a4b2"),
+    "python/long_strings": ("1748b4dfdda036a3", "dbf3f320fde95fcf"),
+}
+
+def load_server():
+    """backend/server.py imported into this process, for tests that drive the worker pool directly."""
+    sys.path.insert(0, str(Path(__file__).resolve().parent / "backend"))
+    # server.py connects lazily; these only need to be present
+    os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+    os.environ.setdefault("DB_NAME", "noseycoder_test")
+    import server
+    return server
 
 class CodeScopeAPITester:
     def __init__(self):
@@ -299,6 +334,195 @@ def validate_config(config):
             self.log_test("History endpoint", False, f"Request error: {str(e)}")
             return False
 
+    def test_history_writer_stats(self):
+        """Test that history records are queued and flushed behind the response"""
+        try:
+            before = requests.get(f"{API_BASE}/history/writer/stats", timeout=10).json()
+            payload = {"code": "def queued(a):\n    return a or 1\n", "filename": "queued.py"}
+            requests.post(f"{API_BASE}/analyze", json=payload, timeout=10)
+            for _ in range(20):
+                after = requests.get(f"{API_BASE}/history/writer/stats", timeout=10).json()
+                if after.get('written', 0) > before.get('written', 0):
+                    break
+                time.sleep(0.25)
+
+            if after.get('enqueued', 0) > before.get('enqueued', 0) and 'queueDepth' in after:
+                self.log_test("History writer stats", True,
+                              f"Written: {after.get('written')}, queue depth: {after.get('queueDepth')}, "
+                              f"avg flush: {after.get('avgFlushSeconds')}s")
+                return True
+            else:
+                self.log_test("History writer stats", False, f"Record was not queued: {after}")
+                return False
+
+        except Exception as e:
+            self.log_test("History writer stats", False, f"Request error: {str(e)}")
+            return False
+
+    def test_server_timing_and_metrics(self):
+        """Test Server-Timing stages on analyze and the Prometheus metrics endpoint"""
+        try:
+            payload = {"code": f"function timed(a) {{ return a + {int(time.time())}; }}", "filename": "timed.js"}
+            response = requests.post(f"{API_BASE}/analyze", json=payload, timeout=10)
+            timing = response.headers.get('Server-Timing', '')
+            stages = {entry.split(';')[0].strip() for entry in timing.split(',') if entry}
+            metrics = requests.get(f"{API_BASE}/metrics", timeout=10)
+
+            expected = {'extract', 'spans', 'lint', 'serialize', 'total'}
+            if (expected <= stages and metrics.status_code == 200
+                    and 'noseycoder_stage_duration_seconds_bucket' in metrics.text
+                    and 'noseycoder_input_lines_count{language="javascript"}' in metrics.text):
+                self.log_test("Server-Timing and metrics", True, f"Server-Timing: {timing}")
+                return True
+            else:
+                self.log_test("Server-Timing and metrics", False,
+                              f"Stages: {sorted(stages)}, metrics status: {metrics.status_code}")
+                return False
+
+        except Exception as e:
+            self.log_test("Server-Timing and metrics", False, f"Request error: {str(e)}")
+            return False
+
+    def test_stream_analysis(self):
+        """Test that a raw streamed body gives the same metrics as /analyze"""
+        try:
+            code = "\n".join(
+                f"function part{i}(a, b) {{\n  if (a > b && b > {i}) {{ return a; }}\n  return b;\n}}" for i in range(200)
+            ) + "\n"
+            streamed = requests.post(f"{API_BASE}/analyze/stream", params={"filename": "stream.js"},
+                                     data=code.encode(), headers={"Content-Type": "text/plain"}, timeout=30)
+            whole = requests.post(f"{API_BASE}/analyze", json={"code": code, "filename": "stream.js"}, timeout=30)
+            if streamed.status_code != 200 or whole.status_code != 200:
+                self.log_test("Streaming analysis", False, f"Status {streamed.status_code} / {whole.status_code}")
+                return False
+
+            result, expected = streamed.json(), whole.json()
+            if (result['summary'] == expected['summary'] and len(result['functions']) == 200
+                    and result['functions'][-1]['startLine'] == expected['functions'][-1]['startLine']):
+                self.log_test("Streaming analysis", True,
+                              f"Functions: {len(result['functions'])}, chunks: {result['streamed']['chunks']}")
+                return True
+            else:
+                self.log_test("Streaming analysis", False, f"Streamed summary differs: {result['summary']}")
+                return False
+
+        except Exception as e:
+            self.log_test("Streaming analysis", False, f"Request error: {str(e)}")
+            return False
+
+    def test_degraded_analysis(self):
+        """Test that a source with a pathologically long line gets a flagged summary-only result"""
+        try:
+            code = "const table = [" + ", ".join(str(i) for i in range(20000)) + "];\nfunction f(a) { return a ? 1 : 2; }\n"
+            response = requests.post(f"{API_BASE}/analyze", json={"code": code, "filename": "table.js"}, timeout=60)
+            if response.status_code != 200:
+                self.log_test("Degraded analysis", False, f"Status code: {response.status_code}")
+                return False
+
+            result = response.json()
+            degraded = result.get('degraded') or {}
+            stats = requests.get(f"{API_BASE}/pool/stats", timeout=10).json()
+            recent = stats.get('budget', {}).get('recentDegraded', [])
+            if (degraded.get('reason') == 'long_line' and result['functions'] == []
+                    and result['summary']['loc'] == 3 and result['summary']['cyclomaticComplexity'] == 2
+                    and any(r['resultId'] == result['resultId'] for r in recent)):
+                self.log_test("Degraded analysis", True, degraded['detail'])
+                return True
+            else:
+                self.log_test("Degraded analysis", False, f"Unexpected result: {degraded}, {result['summary']}")
+                return False
+
+        except Exception as e:
+            self.log_test("Degraded analysis", False, f"Request error: {str(e)}")
+            return False
+
+    def test_detail_levels_and_compact(self):
+        """Test detail levels and the compact encoding against the full result"""
+        try:
+            code = "function a(x) { return x ? 1 : 2; }\nfunction b(y) {\n  if (y > 1 && y < 9) { return y; }\n  return 0;\n}\n"
+            payload = {"code": code, "filename": "detail.js"}
+            full = requests.post(f"{API_BASE}/analyze", json=payload, timeout=30).json()
+            summary = requests.post(f"{API_BASE}/analyze", params={"detail": "summary"}, json=payload, timeout=30).json()
+            compact = requests.post(f"{API_BASE}/analyze", params={"compact": "true"}, json=payload, timeout=30).json()
+            invalid = requests.post(f"{API_BASE}/analyze", params={"detail": "everything"}, json=payload, timeout=30)
+
+            fn, packed = full['functions'][1], compact['functions'][1]
+            levels = compact['levels']['complexity']
+            if ('functions' in summary or summary['summary'] != full['summary']
+                    or summary['issueCount'] != len(full['linterIssues'])):
+                self.log_test("Detail levels and compact", False, f"Bad summary detail: {list(summary)}")
+                return False
+            if (levels[packed['complexityLevel']] != fn['complexityLevel'] or 'heatmap' in compact
+                    or dict(zip(compact['halsteadFields'], packed['halstead'])) != fn['halstead']
+                    or invalid.status_code != 422):
+                self.log_test("Detail levels and compact", False, f"Compact function differs: {packed}")
+                return False
+            self.log_test("Detail levels and compact", True, f"Compact keys: {sorted(packed)[:4]}...")
+            return True
+
+        except Exception as e:
+            self.log_test("Detail levels and compact", False, f"Request error: {str(e)}")
+            return False
+
+    def test_conditional_requests(self):
+        """Test ETag revalidation, the digest probe and compression of large results"""
+        try:
+            code = "".join(f"function f{i}(a) {{ return a > {i} ? a : {i}; }}\n" for i in range(300))
+            payload = {"code": code, "filename": "etag.js"}
+            first = requests.post(f"{API_BASE}/analyze", json=payload, headers={"Accept-Encoding": "gzip"}, timeout=30)
+            etag = first.headers.get("ETag")
+            again = requests.post(f"{API_BASE}/analyze", json=payload, headers={"If-None-Match": etag}, timeout=30)
+            digest = hashlib.sha256(code.encode()).hexdigest()
+            probe = requests.post(f"{API_BASE}/analyze/probe", json={"digest": digest, "filename": "etag.js"}, timeout=30)
+            missing = requests.post(f"{API_BASE}/analyze/probe", json={"digest": "0" * 64, "filename": "etag.js"}, timeout=30)
+
+            if first.status_code != 200 or not etag or first.headers.get("Content-Encoding") != "gzip":
+                self.log_test("Conditional requests", False, f"First response: {first.status_code} {dict(first.headers)}")
+                return False
+            if (again.status_code != 304 or probe.status_code != 200 or missing.status_code != 404
+                    or probe.json()['summary'] != first.json()['summary']):
+                self.log_test("Conditional requests", False,
+                              f"Revalidate {again.status_code}, probe {probe.status_code}, missing {missing.status_code}")
+                return False
+            self.log_test("Conditional requests", True, f"ETag {etag}, 304 on revalidation, probe hit")
+            return True
+
+        except Exception as e:
+            self.log_test("Conditional requests", False, f"Request error: {str(e)}")
+            return False
+
+    def test_history_pagination_and_stats(self):
+        """Test cursor pagination, filters and rollup stats on history"""
+        try:
+            first = requests.get(f"{API_BASE}/history", params={"limit": 1}, timeout=10)
+            if first.status_code != 200 or len(first.json()) > 1:
+                self.log_test("History pagination and stats", False, f"First page: {first.status_code}")
+                return False
+            cursor = first.headers.get('X-Next-Cursor')
+            if cursor:
+                second = requests.get(f"{API_BASE}/history", params={"limit": 1, "cursor": cursor}, timeout=10).json()
+                if second and second[0]['id'] == first.json()[0]['id']:
+                    self.log_test("History pagination and stats", False, "Cursor returned the same record again")
+                    return False
+
+            filtered = requests.get(f"{API_BASE}/history", params={"language": "python", "filenamePrefix": "queued"}, timeout=10).json()
+            if any(r['language'] != 'python' or not r['filename'].startswith('queued') for r in filtered):
+                self.log_test("History pagination and stats", False, "Filter returned non-matching records")
+                return False
+
+            stats = requests.get(f"{API_BASE}/history/stats", params={"granularity": "hour"}, timeout=10)
+            if stats.status_code == 200 and isinstance(stats.json().get('buckets'), list):
+                self.log_test("History pagination and stats", True,
+                              f"Filtered: {len(filtered)}, hourly buckets: {len(stats.json()['buckets'])}")
+                return True
+            else:
+                self.log_test("History pagination and stats", False, f"Stats: {stats.status_code}")
+                return False
+
+        except Exception as e:
+            self.log_test("History pagination and stats", False, f"Request error: {str(e)}")
+            return False
+
     def test_malformed_requests(self):
         """Test API error handling with malformed requests"""
         try:
@@ -319,6 +543,666 @@ def validate_config(config):
             self.log_test("Malformed request handling", False, f"Request error: {str(e)}")
             return False
 
+    def test_nested_function_metrics(self):
+        """Test parent ids and inclusive/exclusive metrics for nested functions"""
+        try:
+            code = "function outer(items) {\n  if (!items) { return []; }\n  const pick = (item) => {\n    if (item.ok) { return item.value; }\n    return null;\n  };\n  return items.map(pick);\n}"
+            response = requests.post(f"{API_BASE}/analyze", json={"code": code, "filename": "nested.js"}, timeout=10)
+            if response.status_code != 200:
+                self.log_test("Nested function metrics", False, f"Status code: {response.status_code}")
+                return False
+            functions = {fn['name']: fn for fn in response.json().get('functions', [])}
+            outer, inner = functions.get('outer'), functions.get('pick')
+            if not outer or not inner:
+                self.log_test("Nested function metrics", False, f"Functions found: {list(functions)}")
+                return False
+            ok = (
+                inner['parentId'] == outer['id'] and outer['parentId'] is None
+                and outer['cyclomaticComplexity'] == 3 and outer['exclusive']['cyclomaticComplexity'] == 2
+                and inner['exclusive']['cyclomaticComplexity'] == inner['cyclomaticComplexity'] == 2
+            )
+            details = f"outer CC {outer['cyclomaticComplexity']} (exclusive {outer['exclusive']['cyclomaticComplexity']}), inner parent {inner['parentId']}"
+            self.log_test("Nested function metrics", ok, details)
+            return ok
+
+        except Exception as e:
+            self.log_test("Nested function metrics", False, f"Request error: {str(e)}")
+            return False
+
+    def test_cache_stats_endpoint(self):
+        """Test that repeat analyses are served from the result cache"""
+        try:
+            payload = {"code": "function cached(a) { return a ? 1 : 2; }", "filename": "cached.js"}
+            requests.post(f"{API_BASE}/analyze", json=payload, timeout=10)
+            before = requests.get(f"{API_BASE}/cache/stats", timeout=10).json()
+            requests.post(f"{API_BASE}/analyze", json=payload, timeout=10)
+            after = requests.get(f"{API_BASE}/cache/stats", timeout=10).json()
+
+            hits_before = before.get('memoryHits', 0) + before.get('mongoHits', 0)
+            hits_after = after.get('memoryHits', 0) + after.get('mongoHits', 0)
+            if hits_after <= hits_before:
+                self.log_test("Cache stats endpoint", False, f"Repeat analysis was not cached: {after}")
+                return False
+
+            # A source never analyzed before misses the result cache and looks its segments up in the span memo
+            fresh = {"code": f"function fresh() {{ return {time.time_ns()}; }}", "filename": "fresh.js"}
+            requests.post(f"{API_BASE}/analyze", json=fresh, timeout=10)
+            memo = requests.get(f"{API_BASE}/cache/stats", timeout=10).json().get('spanMemo', {})
+            lookups_before = sum(after.get('spanMemo', {}).get(k, 0) for k in ('hits', 'misses'))
+            if memo.get('hits', 0) + memo.get('misses', 0) > lookups_before and 'hitRate' in memo:
+                self.log_test("Cache stats endpoint", True,
+                              f"Hits: {hits_after}, Misses: {after.get('misses')}, span memo: {memo}")
+                return True
+            self.log_test("Cache stats endpoint", False, f"Span memo lookups not counted: {memo}")
+            return False
+
+        except Exception as e:
+            self.log_test("Cache stats endpoint", False, f"Request error: {str(e)}")
+            return False
+
+    def test_rule_overrides(self):
+        """Test per-request rule thresholds and disabling rules"""
+        try:
+            code = "function branchy(a, b) {\n  if (a) { return 1; }\n  if (b) { return 2; }\n  return a && b ? 3 : 4;\n}"
+            rules = {
+                "high-complexity": {"thresholds": {"max": 2}},
+                "multiple-returns": {"enabled": False}
+            }
+            response = requests.post(f"{API_BASE}/analyze", json={"code": code, "filename": "rules.js", "rules": rules}, timeout=10)
+            if response.status_code != 200:
+                self.log_test("Rule overrides", False, f"Status code: {response.status_code}")
+                return False
+            issue_rules = {issue['rule'] for issue in response.json().get('linterIssues', [])}
+            if 'high-complexity' not in issue_rules or 'multiple-returns' in issue_rules:
+                self.log_test("Rule overrides", False, f"Unexpected issues: {issue_rules}")
+                return False
+
+            bad = requests.post(f"{API_BASE}/analyze", json={"code": code, "filename": "rules.js", "rules": {"no-such-rule": {}}}, timeout=10)
+            listed = requests.get(f"{API_BASE}/rules", timeout=10).json()
+            if bad.status_code == 422 and any(r['id'] == 'high-complexity' for r in listed):
+                self.log_test("Rule overrides", True, f"Issues: {sorted(issue_rules)}, {len(listed)} rules registered")
+                return True
+            else:
+                self.log_test("Rule overrides", False, f"Unknown rule status: {bad.status_code}")
+                return False
+
+        except Exception as e:
+            self.log_test("Rule overrides", False, f"Request error: {str(e)}")
+            return False
+
+    def test_batch_analysis(self):
+        """Test /api/analyze/batch NDJSON streaming with an unsupported item"""
+        try:
+            payload = {"items": [
+                {"code": "function a(x) { return x && 1; }", "filename": "a.js"},
+                {"code": "def b(x):\n    return x or 1\n", "filename": "b.py"},
+                {"code": "SELECT 1;", "filename": "c.sql"}
+            ]}
+            response = requests.post(f"{API_BASE}/analyze/batch", json=payload, timeout=30)
+
+            if response.status_code == 200:
+                lines = [json.loads(line) for line in response.text.splitlines() if line.strip()]
+                by_index = {line.get('index'): line for line in lines}
+                if sorted(by_index) != [0, 1, 2]:
+                    self.log_test("Batch analysis", False, f"Expected indexes 0-2, got: {sorted(by_index)}")
+                    return False
+                if 'error' not in by_index[2] or 'summary' not in by_index[0] or 'summary' not in by_index[1]:
+                    self.log_test("Batch analysis", False, f"Unexpected item results: {lines}")
+                    return False
+                self.log_test("Batch analysis", True, f"Streamed {len(lines)} results, inline error: {by_index[2]['error']}")
+                return True
+            else:
+                self.log_test("Batch analysis", False, f"HTTP {response.status_code}")
+                return False
+
+        except Exception as e:
+            self.log_test("Batch analysis", False, f"Request error: {str(e)}")
+            return False
+
+    def test_batch_rollup_distributions(self):
+        """Test the batch rollup line with per-function distributions and z-score outliers"""
+        try:
+            items = [{"code": f"function small{i}(a) {{ return a + {i}; }}\n", "filename": f"s{i}.js"} for i in range(30)]
+            branches = "".join(f"  if (x === {i} || y > {i}) {{ x += {i}; }}\n" for i in range(40))
+            items.append({"code": f"function tangled(x, y) {{\n{branches}  return x;\n}}\n", "filename": "tangled.js"})
+            response = requests.post(f"{API_BASE}/analyze/batch", params={"rollup": "true", "detail": "summary"},
+                                     json={"items": items}, timeout=60)
+            lines = [json.loads(line) for line in response.text.splitlines() if line.strip()]
+            rollup = lines[-1].get('rollup') if lines else None
+            if response.status_code != 200 or not rollup:
+                self.log_test("Batch rollup distributions", False, f"HTTP {response.status_code}, last line: {lines[-1:]}")
+                return False
+
+            metrics = rollup['functionMetrics']
+            cc = metrics['cyclomaticComplexity']
+            outlier_names = {o['name'] for o in metrics['outliers'] if o['metric'] == 'cyclomaticComplexity'}
+            if (rollup['files'] == 31 and metrics['functions'] == 31 and cc['p50'] == 1
+                    and sum(b['count'] for b in cc['histogram']) == 31 and outlier_names == {'tangled'}):
+                self.log_test("Batch rollup distributions", True, f"CC p90: {cc['p90']}, outliers: {outlier_names}")
+                return True
+            self.log_test("Batch rollup distributions", False, f"Unexpected rollup: {metrics}")
+            return False
+
+        except Exception as e:
+            self.log_test("Batch rollup distributions", False, f"Request error: {str(e)}")
+            return False
+
+    def test_duplicate_logic_clones(self):
+        """Test the duplicate-logic rule within a file and the cross-file clone lookup"""
+        def copy_of(name, items, limit):
+            return (
+                f"function {name}({items}, {limit}, tax) {{\n"
+                f"  let total = 0;\n"
+                f"  for (let i = 0; i < {items}.length; i++) {{\n"
+                f"    if ({items}[i].price > {limit} && {items}[i].active) {{\n"
+                f"      total += {items}[i].price * (1 + tax);\n"
+                f"    }} else {{\n"
+                f"      total -= {items}[i].discount || 0;\n"
+                f"    }}\n"
+                f"  }}\n"
+                f"  while (total > 1000) {{ total = total / 2; }}\n"
+                f"  return total;\n"
+                f"}}\n"
+            )
+        try:
+            first = copy_of("sumCart", "items", "limit") + "\n" + copy_of("sumOrder", "lines", "max")
+            response = requests.post(f"{API_BASE}/analyze", json={"code": first, "filename": "clones_a.js"}, timeout=30)
+            result = response.json()
+            duplicates = [i for i in result.get('linterIssues', []) if i['rule'] == 'duplicate-logic']
+            if response.status_code != 200 or len(duplicates) != 1 or 'cloneFingerprints' in result:
+                self.log_test("Duplicate logic and clones", False, f"HTTP {response.status_code}, issues: {duplicates}")
+                return False
+
+            second = "const rate = 2;\n" + copy_of("cartTotal", "rows", "cap")
+            response = requests.post(f"{API_BASE}/analyze", json={"code": second, "filename": "clones_b.js"}, timeout=30)
+            clones = requests.get(f"{API_BASE}/clones/{response.json()['resultId']}", timeout=30).json()
+            matched = {(c['match']['filename'], c['match']['name']) for c in clones.get('clones', [])}
+            missing = requests.get(f"{API_BASE}/clones/{'0' * 64}", timeout=30)
+            if {("clones_a.js", "sumCart"), ("clones_a.js", "sumOrder")} <= matched and missing.status_code == 404:
+                self.log_test("Duplicate logic and clones", True, duplicates[0]['message'])
+                return True
+            self.log_test("Duplicate logic and clones", False, f"Unexpected clones: {clones}")
+            return False
+
+        except Exception as e:
+            self.log_test("Duplicate logic and clones", False, f"Request error: {str(e)}")
+            return False
+
+    def test_live_analysis(self):
+        """Test the /api/live WebSocket: full result on open, then a debounced delta after edits"""
+        # c() stays the most complex function, so edits to b() leave the heat of a() and c() alone
+        code = ("function a(x) {\n  return x;\n}\nfunction b(y) {\n  return y;\n}\n"
+                "function c(z) {\n  return z && z > 1 && z < 9 && z !== 4 && z !== 5;\n}\n")
+        try:
+            with open_websocket(f"{WS_BASE}/live?detail=functions") as ws:
+                ws.send(json.dumps({"type": "open", "filename": "live.js", "text": code, "version": 1}))
+                first = json.loads(ws.recv(timeout=30))
+                # Two quick edits to b() are analyzed once, after the debounce
+                for version, text in ((2, " && x"), (3, " || y")):
+                    ws.send(json.dumps({"type": "edit", "version": version, "changes": [{
+                        "range": {"start": {"line": 4, "character": 10}, "end": {"line": 4, "character": 10}},
+                        "text": text
+                    }]}))
+                delta = json.loads(ws.recv(timeout=30))
+
+            splice = delta.get('splices', {}).get('functions', {})
+            changed = [fn['name'] for fn in splice.get('items', [])]
+            if (first.get('type') == 'result' and len(first['result']['functions']) == 3
+                    and delta.get('type') == 'delta' and delta.get('version') == 3 and delta.get('baseVersion') == 1
+                    and splice.get('start') == 1 and splice.get('deleteCount') == 1 and changed == ['b']
+                    and delta['set']['summary']['cyclomaticComplexity'] == 7):
+                self.log_test("Live analysis", True, f"Delta for v3 re-sent {changed}")
+                return True
+            self.log_test("Live analysis", False, f"Unexpected messages: {first.get('type')}, {delta}")
+            return False
+
+        except Exception as e:
+            self.log_test("Live analysis", False, f"WebSocket error: {str(e)}")
+            return False
+
+    def test_archive_analysis(self):
+        """Test /api/analyze/archive with an in-memory .tar.gz repository"""
+        try:
+            files = {
+                "repo/src/app.js": "function main(a) { if (a) { return 1; } return 2; }",
+                "repo/tools/util.py": "def helper(x):\n    return x and 1\n",
+                "repo/README.md": "# not analyzed"
+            }
+            buf = io.BytesIO()
+            with tarfile.open(fileobj=buf, mode="w:gz") as tf:
+                for name, content in files.items():
+                    data = content.encode()
+                    info = tarfile.TarInfo(name)
+                    info.size = len(data)
+                    tf.addfile(info, io.BytesIO(data))
+
+            response = requests.post(f"{API_BASE}/analyze/archive", data=buf.getvalue(),
+                                   headers={"Content-Type": "application/gzip"}, timeout=30)
+
+            if response.status_code == 200:
+                lines = [json.loads(line) for line in response.text.splitlines() if line.strip()]
+                rollup = lines[-1].get('rollup') if lines else None
+                if not rollup or rollup.get('files') != 2 or len(lines) != 3:
+                    self.log_test("Archive analysis", False, f"Unexpected stream: {lines}")
+                    return False
+                self.log_test("Archive analysis", True,
+                             f"Files: {rollup['files']}, LOC: {rollup['loc']}, MI p50: {rollup['maintainabilityIndex']['p50']}")
+                return True
+            else:
+                self.log_test("Archive analysis", False, f"HTTP {response.status_code}")
+                return False
+
+        except Exception as e:
+            self.log_test("Archive analysis", False, f"Request error: {str(e)}")
+            return False
+
+    def test_incremental_analysis(self):
+        """Test /api/analyze/incremental with a diff against a previous result"""
+        try:
+            code = "function first(a) {\n    return a;\n}\n\nfunction second(b) {\n    return b;\n}"
+            response = requests.post(f"{API_BASE}/analyze", json={"code": code, "filename": "inc.js"}, timeout=10)
+            result_id = response.json().get('resultId')
+            if not result_id:
+                self.log_test("Incremental analysis", False, "No resultId in analyze response")
+                return False
+
+            diff = "\n".join([
+                "--- a/inc.js", "+++ b/inc.js", "@@ -5,3 +5,4 @@",
+                " function second(b) {", "+    b = b ? b + 1 : 0;", "     return b;", " }"
+            ])
+            response = requests.post(f"{API_BASE}/analyze/incremental",
+                                   json={"resultId": result_id, "diff": diff}, timeout=10)
+
+            if response.status_code == 200:
+                data = response.json()
+                if data.get('changedFunctions') != ['second'] or data.get('resultId') == result_id:
+                    self.log_test("Incremental analysis", False, f"Unexpected response: {data.get('changedFunctions')}")
+                    return False
+                self.log_test("Incremental analysis", True, f"Changed: {data['changedFunctions']}, spans: {data['changedSpans']}")
+                return True
+            else:
+                self.log_test("Incremental analysis", False, f"HTTP {response.status_code}: {response.text}")
+                return False
+
+        except Exception as e:
+            self.log_test("Incremental analysis", False, f"Request error: {str(e)}")
+            return False
+
+    def test_git_trend_endpoints(self):
+        """Test the git trend series endpoints for a repository no trend job has written"""
+        try:
+            repo = f"no-such-repo-{int(time.time())}"
+            series = requests.get(f"{API_BASE}/trends/{repo}", params={"limit": 10}, timeout=30)
+            file_series = requests.get(f"{API_BASE}/trends/{repo}/file", params={"path": "src/app.js"}, timeout=30)
+            missing_path = requests.get(f"{API_BASE}/trends/{repo}/file", timeout=30)
+            if (series.status_code == 200 and series.json() == {"repo": repo, "count": 0, "points": []}
+                    and file_series.status_code == 200 and file_series.json()["points"] == []
+                    and missing_path.status_code == 422):
+                self.log_test("Git trend endpoints", True, "Empty series and path validation")
+                return True
+            self.log_test("Git trend endpoints", False,
+                          f"HTTP {series.status_code}/{file_series.status_code}/{missing_path.status_code}")
+            return False
+
+        except Exception as e:
+            self.log_test("Git trend endpoints", False, f"Request error: {str(e)}")
+            return False
+
+    def test_job_queue(self):
+        """Test /api/jobs: submit a batch job, poll it to completion and fetch its chunked NDJSON result"""
+        items = [
+            {"code": "function a(x) { return x ? 1 : 2; }", "filename": "job_a.js"},
+            {"code": "def b(y):\n    return y or 3\n", "filename": "job_b.py"},
+            {"code": "const c = (z) => z && z.w;", "filename": "job_c.ts"},
+        ]
+        try:
+            response = requests.post(f"{API_BASE}/jobs", params={"rollup": "true"}, json={"items": items}, timeout=30)
+            job = response.json()
+            if response.status_code != 202 or job.get("status") != "queued":
+                self.log_test("Job queue", False, f"Submit: HTTP {response.status_code}, {job}")
+                return False
+
+            deadline = time.time() + 60
+            while job["status"] in ("queued", "running") and time.time() < deadline:
+                time.sleep(0.5)
+                job = requests.get(f"{API_BASE}/jobs/{job['id']}", timeout=30).json()
+            result = requests.get(f"{API_BASE}/jobs/{job['id']}/result", timeout=30)
+            lines = [json.loads(line) for line in result.text.splitlines()]
+            indexes = sorted(line["index"] for line in lines if "index" in line)
+            cancel_done = requests.delete(f"{API_BASE}/jobs/{job['id']}", timeout=30)
+            unknown = requests.get(f"{API_BASE}/jobs/no-such-job", timeout=30)
+            if (job["status"] == "done" and indexes == [0, 1, 2] and lines[-1]["rollup"]["files"] == 3
+                    and job["resultLines"] == 4 and cancel_done.status_code == 409 and unknown.status_code == 404):
+                self.log_test("Job queue", True, f"{job['resultLines']} lines, {job['resultBytes']} bytes, "
+                                                 f"{job['attempts']} attempt(s)")
+                return True
+            self.log_test("Job queue", False, f"Job {job}, indexes {indexes}, HTTP {cancel_done.status_code}/"
+                                              f"{unknown.status_code}")
+            return False
+
+        except Exception as e:
+            self.log_test("Job queue", False, f"Request error: {str(e)}")
+            return False
+
+    def test_fair_scheduling(self):
+        """Test per-lane scheduler stats and the per-client token bucket on analysis requests"""
+        try:
+            stats = requests.get(f"{API_BASE}/pool/stats", timeout=10).json()
+            scheduler = stats["scheduler"]
+            classes = stats["small"]["classes"]
+            if set(classes) != {"interactive", "bulk"} or "interactiveP95WaitSeconds" not in scheduler:
+                self.log_test("Fair scheduling", False, f"Unexpected stats: {stats}")
+                return False
+            if scheduler["rate"] <= 0:
+                self.log_test("Fair scheduling", True, "Client rate limiting disabled; lane stats present")
+                return True
+
+            # The same source every time, so after the first request these are cache hits
+            payload = {"code": "function limited(a) { return a ? 1 : 2; }", "filename": "limited.js"}
+            key = {"X-API-Key": f"test-{time.time_ns()}"}
+            session = requests.Session()
+            statuses = [session.post(f"{API_BASE}/analyze", json=payload, headers=key, timeout=10)
+                        for _ in range(int(scheduler["burst"]) + int(scheduler["rate"]) + 10)]
+            limited = [r for r in statuses if r.status_code == 429]
+            # Probes only read the cache, so they are not charged even while the client is limited
+            digest = hashlib.sha256(payload["code"].encode()).hexdigest()
+            probe = session.post(f"{API_BASE}/analyze/probe", json={"digest": digest, "filename": "limited.js"},
+                                 headers=key, timeout=10)
+            other = requests.post(f"{API_BASE}/analyze", json=payload,
+                                  headers={"X-API-Key": f"other-{time.time_ns()}"}, timeout=10)
+            after = requests.get(f"{API_BASE}/pool/stats", timeout=10).json()["scheduler"]
+            if (limited and limited[0].headers.get("Retry-After") and statuses[0].status_code == 200
+                    and probe.status_code == 200 and other.status_code == 200
+                    and after["rateLimited"]["interactive"] >= scheduler["rateLimited"]["interactive"] + len(limited)):
+                self.log_test("Fair scheduling", True, f"{len(limited)} of {len(statuses)} analyses rate limited, "
+                                                       f"probe {probe.status_code}, "
+                                                       f"interactive p95 wait {after['interactiveP95WaitSeconds']}s")
+                return True
+            self.log_test("Fair scheduling", False, f"Statuses {[r.status_code for r in statuses]}, "
+                                                    f"probe {probe.status_code}, other client {other.status_code}, {after}")
+            return False
+
+        except Exception as e:
+            self.log_test("Fair scheduling", False, f"Request error: {str(e)}")
+            return False
+
+    def test_pool_backpressure(self):
+        """Test that a full pool lane queue rejects work with 429 and a Retry-After estimate (in process)"""
+        try:
+            server = load_server()
+
+            async def scenario():
+                # No worker processes: one analysis runs at a time in a thread, one more may queue
+                lane = server.PoolLane("backpressure", 0, 1)
+                return lane, await asyncio.gather(*[lane.submit(time.sleep, 0.3) for _ in range(3)],
+                                                  return_exceptions=True)
+
+            lane, results = asyncio.run(scenario())
+            rejected = [r for r in results if isinstance(r, server.HTTPException)]
+            if (results[:2] == [None, None] and len(rejected) == 1 and rejected[0].status_code == 429
+                    and int(rejected[0].headers["Retry-After"]) >= 1 and lane.snapshot()["rejected"] == 1
+                    and lane.snapshot()["pending"] == 0):
+                self.log_test("Pool backpressure", True, f"Retry-After: {rejected[0].headers['Retry-After']}")
+                return True
+            self.log_test("Pool backpressure", False, f"Results: {results}, lane: {lane.snapshot()}")
+            return False
+
+        except Exception as e:
+            self.log_test("Pool backpressure", False, f"Error: {str(e)}")
+            return False
+
+    def test_pool_worker_crash(self):
+        """Test that a worker dying under in-flight analyses replaces its pool once and queued work survives (in process)"""
+        try:
+            server = load_server()
+
+            async def scenario():
+                lane = server.PoolLane("crash", 2, 8)
+                lane.start()
+                try:
+                    # Spawn both workers first, so the crash lands while the long call is running
+                    await asyncio.gather(lane.submit(time.sleep, 0.1), lane.submit(time.sleep, 0.1))
+                    crashed = lane.executor
+                    # Two calls in flight on the pool that breaks, two waiting for a worker
+                    calls = [lane.submit(os._exit, 1), lane.submit(time.sleep, 1.0)]
+                    calls += [lane.submit(time.sleep, 0.1) for _ in range(2)]
+                    results = await asyncio.gather(*calls, return_exceptions=True)
+                    return lane, crashed, results
+                finally:
+                    lane.shutdown()
+
+            lane, crashed, results = asyncio.run(scenario())
+            failed = [getattr(r, "status_code", r) for r in results[:2]]
+            if failed == [503, 503] and results[2:] == [None, None] and lane.restarts == 1 and lane.executor is None:
+                self.log_test("Pool worker crash", True, "In-flight calls got 503, queued calls ran on one replacement pool")
+                return True
+            self.log_test("Pool worker crash", False, f"Results: {results}, restarts: {lane.restarts}, "
+                                                      f"replaced: {crashed is not None}")
+            return False
+
+        except Exception as e:
+            self.log_test("Pool worker crash", False, f"Error: {str(e)}")
+            return False
+
+    def test_history_timestamp_boundaries(self):
+        """Test that history timestamps on a whole second order, page and filter like their neighbours (in process)"""
+        try:
+            server = load_server()
+            second = datetime(2026, 1, 1, 12, 0, 5, tzinfo=server.timezone.utc)
+            moments = [second - server.timedelta(microseconds=1), second, second + server.timedelta(microseconds=1)]
+            result = {"filename": "boundary.py", "language": "python", "linterIssues": [],
+                      "summary": {"loc": 1, "cyclomaticComplexity": 1, "maintainabilityIndex": 100, "functionCount": 0}}
+
+            class FrozenClock(datetime):
+                moment = None
+
+                @classmethod
+                def now(cls, tz=None):
+                    return cls.moment
+
+            records = []
+            original = server.datetime
+            server.datetime = FrozenClock
+            try:
+                for moment in moments:
+                    FrozenClock.moment = moment
+                    records.append(server.history_record(result))
+            finally:
+                server.datetime = original
+
+            # Mongo compares these fields as strings, and so does this check
+            query = server.history_query(None, None, second, None, server.encode_history_cursor(records[2]))
+            matched = [r for r in records if r["timestamp"] >= query["timestamp"]["$gte"]
+                       and (r["timestamp"] < records[2]["timestamp"]
+                            or (r["timestamp"] == records[2]["timestamp"] and r["id"] < records[2]["id"]))]
+            timestamps = [r["timestamp"] for r in records]
+            if (timestamps == sorted(timestamps) and timestamps[1].endswith(":05.000000+00:00")
+                    and matched == [records[1]]):
+                self.log_test("History timestamp boundaries", True, timestamps[1])
+                return True
+            self.log_test("History timestamp boundaries", False, f"Timestamps: {timestamps}, matched: {matched}")
+            return False
+
+        except Exception as e:
+            self.log_test("History timestamp boundaries", False, f"Error: {str(e)}")
+            return False
+
+    def test_history_stats_bucket_bounds(self):
+        """Test that history stats leave out the bucket starting at until and keep a partial one (in process)"""
+        try:
+            server = load_server()
+            hour = datetime(2026, 1, 1, 5, tzinfo=server.timezone.utc)
+            records = [{"timestamp": server.iso_timestamp(hour + server.timedelta(minutes=minutes)), "language": "python",
+                        "complexity": 1, "maintainability": 100.0, "loc": 1, "functionCount": 0, "issueCount": 0}
+                       for minutes in (-30, 0, 30, 60)]
+            buckets = {}
+            for update in server.rollup_updates(records):
+                doc = update._doc["$setOnInsert"]
+                buckets.setdefault(doc["granularity"], set()).add(doc["bucket"])
+
+            def selected(granularity, until):
+                match = server.history_stats_pipeline(granularity, None, hour - server.timedelta(days=1), until)[0]["$match"]
+                # Mongo compares bucket keys as strings, and so does this check
+                return sorted(b for b in buckets[granularity]
+                              if match["bucket"]["$gte"] <= b < match["bucket"]["$lt"])
+
+            at_hour = selected("hour", hour)
+            mid_hour = selected("hour", hour + server.timedelta(minutes=30))
+            at_day = selected("day", hour.replace(hour=0))
+            if (at_hour == ["2026-01-01T04:00:00+00:00"]
+                    and mid_hour == ["2026-01-01T04:00:00+00:00", "2026-01-01T05:00:00+00:00"]
+                    and at_day == []):
+                self.log_test("History stats bucket bounds", True, "Bucket at until left out, partial bucket kept")
+                return True
+            self.log_test("History stats bucket bounds", False,
+                          f"At hour: {at_hour}, mid hour: {mid_hour}, at day: {at_day}")
+            return False
+
+        except Exception as e:
+            self.log_test("History stats bucket bounds", False, f"Error: {str(e)}")
+            return False
+
+    def test_live_invalid_edits(self):
+        """Test that a rejected /api/live edit leaves the whole document as it was, and oversized edits keep the session"""
+        code = "function a(x) {\n  return x;\n}\nfunction b(y) {\n  return y;\n}\n"
+        insert = lambda line, character, text: {
+            "range": {"start": {"line": line, "character": character}, "end": {"line": line, "character": character}},
+            "text": text
+        }
+        try:
+            with open_websocket(f"{WS_BASE}/live?detail=summary") as ws:
+                ws.send(json.dumps({"type": "open", "filename": "resync.js", "text": code, "version": 1}))
+                first = json.loads(ws.recv(timeout=30))
+                # A valid change followed by a reversed range: neither may be applied
+                ws.send(json.dumps({"type": "edit", "version": 2, "changes": [insert(1, 10, " && x"), {
+                    "range": {"start": {"line": 4, "character": 9}, "end": {"line": 4, "character": 2}}, "text": ""
+                }]}))
+                invalid = json.loads(ws.recv(timeout=30))
+                ws.send(json.dumps({"type": "edit", "version": 3, "changes": [{"text": "x" * (1024 * 1024 + 1)}]}))
+                oversized = json.loads(ws.recv(timeout=30))
+                ws.send(json.dumps({"type": "edit", "version": 4, "changes": [insert(4, 10, " || y")]}))
+                delta = json.loads(ws.recv(timeout=30))
+
+            # Only b()'s new || counts: the " && x" of the rejected edit never reached the document
+            complexity = delta.get("set", {}).get("summary", {}).get("cyclomaticComplexity")
+            if (invalid.get("type") == "error" and invalid.get("version") == 1 and oversized.get("status") == 413
+                    and oversized.get("version") == 1 and delta.get("version") == 4
+                    and complexity == first["result"]["summary"]["cyclomaticComplexity"] + 1):
+                self.log_test("Live invalid edits", True, f"{invalid['message']}; {oversized['message']}")
+                return True
+            self.log_test("Live invalid edits", False, f"Messages: {invalid}, {oversized}, {delta}")
+            return False
+
+        except Exception as e:
+            self.log_test("Live invalid edits", False, f"WebSocket error: {str(e)}")
+            return False
+
+    def test_analysis_size_limit(self):
+        """Test that the analysis size limit counts UTF-8 bytes, not characters (in process)"""
+        try:
+            server = load_server()
+            limit, server.ANALYSIS_MAX_BYTES = server.ANALYSIS_MAX_BYTES, 1000
+            try:
+                # 407 characters, 1207 bytes
+                source = "s = '" + "\u20ac" * 400 + "'\n"
+                try:
+                    asyncio.run(asyncio.wait_for(server.analyze_cached(source, "wide.py"), 10))
+                    status = None
+                except server.HTTPException as e:
+                    status = e.status_code
+            finally:
+                server.ANALYSIS_MAX_BYTES = limit
+            if status == 413:
+                self.log_test("Analysis size limit", True, f"{len(source)} characters, {len(source.encode())} bytes rejected")
+                return True
+            self.log_test("Analysis size limit", False, f"Status: {status}")
+            return False
+
+        except Exception as e:
+            self.log_test("Analysis size limit", False, f"Error: {str(e)}")
+            return False
+
+    def test_python_engine_spans(self):
+        """Test that the ast and regex Python engines agree on function spans (in process)"""
+        source = (
+            "import os\n\n\n"
+            "def outer(a, b=1):\n"
+            "    def inner(x):\n"
+            "        return x\n"
+            "\n"
+            "    # trailing comment\n"
+            "    return inner(a)\n"
+            "\n\n"
+            "class Box:\n"
+            "    @property\n"
+            "    def size(self):\n"
+            "        return (1 +\n"
+            "2)\n"
+            "\n"
+            "    async def load(self, *paths):\n"
+            "        doc = \"\"\"\n"
+            "text\n"
+            "\"\"\"\n"
+            "        return doc\n"
+            "    # between methods\n"
+            "\n"
+            "    def last(self):\n"
+            "        pass\n"
+            "\n\n"
+        )
+        try:
+            server = load_server()
+            spans = {}
+            engine = server.PYTHON_ENGINE
+            try:
+                for name in ("ast", "regex"):
+                    server.PYTHON_ENGINE = name
+                    server._span_memo.clear()
+                    functions = server.analyze_code(source, "spans.py")["functions"]
+                    spans[name] = [(f["name"], f["startLine"], f["endLine"], f["loc"]) for f in functions]
+            finally:
+                server.PYTHON_ENGINE = engine
+                server._span_memo.clear()
+            versions = server.ANALYZER_VERSIONS
+            if spans["ast"] == spans["regex"] and len(spans["ast"]) == 5 and versions["ast"] != versions["regex"]:
+                self.log_test("Python engine spans", True, f"{len(spans['ast'])} functions, versions {sorted(versions.values())}")
+                return True
+            self.log_test("Python engine spans", False, f"ast: {spans['ast']}, regex: {spans['regex']}, versions: {versions}")
+            return False
+
+        except Exception as e:
+            self.log_test("Python engine spans", False, f"Error: {str(e)}")
+            return False
+
+    def test_result_encoding_unchanged(self):
+        """Test that full and compact result bodies are byte-identical to the pinned digests (in process)"""
+        try:
+            server = load_server()
+            sys.path.insert(0, str(Path(__file__).resolve().parent / "backend" / "benchmarks"))
+            from corpora import FILENAMES, generate
+
+            engine, server.PYTHON_ENGINE = server.PYTHON_ENGINE, "regex"
+            try:
+                changed = []
+                for corpus, expected in RESULT_DIGESTS.items():
+                    language, kind = corpus.split("/")
+                    result = server.analyze_code(generate(language, kind, 1000), FILENAMES[language])
+                    bodies = [server.dump_json(server.shape_result(result, "full", compact)) for compact in (False, True)]
+                    digests = tuple(hashlib.sha256(body).hexdigest()[:16] for body in bodies)
+                    if digests != expected:
+                        changed.append(f"{corpus}: {digests}")
+            finally:
+                server.PYTHON_ENGINE = engine
+            if not changed:
+                self.log_test("Result encoding unchanged", True, f"{len(RESULT_DIGESTS)} corpora, full and compact")
+                return True
+            self.log_test("Result encoding unchanged", False, "; ".join(changed))
+            return False
+
+        except Exception as e:
+            self.log_test("Result encoding unchanged", False, f"Error: {str(e)}")
+            return False
+
     def run_all_tests(self):
         """Run complete backend test suite"""
         print("=" * 60)
@@ -334,9 +1218,38 @@ def validate_config(config):
             self.test_python_analysis()
             self.test_invalid_code_handling()
             self.test_history_endpoint()
+            self.test_history_writer_stats()
+            self.test_history_pagination_and_stats()
+            self.test_git_trend_endpoints()
+            self.test_server_timing_and_metrics()
             self.test_malformed_requests()
+            self.test_nested_function_metrics()
+            self.test_cache_stats_endpoint()
+            self.test_rule_overrides()
+            self.test_batch_analysis()
+            self.test_batch_rollup_distributions()
+            self.test_duplicate_logic_clones()
+            self.test_archive_analysis()
+            self.test_job_queue()
+            self.test_fair_scheduling()
+            self.test_stream_analysis()
+            self.test_degraded_analysis()
+            self.test_detail_levels_and_compact()
+            self.test_conditional_requests()
+            self.test_incremental_analysis()
+            self.test_live_analysis()
+            self.test_live_invalid_edits()
         else:
             print("\n❌ Health check failed - skipping other tests")
+
+        # These drive the worker pool in this process and need no running server
+        self.test_history_timestamp_boundaries()
+        self.test_history_stats_bucket_bounds()
+        self.test_analysis_size_limit()
+        self.test_python_engine_spans()
+        self.test_result_encoding_unchanged()
+        self.test_pool_backpressure()
+        self.test_pool_worker_crash()
         
         # Print summary
         print("\n" + "=" * 60)